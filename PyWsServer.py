@@ -1,11 +1,35 @@
 import tornado.httpserver
 import tornado.websocket
 import tornado.ioloop
+import tornado.netutil
 import tornado.web
+import tornado.gen
+import asyncio
 import socket
+import time
+import os
 import mbedWSClient
+import messageParser
+import diskWriter
+import segmentStore
+import historyApi
+import rollupStore
+import broadcast
+import flowControl
+import clusterServer
+import serverMetrics
+import writeAheadLog
+import dayArchive
+import deviceIndex
+import idleReaper
+import liveStream
+import trafficCapture
+import hotRestart
+import ruleEngine
 import gui
 import threading
+import argparse
+import sys
 """ Simple WebSocket server GUI that uses the Tornado WebSocket handler.
 
 FILENAME
@@ -18,17 +42,61 @@ DESCRIPTION
     WebSocket connections on port 4444. When a microcontroller has connected, it will send data to the server every
     3 seconds. The server will save the data to a .csv file every 100 samples from the microcontroller. Pressing the
     'Stop' button will force the server to save all data from memory to disk.
+    The history of each microcontroller can be read back over HTTP on the same port, see historyApi.py, and the
+    server's metrics are available at /metrics, see serverMetrics.py. Dashboards can subscribe to the live samples of
+    chosen IoTDs on the WebSocket route /live, see liveStream.py.
+    Microcontrollers can also send their data in a compact binary format, see messageParser.py.
     You can also send data to all connected microcontrollers or a single microcontroller. Currently the only feature
     implemented is the ability to turn on and off an LED on the microcontroller. Set the "Value:" textbox to 1, and the
     "Address:" textbox to "All", and press the 'Send Command to IoTD' button to turn on the LED on all connected
-    microcontrollers.
+    microcontrollers. The address can also be the IoT ID of one microcontroller, or the name of a group of them (see
+    the --group option).
+    A headless server can use several processes with --workers, see clusterServer.py.
+    Each connection has a limit on the samples it can send per second, and a bounded queue of outgoing commands, see
+    flowControl.py. Commands can report their delivery to each IoTD (the GUI shows it under the Send button).
+    Quiet connections are pinged, and the connections of IoTDs that stop answering are closed, see idleReaper.py.
+    With --wal, every sample is also written to a write-ahead log, so the data that was not saved yet survives a
+    crash: it is saved when the server starts again, see writeAheadLog.py.
+    With --archive, the .csv files of the finished days are converted to compact archives, see dayArchive.py.
+    The IoTDs of the previous runs are indexed from the names and tails of the data files when the server starts,
+    and their recent samples are read back when they reconnect, see deviceIndex.py.
+    IoTDs on slow links can compress their messages with permessage-deflate when the server is started with
+    --deflate.
+    With --capture, the traffic of the IoTDs is recorded to a file, that trafficReplay.py can play again.
+    A new version of a headless server can take over from the running one with --takeover, without closing the port
+    or disconnecting every IoTD at once, see hotRestart.py.
+    With --rules, each sample is checked against rules (thresholds, rates of change, windowed statistics, missing
+    samples) as it arrives, and a rule can send a command when it fires, see ruleEngine.py.
     Messages are output to the console for debugging purposes.
+    The server can also be run without the GUI by passing --headless on the command line. In this mode the data is
+    only saved to disk, and the server runs until it is interrupted with Ctrl-C. When the GUI is used, the server
+    thread never touches the Tk widgets directly: the latest sample from each IoTD is placed in a coalescing update
+    queue, and the GUI drains that queue at most --fps times per second.
 
 REQUIREMENTS
     Files:
         gui.py
         mbedWSClient.py
         ResizingCanvas.py
+        sampleStore.py
+        diskWriter.py
+        segmentStore.py
+        historyApi.py
+        rollupStore.py
+        downsample.py
+        messageParser.py
+        broadcast.py
+        flowControl.py
+        clusterServer.py
+        serverMetrics.py
+        writeAheadLog.py
+        dayArchive.py
+        deviceIndex.py
+        idleReaper.py
+        liveStream.py
+        trafficCapture.py
+        hotRestart.py
+        ruleEngine.py
         Tornado installed
 
 AUTHOR
@@ -57,14 +125,28 @@ LICENSE
 
 """
 
-# This is where we keep a list of connected IoTDs
-Devices = []
-# This is the frame where the graphs are added:
-IoTDVisualFrame = []
+# This is where we keep track of the connected IoTDs and their data
+Registry = mbedWSClient.DeviceRegistry()
+# This is where we keep the metrics of the server
+Metrics = serverMetrics.ServerMetrics(Registry)
+# This is the queue the GUI drains to draw the latest data (None when running headless):
+IoTDUpdateQueue = None
+# This pings the quiet connections and closes the dead ones, it is made by the TornadoThread:
+Heartbeats = None
+# The trafficCapture.Recorder of the incoming traffic, or None:
+Capture = None
 
 DEBUG = 0
 INFOMSG = 1
 
+PORT = 4444
+# Seconds the server waits for the WebSocket connections to close when it stops:
+CLOSETIMEOUT = 2.0
+# Offer permessage-deflate to the clients that ask for it, and its zlib settings:
+DEFLATE = False
+DEFLATELEVEL = 6
+DEFLATEMEMLEVEL = 5
+
 
 def debug_msg(msg):
     if DEBUG:
@@ -77,28 +159,83 @@ def info_msg(msg):
 
 
 class WSHandler(tornado.websocket.WebSocketHandler):
+    def select_subprotocol(self, subprotocols):
+        # IoTDs that want to send binary messages ask for it with a subprotocol:
+        if messageParser.BINARYSUBPROTOCOL in subprotocols:
+            return messageParser.BINARYSUBPROTOCOL
+        return None
+
     def open(self):
         info_msg('New connection.')
-        Devices.append(mbedWSClient.MbedWSClient(self))
-        self.index = len(Devices) - 1
+        self.binary = (self.selected_subprotocol == messageParser.BINARYSUBPROTOCOL or
+                       self.get_argument("format", "text") == "binary")
+        self.parse_errors = 0
+        # Inbound rate limit, and outgoing command queue:
+        self.bucket = flowControl.TokenBucket()
+        self.commands = flowControl.CommandQueue(self, on_drop=Metrics.on_command_dropped)
+        self.client = Registry.add_connection(self)
+        Heartbeats.add(self)
+        if Capture is not None:
+            self.capture_id = Capture.open(self.binary)
+        Metrics.connections_opened += 1
 
     def on_message(self, message):
-        # Saving message:
-        debug_msg("Received at index: %d message: %s" % (self.index, message))
-        Devices[self.index].append_data(message, IoTDVisualFrame[0])
-        # self.write_message(message[::-1])
-
-    def send_message(self, message):
-        # Send a message to the client:
+        # Parse the message once, and save the samples it holds:
+        Metrics.messages += 1
+        Heartbeats.touch(self)
+        if Capture is not None:
+            Capture.message(self.capture_id, message)
+        if not self.bucket.ready():
+            # The IoTD sends more than its share, drop the message without parsing it:
+            Metrics.rate_limited += 1
+            return
+        timer = Metrics.stage_timer
+        if timer is not None:
+            lap = timer.start()
+        try:
+            if isinstance(message, bytes):
+                if not self.binary:
+                    raise messageParser.ParseError("Binary message on a text connection")
+                samples = messageParser.parse_binary(message)
+            else:
+                samples = messageParser.parse_text(message)
+        except messageParser.ParseError as e:
+            self.parse_errors += 1
+            Metrics.parse_errors += 1
+            debug_msg("Message from %s dropped: %s" % (self.request.remote_ip, e))
+            return
+        if timer is not None:
+            timer.lap("parse", lap)
+        self.bucket.take(len(samples))
+        for sample in samples:
+            self.client.append_sample(sample, IoTDUpdateQueue)
+
+    def send_message(self, message, delivery=None):
+        # Queue a message to the client, delivery is a flowControl.Delivery or None:
         debug_msg("sending message: %s" % message)
-        self.write_message(message)
+        self.commands.put(message, delivery=delivery)
+
+    def on_pong(self, data):
+        Heartbeats.touch(self)
 
     def on_close(self):
         info_msg('connection closed')
+        Heartbeats.remove(self)
+        if Capture is not None:
+            Capture.close(self.capture_id)
+        Registry.remove_connection(self)
+        self.commands.close()
+        Metrics.connections_closed += 1
 
     def check_origin(self, origin):
         return True
 
+    def get_compression_options(self):
+        # None disables compression. Otherwise it is used with the clients that negotiate it:
+        if not DEFLATE:
+            return None
+        return {"compression_level": DEFLATELEVEL, "mem_level": DEFLATEMEMLEVEL}
+
     def is_wsconnected(self):
         if self.ws_connection is None:
             return False
@@ -107,71 +244,354 @@ class WSHandler(tornado.websocket.WebSocketHandler):
 
 
 class TornadoThread (threading.Thread):
-    def __init__(self):
+    def __init__(self, sockets=None, worker=None, takeover=None):
+        # sockets are listening sockets to serve, by default the server listens on PORT. worker is the number of the
+        # process in cluster mode, or None. takeover is the hotRestart.Takeover of the server this one replaces, or
+        # None.
         threading.Thread.__init__(self)
-        self.application = tornado.web.Application([(r'/ws', WSHandler)])
+        # The sockets are bound here, so a busy port is reported at once, and served by the IOLoop of run():
+        self.sockets = sockets if sockets is not None else tornado.netutil.bind_sockets(PORT)
+        self.takeover = takeover
+        if takeover is not None:
+            takeover.apply(Registry)
+        # Data is saved to disk by a separate thread, so that the IOLoop never waits for the disk:
+        segments = None
+        segment_reader = None
+        csv = mbedWSClient.STORAGE in ("csv", "both")
+        if mbedWSClient.STORAGE in ("segments", "both"):
+            segments = segmentStore.SegmentStore(mbedWSClient.DATADIRECTORY, mbedWSClient.MAXVALUES)
+            segment_reader = segmentStore.SegmentStore(mbedWSClient.DATADIRECTORY, mbedWSClient.MAXVALUES)
+        self.wal = None
+        if writeAheadLog.ENABLED:
+            # Save what the last run left in the log before taking any new data. A worker only replays its own log,
+            # and the log of the server being taken over from is its own until it stops:
+            wal_name = "main" if worker is None else "worker%d" % worker
+            if takeover is not None:
+                wal_name = "restart%d" % os.getpid()
+            else:
+                writeAheadLog.recover(None if worker is None else wal_name, csv, segments)
+            self.wal = writeAheadLog.WriteAheadLog(wal_name)
+            self.wal.start()
+        Registry.wal = self.wal
+        global Heartbeats, Capture
+        Heartbeats = idleReaper.HeartbeatWheel(on_reap=self.reap)
+        if trafficCapture.CAPTUREFILE:
+            name = trafficCapture.CAPTUREFILE
+            if worker is not None:
+                name = "%s.worker%d" % (name, worker)
+            Capture = trafficCapture.Recorder(name)
+            Capture.start()
+        # Know the IoTDs of the previous runs, their history is only read when it is needed:
+        Registry.index = deviceIndex.DeviceIndex(mbedWSClient.DATADIRECTORY, segment_reader).build()
+        self.disk_writer = diskWriter.DiskWriter(csv, segments, durable=self.wal is not None)
+        # The data of each day is saved to that day's files, the day is moved on at midnight:
+        self.rollover = mbedWSClient.RolloverScheduler(Registry)
+        self.archiver = None
+        if dayArchive.ENABLED and csv:
+            # Archive the finished days now, and after each midnight once their files are written and closed:
+            self.archiver = dayArchive.Archiver()
+            self.rollover.listeners.append(self.archive_before)
+        # The live samples for the dashboards:
+        self.live = liveStream.LiveHub(Registry)
+        # The rules checked on each sample:
+        self.rules = None
+        if ruleEngine.RULES:
+            self.rules = ruleEngine.RuleEngine(Registry, ruleEngine.RULES, send=self.send_cmd_now)
+            self.rules.callbacks.append(self.on_rule)
+        self.application = tornado.web.Application([
+            (r'/ws', WSHandler),
+            (r'/history/([0-9]+)', historyApi.HistoryHandler,
+             dict(registry=Registry, segments=segment_reader,
+                  rollups=rollupStore.RollupStore(mbedWSClient.DATADIRECTORY, mbedWSClient.MAXVALUES))),
+            (r'/metrics', serverMetrics.MetricsHandler, dict(metrics=Metrics)),
+            (r'/live', liveStream.LiveHandler, dict(hub=self.live)),
+        ])
         self.http_server = tornado.httpserver.HTTPServer(self.application)
-        self.http_server.listen(4444)
+        # A new server can take over the listening sockets from this one:
+        self.handoff = None
+        if hotRestart.ENABLED and worker is None:
+            self.handoff = hotRestart.Handoff(self, Registry)
+        self.ioloop = None
+        self.own_ioloop = False
+        self.disk_writer.start()
+        Registry.writer = self.disk_writer
 
     def run(self):
         info_msg("Start a tornado")
+        if threading.current_thread() is not threading.main_thread():
+            # Each server thread runs its own IOLoop, a thread made by clone() does not reuse the last one:
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            self.own_ioloop = True
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        self.http_server.add_sockets(self.sockets)
+        Metrics.start(self.ioloop, self.disk_writer)
+        self.rollover.start(self.ioloop)
+        Heartbeats.start()
+        self.live.start()
+        if self.rules is not None:
+            self.rules.start()
+        if self.archiver is not None:
+            self.archiver.start()
+            self.archiver.archive_before(Registry.day)
+        if self.wal is not None:
+            self.wal.start_timers(Registry, self.disk_writer)
+        if self.handoff is not None:
+            self.handoff.start()
+        if self.takeover is not None:
+            self.takeover.start()
         myIP = socket.gethostbyname(socket.gethostname())
         info_msg("*** Websocket Server Started at %s ***" % myIP)
-        tornado.ioloop.IOLoop.instance().start()
+        self.ioloop.start()
 
     def stop(self):
         info_msg("Stop a tornado")
-        tornado.ioloop.IOLoop.instance().stop()
-        self.http_server.close_all_connections()
-        self.http_server.stop()
+        try:
+            if self.is_alive() and threading.current_thread() is not self:
+                # Stopped from another thread (the GUI's): the IOLoop closes the connections and stops, then the
+                # thread ends:
+                self.ioloop.add_callback(self.stop_ioloop)
+                self.join()
+            elif self.ioloop is not None:
+                # The IOLoop of this thread is not running any more (Ctrl-C), run it until the connections are
+                # closed:
+                self.ioloop.run_sync(self.close_connections)
+            else:
+                # It never ran:
+                for sock in self.sockets:
+                    sock.close()
+        finally:
+            # A callback cut short by the Ctrl-C raises it again in run_sync, the data is saved all the same:
+            self.shut_down()
+
+    def shut_down(self):
+        # Stop the services of the server and save the data left in memory, once the connections are closed:
+        if self.handoff is not None:
+            self.handoff.stop()
+        Heartbeats.stop()
+        Metrics.stop()
+        self.live.stop()
+        if self.rules is not None:
+            self.rules.stop()
+        if Capture is not None:
+            Capture.stop()
         # Save any data left in memory:
-        for handler in Devices:
-            handler.save_data_to_disk(-1)
-
-    def send_cmd(self, adr, cmd):
-        # Send a command string to an IoTD:
+        self.rollover.stop()
+        Registry.close_rollups()
+        if self.wal is not None:
+            self.wal.checkpoint(Registry, self.disk_writer)
+        if Registry.held:
+            # Nobody granted these IoT IDs (the coordinator or the old server is gone). Writing their files beside
+            # another process is better than losing their data:
+            info_msg("Saving the data of IoTDs %s, which were never granted" % sorted(Registry.held))
+        Registry.save_data_to_disk(-1, force=True)
+        self.disk_writer.stop()
+        Registry.index.save(Registry)
+        if self.wal is not None:
+            self.wal.stop()
+            Registry.wal = None
+        if self.archiver is not None:
+            self.archiver.stop()
+        if self.own_ioloop:
+            self.ioloop.close()
+
+    async def close_connections(self):
+        # Stop listening, and close the WebSocket connections. Those that are still open after CLOSETIMEOUT seconds
+        # are dropped with the process:
+        self.http_server.stop()
+        for handler in list(Registry.connections):
+            handler.close(1001, "server stopping")
+        await self.http_server.close_all_connections()
+        deadline = time.monotonic() + CLOSETIMEOUT
+        while Registry.connections and time.monotonic() < deadline:
+            await tornado.gen.sleep(0.05)
+
+    async def stop_ioloop(self):
+        await self.close_connections()
+        self.ioloop.stop()
+
+    def reap(self, handler):
+        # handler was idle for too long. Its IoT IDs are unbound now, the connection is closed by the wheel:
+        info_msg("Closing an idle connection")
+        Registry.remove_connection(handler)
+        Metrics.idle_reaped += 1
+
+    def on_rule(self, name, IoTID, event, value, timestamp):
+        if event == "fired":
+            Metrics.rules_fired += 1
+
+    def archive_before(self, day):
+        self.disk_writer.release(-1, lambda: self.archiver.archive_before(day))
+
+    def send_cmd(self, adr, cmd, ack=None, timeout=None):
+        # Send a command string to an IoTD. This can be called from any thread (like the GUI's), the command is sent
+        # from the IOLoop. adr is -1 for all of the IoTDs, an IoT ID, or the name of a group.
+        # ack is called from the IOLoop as ack(IoT ID, cmd, status) for each IoTD, see flowControl.Delivery. timeout
+        # is in seconds, flowControl.DELIVERYTIMEOUT by default.
+        if self.ioloop is None:
+            info_msg("The server is not running. Command not sent.")
+        else:
+            self.ioloop.add_callback(self.send_cmd_now, adr, cmd, ack, timeout)
+
+    def send_cmd_now(self, adr, cmd, ack=None, timeout=None):
+        delivery = None
+        if ack is not None:
+            def delivery(handler):
+                # Report to ack what becomes of the command on handler:
+                return flowControl.Delivery(ack, handler.client.ID, cmd, timeout)
         if adr == -1:
-            # send the command to all of the IoTDs:
-            for handler in Devices:
-                if handler.is_connected():
-                    handler.send_cmdstr(cmd)
-
+            # send the command to all of the IoTDs, the frame is only built once:
+            handlers = [client.handle for client in Registry.clients()]
+            self.ioloop.spawn_callback(broadcast.fan_out, handlers, cmd, False, delivery)
+        elif isinstance(adr, str):
+            # Send it to every connected IoTD of a group:
+            handlers = [client.handle for client in Registry.group_clients(adr)]
+            if not handlers:
+                info_msg("No IoTD of group %s is connected. Command not sent." % adr)
+            else:
+                self.ioloop.spawn_callback(broadcast.fan_out, handlers, cmd, False, delivery)
         else:
-            # Send it to a particular IoTD.
-            # First find the IoTD we are interested in:
-            cmd_sent = -1
-            # In reality, the outer for loop only goes through once sing the clientDict is a 'global'
-            # variable amongst all of the handlers in Devices:
-            for handler in Devices:
-                for key in handler.clientDict:
-                    IoTDID = handler.clientDict[key].ID
-                    debug_msg("IoTDID: %d, clientDict[key].ID: %d, key: %d" % (IoTDID, handler.clientDict[key].ID, key))
-                    if IoTDID == adr:
-                        # This logic is a bit circular and dirty, but it works:
-                        if handler.clientDict[key].handle.is_wsconnected():
-                            handler.clientDict[key].handle.send_message(cmd)
-                            cmd_sent = 1
-                        else:
-                            info_msg("Connection to IoTD with address: %d lost." % adr)
-                            cmd_sent = 0
-                        break
-                if cmd_sent != -1:
-                    break
-            if cmd_sent == -1:
+            # Send it to a particular IoTD:
+            client = Registry.lookup(adr)
+            if client is None:
                 info_msg("IoTD %d is not connected. Command not sent." % adr)
+                if ack is not None:
+                    ack(adr, cmd, "closed")
+            elif client.is_connected():
+                client.send_cmdstr(cmd, None if delivery is None else delivery(client.handle))
+            else:
+                info_msg("Connection to IoTD with address: %d lost." % adr)
+                if ack is not None:
+                    ack(adr, cmd, "closed")
+
+    def tag_device(self, IoTID, group):
+        # Add an IoT ID to a group, from any thread:
+        if self.ioloop is None:
+            Registry.tag(IoTID, group)
+        else:
+            self.ioloop.add_callback(Registry.tag, IoTID, group)
 
     def clone(self):
         return TornadoThread()
 
-    def setFrame(self, some_frame):
-        IoTDVisualFrame.append(some_frame)
+    def setUpdateQueue(self, update_queue):
+        global IoTDUpdateQueue
+        IoTDUpdateQueue = update_queue
+
 
+def run_headless(thread):
+    # Run the server on this thread until Ctrl-C is pressed:
+    try:
+        thread.run()
+    except KeyboardInterrupt:
+        info_msg("Keyboard interrupt received")
+    thread.stop()
 
-MyThread = TornadoThread()
-WebSocketGui = gui.WSGui(MyThread)
 
 if __name__ == "__main__":
-    # Start the GUI:
-    WebSocketGui.start()
+    parser = argparse.ArgumentParser(description="WebSocket server for mbed IoT devices")
+    parser.add_argument("--headless", action="store_true", help="run the server without the GUI")
+    parser.add_argument("--fps", type=float, default=gui.REFRESHRATE,
+                        help="maximum number of GUI refreshes per second (default: %(default)s)")
+    parser.add_argument("--retention", type=int, default=mbedWSClient.RETENTION,
+                        help="number of saved samples kept in memory per IoTD (default: %(default)s)")
+    parser.add_argument("--storage", choices=("csv", "segments", "both"), default=mbedWSClient.STORAGE,
+                        help="how the data is saved to disk (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=PORT, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run a headless server in this many processes (default: one process)")
+    parser.add_argument("--cluster-socket", default=clusterServer.CLUSTERSOCKET,
+                        help="Unix socket of the --workers coordinator (default: %(default)s)")
+    parser.add_argument("--stage-timing", action="store_true",
+                        help="time each stage of the incoming messages, see /metrics")
+    parser.add_argument("--rate-limit", type=float, default=flowControl.INBOUNDRATE,
+                        help="samples per second accepted from each connection, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--rate-burst", type=float, default=flowControl.INBOUNDBURST,
+                        help="samples a connection can send in a burst (default: %(default)s)")
+    parser.add_argument("--cmd-queue", type=int, default=flowControl.QUEUELIMIT,
+                        help="outgoing messages queued per connection (default: %(default)s)")
+    parser.add_argument("--cmd-policy", choices=flowControl.POLICIES, default=flowControl.POLICY,
+                        help="what to do when the queue of a connection is full (default: %(default)s)")
+    parser.add_argument("--ping-interval", type=float, default=idleReaper.PINGINTERVAL,
+                        help="seconds of silence before a connection is pinged, 0 for never (default: %(default)s)")
+    parser.add_argument("--idle-timeout", type=float, default=idleReaper.IDLETIMEOUT,
+                        help="seconds of silence before a connection is closed, 0 for never (default: %(default)s)")
+    parser.add_argument("--capture", default=None, metavar="FILE",
+                        help="record the incoming traffic to FILE, for trafficReplay.py")
+    parser.add_argument("--rules", default=None, metavar="FILE",
+                        help="check the samples against the rules of a JSON file as they arrive, see ruleEngine.py")
+    parser.add_argument("--handoff", action="store_true",
+                        help="hand the port over to a new server started with --takeover, then drain")
+    parser.add_argument("--takeover", action="store_true",
+                        help="take the port over from the running server started with --handoff")
+    parser.add_argument("--handoff-socket", default=hotRestart.HANDOFFSOCKET,
+                        help="Unix socket of the --handoff server (default: %(default)s)")
+    parser.add_argument("--drain-period", type=float, default=hotRestart.DRAINPERIOD,
+                        help="seconds over which the connections are moved to the new server (default: %(default)s)")
+    parser.add_argument("--archive", action="store_true",
+                        help="convert the .csv files of the finished days to compact archives")
+    parser.add_argument("--deflate", action="store_true",
+                        help="offer permessage-deflate compression to the IoTDs that ask for it")
+    parser.add_argument("--open-files", type=int, default=diskWriter.MAXOPENFILES,
+                        help="maximum number of .csv files kept open (default: %(default)s)")
+    parser.add_argument("--wal", action="store_true",
+                        help="keep a write-ahead log of the incoming samples, so they survive a crash")
+    parser.add_argument("--wal-interval", type=float, default=writeAheadLog.COMMITINTERVAL,
+                        help="seconds between the fsyncs of the write-ahead log (default: %(default)s)")
+    parser.add_argument("--wal-bytes", type=int, default=writeAheadLog.COMMITBYTES,
+                        help="number of logged bytes that triggers an early fsync (default: %(default)s)")
+    parser.add_argument("--group", action="append", default=[], metavar="NAME=ID,ID,...",
+                        help="put IoT IDs in a named group, that commands can be sent to")
+    args = parser.parse_args()
+    for group in args.group:
+        name, ids = group.split("=", 1)
+        for IoTID in ids.split(","):
+            Registry.tag(int(IoTID), name.strip())
+    mbedWSClient.RETENTION = args.retention
+    mbedWSClient.STORAGE = args.storage
+    Metrics.stage_timing = args.stage_timing
+    diskWriter.MAXOPENFILES = args.open_files
+    flowControl.INBOUNDRATE = args.rate_limit
+    flowControl.INBOUNDBURST = args.rate_burst
+    flowControl.QUEUELIMIT = args.cmd_queue
+    flowControl.POLICY = args.cmd_policy
+    idleReaper.PINGINTERVAL = args.ping_interval
+    idleReaper.IDLETIMEOUT = args.idle_timeout
+    trafficCapture.CAPTUREFILE = args.capture
+    hotRestart.ENABLED = args.handoff
+    if args.rules:
+        try:
+            ruleEngine.RULES = ruleEngine.load_rules(args.rules)
+        except (OSError, ValueError) as e:
+            parser.error("Could not load the rules from %s: %s" % (args.rules, e))
+    hotRestart.HANDOFFSOCKET = args.handoff_socket
+    hotRestart.DRAINPERIOD = args.drain_period
+    writeAheadLog.ENABLED = args.wal
+    dayArchive.ENABLED = args.archive
+    DEFLATE = args.deflate
+    writeAheadLog.COMMITINTERVAL = args.wal_interval
+    writeAheadLog.COMMITBYTES = args.wal_bytes
+    PORT = args.port
+    if args.workers > 0:
+        if args.handoff or args.takeover:
+            parser.error("--handoff and --takeover do not work with --workers")
+        if args.archive:
+            parser.error("--archive does not work with --workers, run dayArchive.py by hand instead")
+        clusterServer.run_cluster(args.workers, PORT, TornadoThread, Registry, run_headless, args.cluster_socket)
+        sys.exit(0)
+    if args.takeover:
+        # Take the listening sockets of the running server, before anything else is started:
+        try:
+            Takeover = hotRestart.Takeover()
+        except (OSError, ValueError) as e:
+            parser.error("Could not take over from the server on %s: %s" % (args.handoff_socket, e))
+        MyThread = TornadoThread(Takeover.sockets, takeover=Takeover)
+    else:
+        MyThread = TornadoThread()
+    if args.headless:
+        run_headless(MyThread)
+    else:
+        # Start the GUI:
+        WebSocketGui = gui.WSGui(MyThread, args.fps)
+        WebSocketGui.start()
 
 
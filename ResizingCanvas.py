@@ -6,6 +6,8 @@ FILENAME
 
 DESCRIPTION
     This is a subclass of Canvas that will automatically resize when the window re-sizes.
+    By default, every item is scaled along with the canvas. If an on_resize callback is given, the items are left
+    alone and the callback is called instead, so that the owner can place its items again from its own data.
 
 AUTHOR
     ebarr
@@ -16,8 +18,9 @@ AUTHOR
 
 class RC(Canvas):
     """A subclass of Canvas for dealing with resizing of windows"""
-    def __init__(self, parent, **kwargs):
+    def __init__(self, parent, on_resize=None, **kwargs):
         Canvas.__init__(self, parent, **kwargs)
+        self.resize_callback = on_resize
         self.bind("<Configure>", self.on_resize)
         self.height = self.winfo_reqheight()
         self.width = self.winfo_reqwidth()
@@ -30,5 +33,8 @@ class RC(Canvas):
         self.height = event.height
         # resize the canvas
         self.config(width=self.width, height=self.height)
+        if self.resize_callback is not None:
+            self.resize_callback(event)
+            return
         # rescale all the objects tagged with the "all" tag
         self.scale("all", 0, 0, wscale, hscale)
@@ -0,0 +1,115 @@
+import struct
+import tornado.gen
+import tornado.iostream
+import tornado.websocket
+""" Encode-once fan-out of messages to many WebSocket connections
+
+FILENAME
+    broadcast.py
+
+DESCRIPTION
+    Sending the same message to many IoTDs with write_message builds the same WebSocket frame again for every
+    connection. Frames sent by a server are not masked, so the frame is the same for everybody: fan_out() builds it
+    once, and writes the same bytes to the stream of every connection.
+    The connections are written to in batches of BATCHSIZE, and the IOLoop is given back between batches, so that a
+    message to thousands of IoTDs does not hold up the incoming data.
+    Connections that may use compression (see WSHandler.get_compression_options) need their own frame, those are
+    sent the message with write_message.
+    Connections with a flowControl.CommandQueue (handler.commands) get the frame through their queue, so a slow IoTD
+    never has more than its queue limit buffered. The queue can report the delivery to each IoTD.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+# Number of connections written to before giving the IOLoop back:
+BATCHSIZE = 500
+
+OPCODETEXT = 0x1
+OPCODEBINARY = 0x2
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[broadcast : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[broadcast : INFO] %s' % msg)
+
+
+def encode_frame(message, binary=False):
+    # Build an unmasked, unfragmented WebSocket frame:
+    if isinstance(message, str):
+        payload = message.encode("utf-8")
+    else:
+        payload = message
+        binary = True
+    first = 0x80 | (OPCODEBINARY if binary else OPCODETEXT)
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", first, length)
+    elif length <= 0xFFFF:
+        header = struct.pack("!BBH", first, 126, length)
+    else:
+        header = struct.pack("!BBQ", first, 127, length)
+    return header + payload
+
+
+def write_frame(handler, frame, message, binary=False):
+    # Write a frame built by encode_frame to the connection of a WebSocketHandler. Return the Future of the write,
+    # which is done once the frame is handed to the socket, or None if the connection is closed.
+    connection = handler.ws_connection
+    if connection is None or connection.stream is None or connection.stream.closed():
+        return None
+    try:
+        if handler.get_compression_options() is not None:
+            return handler.write_message(message, binary)
+        return connection.stream.write(frame)
+    except (tornado.iostream.StreamClosedError, tornado.websocket.WebSocketClosedError):
+        return None
+
+
+async def fan_out(handlers, message, binary=False, delivery=None):
+    # Send a message to a list of WebSocketHandlers, and return the number of connections it was written or queued
+    # to. delivery(handler) may return a flowControl.Delivery for the message to each handler.
+    frame = encode_frame(message, binary)
+    sent = 0
+    for ii in range(0, len(handlers), BATCHSIZE):
+        for handler in handlers[ii:ii + BATCHSIZE]:
+            commands = getattr(handler, "commands", None)
+            if commands is not None:
+                if commands.put(message, binary, frame, None if delivery is None else delivery(handler)):
+                    sent += 1
+            elif write_frame(handler, frame, message, binary) is not None:
+                sent += 1
+        if ii + BATCHSIZE < len(handlers):
+            await tornado.gen.sleep(0)
+    debug_msg("Message sent to %d of %d connections" % (sent, len(handlers)))
+    return sent
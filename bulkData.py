@@ -0,0 +1,421 @@
+import os
+import sys
+import json
+import time
+import argparse
+import operator
+from array import array
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+import diskWriter
+import dayArchive
+import deviceIndex
+import rollupStore
+import mbedWSClient
+try:
+    import numpy
+except ImportError:
+    numpy = None
+""" Bulk export and import of the data files
+
+FILENAME
+    bulkData.py
+
+DESCRIPTION
+    Offline analysis used to mean parsing the IoTD###_YYYYMMDD.csv files by hand, whose HH:MM:SS.ffffff times have
+    no date. This tool loads many IoTD/day files at once, over a pool of processes, and exports the samples of the
+    chosen IoTDs and days merged in time order, with full time stamps:
+        python bulkData.py export [--ids 1,2] [--from 20161001] [--to 20161031] out.npz
+        python bulkData.py export --format columns out_directory
+    The export has the columns "time", "iotd" and then the values of the samples (see mbedWSClient.COLUMNNAMES).
+    The npz format needs numpy. The columns format is always available: a directory holding one file per column,
+    <name>.f64, as little-endian doubles, and columns.json, which lists the columns and the number of rows. Both can
+    be loaded with numpy (numpy.load, numpy.fromfile).
+    Each file is parsed a whole column at a time: the text is split once into numbers, and the columns are sliced
+    out of them. The date comes from the file name, and the hours are converted to time stamps once each, like
+    diskWriter.parse_rows does. A file with an odd line falls back to diskWriter.read_csv_file. The archives of
+    dayArchive.py are read as well, they are already columnar.
+    The reverse direction backfills the data directory from an export:
+        python bulkData.py import in.npz
+    The samples are split by IoTD and day, and merged into the daily .csv files (a sample that is already there is
+    not added twice). The days that were archived are archived again. The rollups of the IoTDs that were imported
+    are then rebuilt from all of their data, since samples may have been added before their last bucket. Import
+    only when the server is stopped, it writes the same files.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+FORMATS = ("npz", "columns")
+COLUMNEXTENSION = ".f64"
+COLUMNSFILE = "columns.json"
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[bulkData : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[bulkData : INFO] %s' % msg)
+
+
+def column_names(num_values):
+    # The names of the exported columns, for samples of num_values values (the time stamp included):
+    names = ["time", "iotd"]
+    for jj in range(1, num_values):
+        names.append(mbedWSClient.COLUMNNAMES[jj] if jj < len(mbedWSClient.COLUMNNAMES) else "value%d" % jj)
+    return names
+
+
+def find_days(directory, ids=None, first=None, last=None):
+    # Return the files of the chosen IoTDs and days (YYYYMMDD ints), as a sorted list of
+    # (IoT ID, YYYYMMDD, [paths]). A day can have both a .csv file and an archive.
+    days = {}
+    for name in os.listdir(directory):
+        parsed = deviceIndex.parse_filename(name)
+        if parsed is None:
+            continue
+        IoTID, stamp, ext = parsed
+        if (ids is not None and IoTID not in ids) or (first is not None and stamp < first) or \
+                (last is not None and stamp > last):
+            continue
+        days.setdefault((IoTID, stamp), []).append(os.path.join(directory, name))
+    return [(IoTID, stamp, sorted(days[(IoTID, stamp)])) for IoTID, stamp in sorted(days)]
+
+
+def parse_csv_text(text, year, month, day):
+    # Parse the text of a .csv file a column at a time. Returns the columns as arrays of doubles, starting with the
+    # full time stamps, or None if the lines do not all have the same number of fields.
+    lines = text.split("\n", 1)
+    if not lines[0].strip():
+        return []
+    width = lines[0].count(",") + 3
+    fields = text.replace(":", " ").replace(",", " ").split()
+    if len(fields) % width != 0:
+        return None
+    try:
+        if numpy is not None:
+            values = array('d', numpy.array(fields, dtype=float).tobytes())
+        else:
+            values = array('d', map(float, fields))
+    except ValueError:
+        return None
+    hours = values[0::width]
+    hour_starts = {}
+    for hour in set(hours):
+        hour_starts[hour] = time.mktime((year, month, day, int(hour), 0, 0, 0, 0, -1))
+    # time = start of the hour + 60 * minutes + seconds:
+    seconds = map(operator.add, map((60.0).__mul__, values[1::width]), values[2::width])
+    columns = [array('d', map(operator.add, map(hour_starts.__getitem__, hours), seconds))]
+    for jj in range(3, width):
+        columns.append(values[jj::width])
+    return columns
+
+
+def read_csv_columns(path):
+    # Read a .csv file as columns, parsing it line by line only if it cannot be parsed a column at a time:
+    stamp = os.path.basename(path)[-12:-4]
+    with open(path, 'r') as fp:
+        text = fp.read()
+    columns = parse_csv_text(text, int(stamp[0:4]), int(stamp[4:6]), int(stamp[6:8]))
+    if columns is None:
+        debug_msg("%s has odd lines, parsing it line by line" % path)
+        rows = list(diskWriter.read_csv_file(path))
+        columns = [array('d', values) for values in zip(*rows)]
+    return columns
+
+
+def read_day_files(paths):
+    # Read the .csv files and archives of one IoTD and day, merged in time order:
+    parts = []
+    for path in paths:
+        if path.endswith(".csv"):
+            parts.append(read_csv_columns(path))
+        else:
+            parts.append(dayArchive.read_columns(path))
+    parts = [columns for columns in parts if columns and len(columns[0])]
+    if len(parts) == 1:
+        return parts[0]
+    return merge_rows(parts)
+
+
+def merge_rows(parts):
+    # Merge sets of columns into one, in time order, without the rows that are in more than one of them. The rows
+    # are compared to the 6 decimals of the .csv files, as bytes so that nan values match:
+    rows = {}
+    for columns in parts:
+        rows.update((array('d', [round(value, 6) for value in row]).tobytes(), row) for row in zip(*columns))
+    rows = sorted(rows.values(), key=operator.itemgetter(0))
+    if not rows:
+        return []
+    return [array('d', values) for values in zip(*rows)]
+
+
+def load_day(task):
+    # Run in the pool: read the files of one IoTD and day.
+    IoTID, stamp, paths = task
+    try:
+        return IoTID, stamp, read_day_files(paths), None
+    except (OSError, ValueError) as e:
+        return IoTID, stamp, [], "%s (%s)" % (", ".join(paths), e)
+
+
+def run_tasks(function, tasks, processes):
+    # Map function over the tasks, in a pool of processes when there is more than one:
+    if processes <= 1 or len(tasks) <= 1:
+        return map(function, tasks)
+    pool = ProcessPoolExecutor(max_workers=processes)
+    try:
+        return list(pool.map(function, tasks, chunksize=max(1, len(tasks) // (4 * processes))))
+    finally:
+        pool.shutdown()
+
+
+def sort_columns(columns):
+    # Sort the columns by their first column (the time stamps), keeping the order of equal time stamps:
+    if numpy is not None:
+        order = numpy.argsort(numpy.frombuffer(columns[0], dtype=float), kind="stable")
+        return [array('d', numpy.frombuffer(column, dtype=float)[order].tobytes()) for column in columns]
+    order = sorted(range(len(columns[0])), key=columns[0].__getitem__)
+    return [array('d', map(column.__getitem__, order)) for column in columns]
+
+
+def export_data(directory, ids=None, first=None, last=None, processes=None):
+    # Load the chosen IoTDs and days. Returns (names, columns), sorted by time stamp.
+    tasks = find_days(directory, ids, first, last)
+    info_msg("Loading %d IoTD days" % len(tasks))
+    columns = None
+    for IoTID, stamp, day_columns, error in run_tasks(load_day, tasks, processes or os.cpu_count() or 1):
+        if error is not None:
+            info_msg("Could not read %s" % error)
+            continue
+        if not day_columns:
+            continue
+        if columns is None:
+            columns = [array('d') for ii in range(len(day_columns) + 1)]
+        if len(day_columns) + 1 != len(columns):
+            info_msg("Skipping IoTD %d on %d, it has %d values per sample instead of %d" %
+                     (IoTID, stamp, len(day_columns), len(columns) - 1))
+            continue
+        columns[0].extend(day_columns[0])
+        columns[1].extend(array('d', [IoTID]) * len(day_columns[0]))
+        for column, values in zip(columns[2:], day_columns[1:]):
+            column.extend(values)
+    if columns is None:
+        columns = [array('d') for ii in range(mbedWSClient.MAXVALUES + 1)]
+    return column_names(len(columns) - 1), sort_columns(columns)
+
+
+def write_columns(path, names, columns):
+    os.makedirs(path, exist_ok=True)
+    for name, column in zip(names, columns):
+        if sys.byteorder == "big":
+            column = array('d', column)
+            column.byteswap()
+        with open(os.path.join(path, name + COLUMNEXTENSION), 'wb') as fp:
+            column.tofile(fp)
+    with open(os.path.join(path, COLUMNSFILE), 'w') as fp:
+        json.dump({"columns": names, "rows": len(columns[0]), "dtype": "<f8"}, fp)
+
+
+def read_columns(path):
+    with open(os.path.join(path, COLUMNSFILE), 'r') as fp:
+        header = json.load(fp)
+    columns = []
+    for name in header["columns"]:
+        column = array('d')
+        with open(os.path.join(path, name + COLUMNEXTENSION), 'rb') as fp:
+            column.frombytes(fp.read())
+        if sys.byteorder == "big":
+            column.byteswap()
+        if len(column) != header["rows"]:
+            raise ValueError("%s has %d rows instead of %d" % (name, len(column), header["rows"]))
+        columns.append(column)
+    return header["columns"], columns
+
+
+def write_npz(path, names, columns):
+    numpy.savez_compressed(path, **dict((name, numpy.frombuffer(column, dtype=float))
+                                        for name, column in zip(names, columns)))
+
+
+def read_npz(path):
+    with numpy.load(path) as data:
+        names = [name for name in column_names(len(data.files) - 1) if name in data.files]
+        if len(names) != len(data.files):
+            names = ["time", "iotd"] + sorted(name for name in data.files if name not in ("time", "iotd"))
+        return names, [array('d', data[name].astype('<f8').tobytes()) for name in names]
+
+
+def read_export(path):
+    # Return (names, columns) of an export in either format:
+    if os.path.isdir(path):
+        return read_columns(path)
+    if numpy is None:
+        raise ValueError("reading %s needs numpy" % path)
+    return read_npz(path)
+
+
+def split_days(names, columns):
+    # Split an export by IoTD and day, as a sorted list of (IoT ID, YYYYMMDD, columns without "iotd"):
+    if names[0:2] != ["time", "iotd"]:
+        raise ValueError("the export must start with the time and iotd columns")
+    groups = {}
+    day_of = {}
+    for ii, (t, IoTID) in enumerate(zip(columns[0], columns[1])):
+        # Midnight is on a quarter of an hour in every time zone, so the day is only looked up once per quarter:
+        quarter = int(t // 900)
+        if quarter not in day_of:
+            day_of[quarter] = deviceIndex.day_stamp(date.fromtimestamp(quarter * 900))
+        groups.setdefault((int(IoTID), day_of[quarter]), []).append(ii)
+    days = []
+    for key in sorted(groups):
+        rows = groups[key]
+        days.append(key + ([array('d', map(column.__getitem__, rows)) for column in columns[:1] + columns[2:]],))
+    return days
+
+
+def import_day(task):
+    # Run in the pool: merge the samples of one IoTD and day into its .csv file (and archive). Returns the number of
+    # samples added, or an error message.
+    directory, IoTID, stamp, columns = task
+    day = deviceIndex.stamp_day(stamp)
+    csv_file = os.path.join(directory, os.path.basename(mbedWSClient.csv_filename(IoTID, day)))
+    archive = dayArchive.archive_filename(csv_file)
+    try:
+        existing = read_day_files([path for path in (csv_file, archive) if os.path.isfile(path)])
+        if existing and len(existing) != len(columns):
+            return "%s has %d values per sample, the export has %d" % (csv_file, len(existing), len(columns))
+        merged = merge_rows([existing, columns])
+        added = len(merged[0]) - (len(existing[0]) if existing else 0)
+        if added == 0:
+            return 0
+        lines = diskWriter.format_rows(merged)
+        lines.append("")
+        temp = csv_file + ".tmp"
+        with open(temp, 'w') as fp:
+            fp.write("\n".join(lines))
+        os.replace(temp, csv_file)
+        if os.path.isfile(archive):
+            # The day was archived, fold the new samples into the archive:
+            dayArchive.archive_file(csv_file)
+        return added
+    except (OSError, ValueError) as e:
+        return "%s (%s)" % (csv_file, e)
+
+
+def rebuild_rollups(directory, IoTID):
+    # Write the rollup files of IoTD again, from all of its days:
+    days = find_days(directory, set([IoTID]))
+    rollups = None
+    files = {}
+    try:
+        for day_id, stamp, paths in days:
+            columns = read_day_files(paths)
+            if not columns:
+                continue
+            if rollups is None:
+                rollups = rollupStore.RollupSet(len(columns))
+            for sample in zip(*columns):
+                rollups.add(sample)
+            write_rollups(directory, IoTID, rollups.take_pending(), files)
+        if rollups is not None:
+            rollups.close()
+            write_rollups(directory, IoTID, rollups.take_pending(), files)
+    finally:
+        for fp in files.values():
+            fp.close()
+    for tier, width in rollupStore.TIERS:
+        filename = rollupStore.rollup_filename(directory, tier, IoTID)
+        if tier in files:
+            os.replace(filename + ".tmp", filename)
+
+
+def write_rollups(directory, IoTID, pending, files):
+    for tier in pending:
+        if not len(pending[tier]):
+            continue
+        if tier not in files:
+            filename = rollupStore.rollup_filename(directory, tier, IoTID)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            files[tier] = open(filename + ".tmp", 'wb')
+        pending[tier].tofile(files[tier])
+
+
+def import_data(directory, names, columns, processes=None, rollups=True):
+    # Merge an export into the data directory. Returns the number of samples added.
+    days = split_days(names, columns)
+    info_msg("Importing %d samples into %d IoTD days" % (len(columns[0]), len(days)))
+    tasks = [(directory,) + day for day in days]
+    added = 0
+    for (IoTID, stamp, day_columns), result in zip(days, run_tasks(import_day, tasks, processes or os.cpu_count() or 1)):
+        if isinstance(result, str):
+            info_msg("Could not import IoTD %d on %d: %s" % (IoTID, stamp, result))
+        else:
+            added += result
+    if rollups:
+        for IoTID in sorted(set(day[0] for day in days)):
+            rebuild_rollups(directory, IoTID)
+    return added
+
+
+def parse_ids(text):
+    return set(int(part) for part in text.split(",") if part.strip())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk export and import of the data files")
+    parser.add_argument("direction", choices=("export", "import"))
+    parser.add_argument("path", help="the export file (npz) or directory (columns)")
+    parser.add_argument("--data", default=mbedWSClient.DATADIRECTORY,
+                        help="data directory of the server (default: %(default)s)")
+    parser.add_argument("--ids", type=parse_ids, default=None, help="IoT IDs to export, e.g. 1,2,5 (default: all)")
+    parser.add_argument("--from", dest="first", type=int, default=None, help="first day to export, as YYYYMMDD")
+    parser.add_argument("--to", dest="last", type=int, default=None, help="last day to export, as YYYYMMDD")
+    parser.add_argument("--format", choices=FORMATS, default=None,
+                        help="export format (default: npz if numpy is installed, else columns)")
+    parser.add_argument("--processes", type=int, default=None, help="number of processes (default: one per CPU)")
+    parser.add_argument("--no-rollups", action="store_true", help="do not rebuild the rollups after an import")
+    args = parser.parse_args()
+    began = time.monotonic()
+    if args.direction == "export":
+        fmt = args.format or ("npz" if numpy is not None else "columns")
+        if fmt == "npz" and numpy is None:
+            parser.error("the npz format needs numpy, use --format columns")
+        names, columns = export_data(args.data, args.ids, args.first, args.last, args.processes)
+        if fmt == "npz":
+            write_npz(args.path, names, columns)
+        else:
+            write_columns(args.path, names, columns)
+        info_msg("Exported %d samples to %s in %.3f s" % (len(columns[0]), args.path, time.monotonic() - began))
+    else:
+        names, columns = read_export(args.path)
+        added = import_data(args.data, names, columns, args.processes, not args.no_rollups)
+        info_msg("Imported %d new samples from %s in %.3f s" % (added, args.path, time.monotonic() - began))
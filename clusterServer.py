@@ -0,0 +1,351 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.tcpserver
+""" Multi-process server
+
+FILENAME
+    clusterServer.py
+
+DESCRIPTION
+    Runs the server in several worker processes, so that more than one core parses and saves the incoming data. The
+    processes are:
+        the parent
+            Forks the other processes, restarts those that die, and stops everything on Ctrl-C. It never runs an
+            IOLoop, so forking from it is safe.
+        the coordinator
+            Listens on a Unix socket (CLUSTERSOCKET). It keeps a map from each IoT ID to the worker that owns it, and
+            routes commands to the right worker.
+        the workers
+            Each one runs a headless server. They all listen on the same port with SO_REUSEPORT, so the kernel spreads
+            the connections between them.
+    Each IoT ID is owned by one worker at a time, and only its owner writes its files. When an IoTD connects to a
+    worker, the worker tells the coordinator ('bind'). If another worker owned the IoT ID, the coordinator asks it to
+    save and close the files of the IoT ID ('release'), and only then lets the new worker write them ('grant'). In the
+    meantime the new worker keeps the data in memory.
+    If the coordinator dies, the parent starts a new one. Until then the workers write the files of their IoT IDs
+    directly, then they connect to it again and ask for their IoT IDs once more.
+    Commands reach an IoTD on any worker through the coordinator: a single IoT ID goes to its owner, "All" and groups
+    go to every worker (groups come from the command line, so all workers know them). To send a command:
+        python3 clusterServer.py <address> <command>
+    where address is All, an IoT ID or a group name.
+
+    The worker-coordinator messages are JSON objects, one per line:
+        worker -> coordinator   {"op": "hello", "worker": n}, {"op": "bind", "id": n}, {"op": "released", "id": n}
+        coordinator -> worker   {"op": "grant", "id": n}, {"op": "release", "id": n}, {"op": "send", "adr": a,
+                                "cmd": c}
+        anybody -> coordinator  {"op": "send", "adr": a, "cmd": c}
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+CLUSTERSOCKET = "./PyWsServer.sock"
+# Seconds between the attempts of a worker to connect to the coordinator:
+RECONNECTDELAY = 1.0
+# A worker that dies sooner than this after starting is not restarted, something is wrong with it:
+MINUPTIME = 5.0
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[clusterServer : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[clusterServer : INFO] %s' % msg)
+
+
+def encode(msg):
+    return (json.dumps(msg) + "\n").encode("utf-8")
+
+
+class Coordinator(tornado.tcpserver.TCPServer):
+    def __init__(self):
+        tornado.tcpserver.TCPServer.__init__(self)
+        # The stream of each worker:
+        self.workers = {}
+        # The worker that owns each IoT ID:
+        self.owners = {}
+        # The worker waiting for each IoT ID to be released by its owner:
+        self.waiting = {}
+
+    async def handle_stream(self, stream, address):
+        worker = None
+        try:
+            while True:
+                msg = json.loads((await stream.read_until(b"\n")).decode("utf-8"))
+                op = msg.get("op")
+                if op == "hello":
+                    worker = msg["worker"]
+                    self.workers[worker] = stream
+                    info_msg("Worker %d connected" % worker)
+                elif op == "bind" and worker is not None:
+                    self.bind(msg["id"], worker)
+                elif op == "released" and worker is not None:
+                    self.released(msg["id"], worker)
+                elif op == "send":
+                    self.route(msg["adr"], msg["cmd"])
+                else:
+                    info_msg("Unknown message: %s" % msg)
+        except tornado.iostream.StreamClosedError:
+            pass
+        except ValueError as e:
+            info_msg("Bad message from worker %s: %s" % (worker, e))
+            stream.close()
+        if worker is not None and self.workers.get(worker) is stream:
+            info_msg("Worker %d disconnected" % worker)
+            del self.workers[worker]
+            # The data of its IoT IDs is on disk now, other workers can take them over:
+            for IoTID in [key for key in self.owners if self.owners[key] == worker]:
+                del self.owners[IoTID]
+            for IoTID in [key for key in self.waiting if self.owners.get(key) is None]:
+                self.bind(IoTID, self.waiting.pop(IoTID))
+
+    def send(self, worker, msg):
+        if worker in self.workers:
+            try:
+                self.workers[worker].write(encode(msg))
+            except tornado.iostream.StreamClosedError:
+                pass
+
+    def bind(self, IoTID, worker):
+        owner = self.owners.get(IoTID)
+        if owner is None or owner == worker or owner not in self.workers:
+            self.owners[IoTID] = worker
+            self.waiting.pop(IoTID, None)
+            self.send(worker, {"op": "grant", "id": IoTID})
+        else:
+            # Ask the owner to let go first:
+            debug_msg("IoTD %d moves from worker %d to worker %d" % (IoTID, owner, worker))
+            if IoTID not in self.waiting:
+                self.send(owner, {"op": "release", "id": IoTID})
+            self.waiting[IoTID] = worker
+
+    def released(self, IoTID, worker):
+        if self.owners.get(IoTID) == worker:
+            del self.owners[IoTID]
+        if IoTID in self.waiting:
+            self.bind(IoTID, self.waiting.pop(IoTID))
+
+    def route(self, adr, cmd):
+        if adr == -1 or isinstance(adr, str):
+            for worker in self.workers:
+                self.send(worker, {"op": "send", "adr": adr, "cmd": cmd})
+        elif adr in self.owners:
+            self.send(self.owners[adr], {"op": "send", "adr": adr, "cmd": cmd})
+        else:
+            info_msg("IoTD %d is not connected. Command not sent." % adr)
+
+
+class WorkerLink(object):
+    """The connection from a worker to the coordinator"""
+    def __init__(self, worker, path, thread, registry):
+        self.worker = worker
+        self.path = path
+        self.thread = thread
+        self.registry = registry
+        self.stream = None
+        # True once the hello is sent, until the coordinator is lost:
+        self.connected = False
+        # The IoT IDs this worker owns, or has asked for:
+        self.owned = set()
+        registry.bind_callback = self.bind
+
+    async def connect(self):
+        # Connect to the coordinator, retrying every RECONNECTDELAY seconds, and ask again for the IoT IDs this worker
+        # owns (a new coordinator does not know them):
+        while True:
+            self.stream = tornado.iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            try:
+                await self.stream.connect(self.path)
+                break
+            except tornado.iostream.StreamClosedError:
+                debug_msg("Worker %d cannot reach the coordinator" % self.worker)
+                await tornado.gen.sleep(RECONNECTDELAY)
+        self.connected = True
+        self.write({"op": "hello", "worker": self.worker})
+        for IoTID in sorted(self.owned):
+            self.hold(IoTID)
+        tornado.ioloop.IOLoop.current().spawn_callback(self.read_loop)
+
+    def write(self, msg):
+        if self.connected and not self.stream.closed():
+            self.stream.write(encode(msg))
+
+    def bind(self, IoTID):
+        if IoTID not in self.owned:
+            self.owned.add(IoTID)
+            # Without the coordinator nobody would grant it, the data is then written at once instead of being kept
+            # in memory (the IoT ID is asked for once the worker is connected again):
+            if self.connected:
+                self.hold(IoTID)
+
+    def hold(self, IoTID):
+        # Keep the data in memory until the coordinator lets us write it:
+        self.registry.held.add(IoTID)
+        self.write({"op": "bind", "id": IoTID})
+
+    async def read_loop(self):
+        ioloop = tornado.ioloop.IOLoop.current()
+        try:
+            while True:
+                msg = json.loads((await self.stream.read_until(b"\n")).decode("utf-8"))
+                op = msg.get("op")
+                if op == "grant":
+                    self.registry.grant(msg["id"])
+                elif op == "release":
+                    IoTID = msg["id"]
+                    self.owned.discard(IoTID)
+                    self.registry.release(IoTID, lambda IoTID=IoTID: ioloop.add_callback(
+                        self.write, {"op": "released", "id": IoTID}))
+                elif op == "send":
+                    self.thread.send_cmd_now(msg["adr"], msg["cmd"])
+        except tornado.iostream.StreamClosedError:
+            info_msg("Worker %d lost the coordinator" % self.worker)
+        except ValueError as e:
+            info_msg("Bad message from the coordinator: %s" % e)
+            self.stream.close()
+        # Nobody can grant the IoT IDs that are held any more, write them directly until the coordinator is back:
+        self.connected = False
+        for IoTID in self.owned:
+            self.registry.grant(IoTID)
+        await self.connect()
+
+
+def run_coordinator(path):
+    if os.path.exists(path):
+        os.remove(path)
+    coordinator = Coordinator()
+    coordinator.add_socket(tornado.netutil.bind_unix_socket(path))
+    info_msg("Coordinator listening on %s" % path)
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    except KeyboardInterrupt:
+        pass
+    os.remove(path)
+
+
+def run_worker(worker, port, path, thread_factory, registry, run):
+    # Every worker listens on the same port, the kernel balances the connections:
+    sockets = tornado.netutil.bind_sockets(port, reuse_port=True)
+    thread = thread_factory(sockets, worker)
+    link = WorkerLink(worker, path, thread, registry)
+    tornado.ioloop.IOLoop.current().add_callback(link.connect)
+    info_msg("Worker %d started (pid %d)" % (worker, os.getpid()))
+    run(thread)
+
+
+def run_cluster(num_workers, port, thread_factory, registry, run, path=CLUSTERSOCKET):
+    # thread_factory(sockets, worker) builds a PyWsServer.TornadoThread serving the given sockets, registry is the
+    # DeviceRegistry it uses, and run(thread) runs it until Ctrl-C.
+    children = {}
+
+    def spawn(task):
+        pid = os.fork()
+        if pid == 0:
+            # The child process:
+            code = 0
+            try:
+                if task == 0:
+                    run_coordinator(path)
+                else:
+                    run_worker(task, port, path, thread_factory, registry, run)
+            except Exception as e:
+                info_msg("Process %d failed: %s" % (task, e))
+                code = 1
+            sys.stdout.flush()
+            os._exit(code)
+        children[pid] = (task, time.time())
+
+    spawn(0)
+    # Wait for the coordinator to listen before starting the workers:
+    for ii in range(100):
+        if os.path.exists(path):
+            break
+        time.sleep(0.05)
+    for task in range(1, num_workers + 1):
+        spawn(task)
+    stopping = False
+    while children:
+        try:
+            pid, status = os.wait()
+        except KeyboardInterrupt:
+            # Ctrl-C reaches every process of the terminal, make sure they all stop:
+            stopping = True
+            for pid in children:
+                if children[pid][0] > 0:
+                    os.kill(pid, signal.SIGINT)
+            continue
+        except ChildProcessError:
+            break
+        if pid not in children:
+            continue
+        task, started = children.pop(pid)
+        if not stopping:
+            name = "Worker %d" % task if task > 0 else "The coordinator"
+            if status != 0 and time.time() - started > MINUPTIME:
+                # The workers reconnect to a new coordinator:
+                info_msg("%s died, restarting it" % name)
+                spawn(task)
+            else:
+                info_msg("%s exited" % name)
+        if not [pid for pid in children if children[pid][0] > 0]:
+            # All of the workers are gone, stop the coordinator too:
+            stopping = True
+            for pid in children:
+                os.kill(pid, signal.SIGINT)
+    info_msg("All server processes stopped")
+
+
+def send_command(adr, cmd, path=CLUSTERSOCKET):
+    # Send a command through the coordinator. adr is -1 for all of the IoTDs, an IoT ID or a group name.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(encode({"op": "send", "adr": adr, "cmd": cmd}))
+    sock.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 clusterServer.py <All|IoT ID|group> <command>")
+        sys.exit(1)
+    address = sys.argv[1]
+    if address == "All":
+        address = -1
+    elif address.isdigit():
+        address = int(address)
+    send_command(address, sys.argv[2])
@@ -0,0 +1,310 @@
+import os
+import sys
+import zlib
+import struct
+import operator
+import argparse
+import tempfile
+import threading
+from array import array
+from datetime import date
+from itertools import accumulate
+import diskWriter
+import mbedWSClient
+""" Compact columnar archive of the finished days
+
+FILENAME
+    dayArchive.py
+
+DESCRIPTION
+    The daily .csv files are plain text, about 40 bytes per sample. Once a day is over, its files are never written
+    again, so each of them can be converted to a compact columnar file next to it:
+        ./Data/IoTD001_20161024.csv  ->  ./Data/IoTD001_20161024.iotz
+    Each column is stored on its own. The values are scaled to integers (the .csv files keep 6 decimals, so this
+    loses nothing), delta-encoded, byte-shuffled and compressed with zlib. Time stamps become small steady deltas
+    and slowly changing values become runs of zero bytes, which compress very well. A column that cannot be scaled
+    (it holds nan or inf) is stored as byte-shuffled doubles instead. The encoding works on whole columns with
+    array, map and slicing, never with a Python loop over the bytes.
+    The file starts with HEADER (magic, version, number of columns, number of rows), followed by COLUMNHEADER
+    (scale, 0 for raw doubles, and compressed size) and the compressed data of each column.
+    read_day() reads the samples of a day from the .csv file, or from the archive if the .csv file is gone, so the
+    rest of the server does not need to know whether a day was archived.
+    With --archive, the server runs an Archiver thread, that archives the days before the current one when it
+    starts and after every midnight. The .csv file is only deleted once the archive is written, synced and read
+    back. The Archiver is not available with --workers, since every worker would archive the same files. The same
+    can be done by hand, and the archives can be turned back into .csv files:
+        python dayArchive.py [--keep-csv] [files...]
+        python dayArchive.py --extract [files...]
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+# The server only archives when this is set (see the --archive option of PyWsServer.py):
+ENABLED = False
+EXTENSION = ".iotz"
+MAGIC = b"IOTZ"
+VERSION = 1
+# The .csv files keep 6 decimals:
+SCALE = 1e6
+COMPRESSLEVEL = 9
+
+HEADER = struct.Struct("<4sHHQ")
+COLUMNHEADER = struct.Struct("<dQ")
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[dayArchive : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[dayArchive : INFO] %s' % msg)
+
+
+def archive_filename(csv_file):
+    return csv_file[:-4] + EXTENSION
+
+
+def file_day(filename):
+    # The day of an IoTD###_YYYYMMDD file:
+    stamp = os.path.basename(filename).rsplit("_", 1)[1][0:8]
+    return date(int(stamp[0:4]), int(stamp[4:6]), int(stamp[6:8]))
+
+
+def shuffle(data, width=8):
+    # Group the first bytes of every value together, then the second bytes, and so on:
+    return b"".join(data[ii::width] for ii in range(width))
+
+
+def unshuffle(data, width=8):
+    count = len(data) // width
+    result = bytearray(len(data))
+    for ii in range(width):
+        result[ii::width] = data[ii * count:(ii + 1) * count]
+    return bytes(result)
+
+
+def encode_column(column):
+    # Return (scale, compressed data) for a column of floats:
+    try:
+        scaled = array('q', map(round, map(SCALE.__mul__, column)))
+        deltas = array('q', map(operator.sub, scaled, array('q', [0]) + scaled[:-1]))
+        return SCALE, zlib.compress(shuffle(deltas.tobytes()), COMPRESSLEVEL)
+    except (ValueError, OverflowError):
+        # nan or inf, keep the doubles as they are:
+        return 0.0, zlib.compress(shuffle(array('d', column).tobytes()), COMPRESSLEVEL)
+
+
+def decode_column(scale, data):
+    raw = unshuffle(zlib.decompress(data))
+    if scale == 0.0:
+        column = array('d')
+        column.frombytes(raw)
+        return column
+    deltas = array('q')
+    deltas.frombytes(raw)
+    return array('d', map(scale.__rtruediv__, accumulate(deltas)))
+
+
+def write_archive(filename, columns):
+    # Write the columns (column 0 holds the time stamps) to an archive, replacing it safely if it exists:
+    rows = len(columns[0])
+    parts = [HEADER.pack(MAGIC, VERSION, len(columns), rows)]
+    for column in columns:
+        scale, data = encode_column(column)
+        parts.append(COLUMNHEADER.pack(scale, len(data)))
+        parts.append(data)
+    # The temporary file is unique, two processes archiving the same day do not write over each other:
+    handle, temp = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(filename) or ".")
+    try:
+        with os.fdopen(handle, 'wb') as fp:
+            fp.write(b"".join(parts))
+            fp.flush()
+            os.fchmod(fp.fileno(), 0o644)
+            os.fsync(fp.fileno())
+        os.replace(temp, filename)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def read_columns(filename, count=None):
+    # Return the columns of an archive, as arrays of doubles. Only the first count columns are decoded if it is given:
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+    magic, version, num_columns, rows = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s is not a version %d archive" % (filename, VERSION))
+    pos = HEADER.size
+    columns = []
+    for ii in range(num_columns if count is None else min(count, num_columns)):
+        scale, length = COLUMNHEADER.unpack_from(data, pos)
+        pos += COLUMNHEADER.size
+        column = decode_column(scale, data[pos:pos + length])
+        if len(column) != rows:
+            raise ValueError("%s is damaged" % filename)
+        columns.append(column)
+        pos += length
+    return columns
+
+
+def read_archive(filename):
+    # Yield the samples of an archive as tuples, like diskWriter.read_csv_file:
+    for row in zip(*read_columns(filename)):
+        yield row
+
+
+def read_day(csv_file):
+    # Yield the samples of a daily .csv file, or of its archive if the day was archived:
+    if os.path.isfile(csv_file):
+        return diskWriter.read_csv_file(csv_file)
+    archive = archive_filename(csv_file)
+    if os.path.isfile(archive):
+        return read_archive(archive)
+    return iter(())
+
+
+def archive_file(csv_file, keep_csv=False):
+    # Archive one .csv file, and delete it unless keep_csv. Returns the size of the archive.
+    columns = None
+    for row in diskWriter.read_csv_file(csv_file):
+        if columns is None:
+            columns = [array('d') for value in row]
+        for column, value in zip(columns, row):
+            column.append(value)
+    if columns is None:
+        columns = [array('d') for ii in range(mbedWSClient.MAXVALUES)]
+    archive = archive_filename(csv_file)
+    if os.path.isfile(archive):
+        # Samples were added to the day after it was archived (or the .csv file was kept), merge them in:
+        # (rows are compared as bytes, so that nan values match)
+        rows = dict((array('d', row).tobytes(), row) for row in zip(*read_columns(archive)))
+        rows.update((array('d', row).tobytes(), row) for row in zip(*columns))
+        rows = sorted(rows.values(), key=operator.itemgetter(0))
+        if rows:
+            columns = [array('d', values) for values in zip(*rows)]
+    write_archive(archive, columns)
+    # Read it back before the .csv file is deleted:
+    if len(read_columns(archive)[0]) != len(columns[0]):
+        raise ValueError("%s could not be read back" % archive)
+    if not keep_csv:
+        os.remove(csv_file)
+    size = os.path.getsize(archive)
+    debug_msg("Archived %s, %d samples in %d bytes" % (csv_file, len(columns[0]), size))
+    return size
+
+
+def extract_file(archive):
+    # Write an archive back to a .csv file:
+    csv_file = archive[:-len(EXTENSION)] + ".csv"
+    lines = diskWriter.format_rows(read_columns(archive))
+    lines.append("")
+    with open(csv_file, 'w') as fp:
+        fp.write("\n".join(lines))
+    return csv_file
+
+
+def closed_days(directory, before):
+    # Return the .csv files of directory for the days before the date before:
+    files = []
+    if os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            if name.startswith("IoTD") and name.endswith(".csv"):
+                try:
+                    if file_day(name) < before:
+                        files.append(os.path.join(directory, name))
+                except (ValueError, IndexError):
+                    continue
+    return files
+
+
+class Archiver(threading.Thread):
+    def __init__(self, keep_csv=False):
+        threading.Thread.__init__(self, name="Archiver", daemon=True)
+        self.keep_csv = keep_csv
+        self.before = None
+        self.wake = threading.Event()
+        self.stopping = False
+
+    def archive_before(self, day):
+        # Archive the days before day. This can be called from any thread:
+        self.before = day
+        self.wake.set()
+
+    def stop(self):
+        # Stop after the file being archived:
+        self.stopping = True
+        self.wake.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while not self.stopping:
+            self.wake.wait()
+            self.wake.clear()
+            if self.before is None:
+                continue
+            files = closed_days(mbedWSClient.DATADIRECTORY, self.before)
+            csv_bytes = 0
+            archive_bytes = 0
+            for filename in files:
+                if self.stopping:
+                    break
+                try:
+                    size = os.path.getsize(filename)
+                    archive_bytes += archive_file(filename, self.keep_csv)
+                    csv_bytes += size
+                except (OSError, ValueError) as e:
+                    info_msg("Could not archive %s (%s)" % (filename, e))
+            if csv_bytes:
+                info_msg("Archived %d bytes of .csv files in %d bytes" % (csv_bytes, archive_bytes))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive the finished days of the .csv data files")
+    parser.add_argument("files", nargs="*",
+                        help="files to archive (or extract), by default every closed day in %s" %
+                             mbedWSClient.DATADIRECTORY)
+    parser.add_argument("--keep-csv", action="store_true", help="do not delete the .csv files once archived")
+    parser.add_argument("--extract", action="store_true", help="turn archives back into .csv files")
+    args = parser.parse_args()
+    if args.extract:
+        archives = args.files
+        if not archives:
+            archives = [os.path.join(mbedWSClient.DATADIRECTORY, name)
+                        for name in sorted(os.listdir(mbedWSClient.DATADIRECTORY)) if name.endswith(EXTENSION)]
+        for archive in archives:
+            info_msg("Extracted %s" % extract_file(archive))
+        sys.exit(0)
+    files = args.files or closed_days(mbedWSClient.DATADIRECTORY, date.today())
+    for filename in files:
+        size = os.path.getsize(filename)
+        info_msg("%s: %d -> %d bytes" % (filename, size, archive_file(filename, args.keep_csv)))
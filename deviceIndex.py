@@ -0,0 +1,272 @@
+import os
+import json
+import time
+from datetime import date
+import diskWriter
+import dayArchive
+""" Index of the IoTDs known from the data files
+
+FILENAME
+    deviceIndex.py
+
+DESCRIPTION
+    When the server starts, it only knows the IoTDs that send it data. The DeviceIndex is built at start-up from the
+    data directory, without parsing any data file: the names of the daily files give the IoTDs and their first and
+    last days, and the time stamp of the last sample of each IoTD is read from the tail of its newest file.
+    When the server stops, the index is written to a manifest next to the data:
+        <DATADIRECTORY>/manifest.json
+    It holds the last time stamp of each IoTD, with the size and modification time of the file it was read from. On
+    the next start, the tail of a file is only read again if the file changed since, so a restart with a year of data
+    lists one directory and reads one small file.
+    The history itself is only loaded when it is needed. When an IoTD sends its first sample after a restart, recent()
+    reads the last samples from the tail of its newest file in the executor, and they are put in its sample store in
+    front of the samples it sent since (see mbedWSClient.DeviceRegistry.load_recent).
+    The history API uses first_day() to skip the days before the first file of an IoTD.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+MANIFEST = "manifest.json"
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[deviceIndex : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[deviceIndex : INFO] %s' % msg)
+
+
+def parse_filename(name):
+    # Return (IoT ID, YYYYMMDD as an int, extension) of an IoTD###_YYYYMMDD.csv or .iotz file name, or None:
+    base, ext = os.path.splitext(name)
+    if not name.startswith("IoTD") or ext not in (".csv", dayArchive.EXTENSION) or len(base) < 14 or base[-9] != "_":
+        return None
+    try:
+        return int(base[4:-9]), int(base[-8:]), ext
+    except ValueError:
+        return None
+
+
+def stamp_day(stamp):
+    return date(stamp // 10000, stamp // 100 % 100, stamp % 100)
+
+
+def day_stamp(day):
+    return day.year * 10000 + day.month * 100 + day.day
+
+
+class KnownDevice(object):
+    def __init__(self, IoTID):
+        self.ID = IoTID
+        # The first and last days with a file, as YYYYMMDD ints, and the newest file (its name in the directory):
+        self.first_day = None
+        self.last_day = None
+        self.last_file = None
+        # The number of daily files:
+        self.files = 0
+        # The time stamp of the last sample saved, or None if it is not known:
+        self.last_time = None
+        # [size, modification time in ns] of last_file when last_time was read, or None:
+        self.stat = None
+
+    def add_file(self, name, stamp, ext):
+        self.files += 1
+        if self.first_day is None or stamp < self.first_day:
+            self.first_day = stamp
+        # The .csv file of a day is newer than its archive, when both are there:
+        if self.last_day is None or stamp > self.last_day or (stamp == self.last_day and ext == ".csv"):
+            self.last_day = stamp
+            self.last_file = name
+
+
+class DeviceIndex(object):
+    def __init__(self, directory, segments=None):
+        # segments is a segmentStore.SegmentStore to read the segments with, when the data is also saved in them:
+        self.directory = directory
+        self.segments = segments
+        # The KnownDevice of every IoT ID with data files:
+        self.devices = {}
+        self.built = date.today()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __contains__(self, IoTID):
+        return IoTID in self.devices
+
+    def get(self, IoTID):
+        return self.devices.get(IoTID)
+
+    def ids(self):
+        return sorted(self.devices)
+
+    def first_day(self, IoTID):
+        # Return the first day that can hold data of IoTID. An IoTD that was not in the files when the index was
+        # built has none before that day:
+        entry = self.devices.get(IoTID)
+        if entry is None:
+            return self.built
+        if entry.first_day is None:
+            return None
+        return stamp_day(entry.first_day)
+
+    def build(self):
+        # Index the data directory, reading the tail of a file only when the manifest does not match it. Returns self.
+        began = time.monotonic()
+        self.built = date.today()
+        devices = {}
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                parsed = parse_filename(name)
+                if parsed is None:
+                    continue
+                IoTID, stamp, ext = parsed
+                if IoTID not in devices:
+                    devices[IoTID] = KnownDevice(IoTID)
+                devices[IoTID].add_file(name, stamp, ext)
+        manifest = self.read_manifest()
+        tails = 0
+        for IoTID in devices:
+            entry = devices[IoTID]
+            entry.stat = self.file_stat(entry.last_file)
+            known = manifest.get("%d" % IoTID)
+            if known is not None and known.get("file") == entry.last_file and known.get("stat") == entry.stat:
+                entry.last_time = known.get("last_time")
+            else:
+                entry.last_time = self.read_last_time(entry)
+                tails += 1
+        if self.segments is not None:
+            for IoTID in self.segments.devices():
+                if IoTID not in devices:
+                    devices[IoTID] = KnownDevice(IoTID)
+                entry = devices[IoTID]
+                segments = self.segments.segments(IoTID)
+                if segments:
+                    first = day_stamp(date.fromtimestamp(segments[0][0]))
+                    if entry.first_day is None or first < entry.first_day:
+                        entry.first_day = first
+                last_time = self.segments.last_time(IoTID)
+                if last_time is not None and (entry.last_time is None or last_time > entry.last_time):
+                    entry.last_time = last_time
+                tails += 1
+        self.devices = devices
+        info_msg("%d IoTDs indexed in %.3f s, %d file tails read" % (len(devices), time.monotonic() - began, tails))
+        return self
+
+    def file_stat(self, name):
+        if name is None:
+            return None
+        try:
+            st = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def read_manifest(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST), 'r') as fp:
+                manifest = json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            info_msg("Ignoring the manifest (%s)" % e)
+            return {}
+        return manifest if isinstance(manifest, dict) else {}
+
+    def read_last_time(self, entry):
+        # Read the time stamp of the last sample of the newest file of an IoTD:
+        if entry.last_file is None:
+            return None
+        path = os.path.join(self.directory, entry.last_file)
+        try:
+            if path.endswith(".csv"):
+                row = diskWriter.read_last_row(path)
+                return None if row is None else row[0]
+            times = dayArchive.read_columns(path, 1)[0]
+            return times[-1] if len(times) else None
+        except (OSError, ValueError) as e:
+            info_msg("Could not read %s (%s)" % (path, e))
+            return None
+
+    def recent(self, IoTID, count):
+        # Return the last count samples saved for IoTID (fewer if its newest file has fewer) as tuples, in time order:
+        entry = self.devices.get(IoTID)
+        if entry is None or count <= 0:
+            return []
+        try:
+            if self.segments is not None:
+                return self.segments.last_rows(IoTID, count)
+            if entry.last_file is None:
+                return []
+            path = os.path.join(self.directory, entry.last_file)
+            if path.endswith(".csv"):
+                return diskWriter.read_last_rows(path, count)
+            columns = dayArchive.read_columns(path)
+            return list(zip(*[column[-count:] for column in columns]))
+        except (OSError, ValueError) as e:
+            info_msg("Could not read the recent samples of IoTD %d (%s)" % (IoTID, e))
+            return []
+
+    def save(self, registry=None):
+        # Write the manifest. The last time stamps of the IoTDs of registry (a mbedWSClient.DeviceRegistry) are
+        # updated first, this must be called once their data is saved and their files closed.
+        if registry is not None:
+            for IoTID in list(registry.data):
+                store = registry.data[IoTID].store
+                latest = store.latest()
+                if latest is None or store.unsaved_count() > 0:
+                    continue
+                if IoTID not in self.devices:
+                    self.devices[IoTID] = KnownDevice(IoTID)
+                entry = self.devices[IoTID]
+                stamp = day_stamp(registry.day)
+                name = "IoTD%03d_%08d.csv" % (IoTID, stamp)
+                if os.path.isfile(os.path.join(self.directory, name)):
+                    if entry.first_day is None:
+                        entry.first_day = stamp
+                    entry.last_day = stamp
+                    entry.last_file = name
+                entry.last_time = latest[0]
+                entry.stat = self.file_stat(entry.last_file)
+        manifest = {}
+        for IoTID in self.devices:
+            entry = self.devices[IoTID]
+            if entry.last_file is not None and entry.stat is not None:
+                manifest["%d" % IoTID] = {"file": entry.last_file, "stat": entry.stat, "last_time": entry.last_time}
+        path = os.path.join(self.directory, MANIFEST)
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(temp, 'w') as fp:
+                json.dump(manifest, fp)
+            os.replace(temp, path)
+        except OSError as e:
+            info_msg("Could not write the manifest (%s)" % e)
@@ -0,0 +1,424 @@
+import os
+import queue
+import threading
+import time
+from array import array
+from collections import OrderedDict
+""" Background writer for the .csv data files
+
+FILENAME
+    diskWriter.py
+
+DESCRIPTION
+    Saving data to disk used to happen on the Tornado IOLoop, which stalled every connection while a file was opened,
+    written and closed. The DiskWriter is a thread that receives batches of samples through a queue, and does all of
+    the formatting and file I/O away from the IOLoop.
+    All of the batches waiting in the queue are written together: the batches for each file are turned into text
+    in a single join, and written with one call. The files are kept open between batches in a pool of up to
+    MAXOPENFILES files: busy IoTDs keep theirs open, and the least recently written file is closed when the pool is
+    full. A file is also closed when its IoTD starts a new file (a new day) or when the writer stops.
+    If a file cannot be written (for example because another program has it locked), the batch is kept and retried
+    with an increasing delay. Ingestion carries on in the meantime, the batches just wait in the queue.
+    The writer can also append every batch to a segmentStore.SegmentStore, as well as or instead of the .csv files.
+    submit_records() appends fixed-width binary records to a file, which is used for the rollups (rollupStore.py).
+    sync() asks the writer to fsync everything written so far, which the write-ahead log (writeAheadLog.py) uses to
+    know when it can delete its old files.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+# Delays between retries when a file cannot be written, in seconds:
+RETRYDELAY = 0.5
+RETRYDELAYMAX = 30.0
+# Number of retries left once the writer has been asked to stop:
+STOPRETRIES = 3
+# Number of bytes read from the end of a .csv file to find its last row:
+TAILBYTES = 4096
+# Number of .csv files kept open:
+MAXOPENFILES = 256
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[diskWriter : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[diskWriter : INFO] %s' % msg)
+
+
+def format_rows(columns, lines=None):
+    # Turn the columns of a batch (column 0 holds the time stamps) into .csv lines, in the format:
+    # HH:MM:SS.ffffff, value1, value2, ...
+    # The time of day is only formatted once per second, since consecutive samples usually share it.
+    if lines is None:
+        lines = []
+    row_format = "%s.%06d" + ", %f" * (len(columns) - 1)
+    last_second = None
+    prefix = ""
+    for row in zip(*columns):
+        second = int(row[0])
+        usec = int(round((row[0] - second) * 1e6))
+        if usec >= 1000000:
+            second += 1
+            usec -= 1000000
+        if second != last_second:
+            prefix = time.strftime("%H:%M:%S", time.localtime(second))
+            last_second = second
+        lines.append(row_format % ((prefix, usec) + row[1:]))
+    return lines
+
+
+def parse_rows(lines, year, month, day):
+    # The reverse of format_rows: turn .csv lines from the file of the given day into tuples of floats, starting
+    # with the full time stamp. The start of each hour is only converted once, which stays correct across DST changes.
+    hours = {}
+    for line in lines:
+        fields = line.split(",")
+        if len(fields) < 2:
+            continue
+        try:
+            clock = fields[0].strip()
+            hour = int(clock[0:2])
+            if hour not in hours:
+                hours[hour] = time.mktime((year, month, day, hour, 0, 0, 0, 0, -1))
+            t = hours[hour] + int(clock[3:5]) * 60 + float(clock[6:])
+            yield (t,) + tuple(float(field) for field in fields[1:])
+        except ValueError:
+            debug_msg("Skipping a line that could not be parsed: %s" % line)
+
+
+def read_csv_file(filename):
+    # Read a whole IoTD###_YYYYMMDD.csv file, taking the date from the filename:
+    stamp = os.path.basename(filename)[-12:-4]
+    with open(filename, 'r') as fp:
+        for row in parse_rows(fp, int(stamp[0:4]), int(stamp[4:6]), int(stamp[6:8])):
+            yield row
+
+
+def read_last_rows(filename, count):
+    # Return the last count whole rows of a .csv file (or all of them if it has fewer), as read_csv_file would. Only
+    # the tail of the file is read, a block of at least TAILBYTES at a time from the end:
+    stamp = os.path.basename(filename)[-12:-4]
+    with open(filename, 'rb') as fp:
+        pos = fp.seek(0, os.SEEK_END)
+        tail = b""
+        while pos > 0 and tail.count(b"\n") <= count:
+            step = min(pos, max(TAILBYTES, 64 * count))
+            pos -= step
+            fp.seek(pos)
+            tail = fp.read(step) + tail
+    lines = tail.decode(errors="replace").split("\n")
+    if pos > 0:
+        # The first line is probably cut:
+        lines = lines[1:]
+    if not tail.endswith(b"\n"):
+        # The last line was not finished:
+        lines = lines[:-1]
+    rows = list(parse_rows(lines, int(stamp[0:4]), int(stamp[4:6]), int(stamp[6:8])))
+    return rows[-count:] if count > 0 else []
+
+
+def read_last_row(filename):
+    # Return the last whole row of a .csv file, as read_csv_file would, or None if it has none:
+    rows = read_last_rows(filename, 1)
+    return rows[0] if rows else None
+
+
+def latest_csv_files(directory):
+    # Return the newest IoTD###_YYYYMMDD.csv file of each IoT ID in directory, as {IoT ID: filename}:
+    latest = {}
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.startswith("IoTD") and name.endswith(".csv") and len(name) > 17:
+                try:
+                    IoTID = int(name[4:-13])
+                    stamp = int(name[-12:-4])
+                except ValueError:
+                    continue
+                if IoTID not in latest or stamp > latest[IoTID][0]:
+                    latest[IoTID] = (stamp, os.path.join(directory, name))
+    return dict((IoTID, latest[IoTID][1]) for IoTID in latest)
+
+
+def append_to_file(filename, text):
+    # Write some text to the end of a file without keeping the file open:
+    with open(filename, 'a+') as fp:
+        fp.write(text)
+
+
+class DiskWriter(threading.Thread):
+    def __init__(self, csv=True, segments=None, durable=False, max_open=None):
+        # durable files are synced to the disk when they are closed, for the write-ahead log:
+        threading.Thread.__init__(self, name="DiskWriter", daemon=True)
+        self.queue = queue.Queue()
+        self.csv = csv
+        self.segments = segments
+        self.durable = durable
+        self.max_open = MAXOPENFILES if max_open is None else max_open
+        # The open file of each IoTD, as a (filename, file) tuple, least recently used first:
+        self.files = OrderedDict()
+        # Batches that could not be written yet, in the order they were received:
+        self.pending = []
+        self.pending_segments = []
+        self.pending_records = []
+        # Callbacks waiting for everything written so far to be synced to the disk:
+        self.syncs = []
+        self.stopping = False
+        self.retry_delay = RETRYDELAY
+        self.retries_left = STOPRETRIES
+        # Called from the writer thread as listener(seconds, batches) after each round of writes:
+        self.flush_listeners = []
+
+    def submit(self, IoTID, filename, columns):
+        # Queue a batch of samples to be added to filename. columns must not be modified after this call.
+        if len(columns[0]) > 0:
+            self.queue.put((IoTID, filename, columns))
+
+    def submit_records(self, IoTID, filename, records):
+        # Queue an array of binary records to be appended to filename. records must not be modified after this call.
+        if len(records) > 0:
+            self.queue.put((IoTID, filename, records))
+
+    def release(self, IoTID, callback):
+        # Close the files of IoTID (of every IoTD if IoTID is -1) once everything queued before this call is written,
+        # then call callback (from the writer thread):
+        self.queue.put((IoTID, None, callback))
+
+    def sync(self, callback):
+        # Once everything queued before this call is written, fsync the files and call callback (from the writer
+        # thread). callback is not called if the writer gives up on some of the data.
+        self.queue.put((None, None, callback))
+
+    def queue_depth(self):
+        return self.queue.qsize() + len(self.pending) + len(self.pending_segments) + len(self.pending_records)
+
+    def wait(self):
+        # Block until every batch submitted so far has been dealt with:
+        self.queue.join()
+
+    def stop(self):
+        # Write everything that is queued, close the files and exit the thread:
+        self.queue.put(None)
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        info_msg("Disk writer started")
+        while not self.stopping or self.pending or self.pending_segments or self.pending_records:
+            items = []
+            try:
+                retrying = self.pending or self.pending_segments or self.pending_records
+                items.append(self.queue.get(timeout=self.retry_delay if retrying else None))
+            except queue.Empty:
+                pass
+            # Take everything else that is waiting, so it can be written in one go:
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            releases = []
+            for item in items:
+                if item is None:
+                    self.stopping = True
+                elif item[0] is None:
+                    self.syncs.append(item[2])
+                elif item[1] is None:
+                    releases.append(item)
+                elif isinstance(item[2], array):
+                    self.pending_records.append(item)
+                else:
+                    if self.csv:
+                        self.pending.append(item)
+                    if self.segments is not None:
+                        self.pending_segments.append(item)
+            batches = len(self.pending) + len(self.pending_segments)
+            start = time.time()
+            failed = self.write_pending()
+            if self.segments is not None:
+                failed = self.write_pending_segments() or failed
+            failed = self.write_pending_records() or failed
+            if batches:
+                for listener in self.flush_listeners:
+                    listener(time.time() - start, batches)
+            if failed:
+                self.retry_delay = min(self.retry_delay * 2, RETRYDELAYMAX)
+                if self.stopping:
+                    self.retries_left -= 1
+                    if self.retries_left < 0:
+                        info_msg("Giving up on %d batches that could not be written." %
+                                 (len(self.pending) + len(self.pending_segments) + len(self.pending_records)))
+                        self.pending = []
+                        self.pending_segments = []
+                        self.pending_records = []
+                        self.syncs = []
+            else:
+                self.retry_delay = RETRYDELAY
+                if self.syncs:
+                    self.sync_files()
+            for IoTID, filename, callback in releases:
+                if IoTID < 0:
+                    self.close_files()
+                    if self.segments is not None:
+                        self.segments.close()
+                else:
+                    self.close_file(IoTID)
+                    if self.segments is not None:
+                        self.segments.release(IoTID)
+                callback()
+            for ii in range(len(items)):
+                self.queue.task_done()
+        self.close_files()
+        if self.segments is not None:
+            self.segments.close()
+        info_msg("Disk writer stopped")
+
+    def write_pending(self):
+        # Write the pending batches to the .csv files, and return True if some of them failed.
+        # Group the pending batches by file, keeping the order of the batches within each file:
+        by_file = {}
+        for IoTID, filename, columns in self.pending:
+            if filename not in by_file:
+                by_file[filename] = (IoTID, [])
+            by_file[filename][1].append(columns)
+        failed = []
+        for filename in by_file:
+            IoTID, batches = by_file[filename]
+            lines = []
+            for columns in batches:
+                format_rows(columns, lines)
+            lines.append("")
+            try:
+                fp = self.get_file(IoTID, filename)
+                fp.write("\n".join(lines))
+                fp.flush()
+                debug_msg("Wrote %d lines to %s" % (len(lines) - 1, filename))
+            except OSError as e:
+                info_msg("Could not write to %s (%s), will try again." % (filename, e))
+                self.close_file(IoTID)
+                failed.extend((IoTID, filename, columns) for columns in batches)
+        self.pending = failed
+        return len(failed) > 0
+
+    def write_pending_segments(self):
+        # Append the pending batches to the segments, stopping at the first failure to keep the records in order:
+        for ii in range(len(self.pending_segments)):
+            IoTID, filename, columns = self.pending_segments[ii]
+            try:
+                self.segments.append(IoTID, columns)
+            except OSError as e:
+                info_msg("Could not write the segment of IoTD %d (%s), will try again." % (IoTID, e))
+                self.segments.close()
+                self.pending_segments = self.pending_segments[ii:]
+                return True
+        self.pending_segments = []
+        return False
+
+    def write_pending_records(self):
+        # Append the pending binary records, file by file, and return True if some of them failed:
+        by_file = {}
+        for IoTID, filename, records in self.pending_records:
+            if filename not in by_file:
+                by_file[filename] = []
+            by_file[filename].append((IoTID, filename, records))
+        failed = []
+        for filename in by_file:
+            data = b"".join(records.tobytes() for IoTID, name, records in by_file[filename])
+            size = None
+            try:
+                directory = os.path.dirname(filename)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(filename, 'ab') as fp:
+                    size = fp.seek(0, os.SEEK_END)
+                    fp.write(data)
+            except OSError as e:
+                info_msg("Could not write to %s (%s), will try again." % (filename, e))
+                failed.extend(by_file[filename])
+                if size is not None:
+                    # Do not leave part of a record behind:
+                    try:
+                        os.truncate(filename, size)
+                    except OSError:
+                        pass
+        self.pending_records = failed
+        return len(failed) > 0
+
+    def sync_files(self):
+        # Everything has been written, fsync the open files and tell whoever was waiting for it:
+        try:
+            for IoTID in self.files:
+                os.fsync(self.files[IoTID][1].fileno())
+            if self.segments is not None:
+                self.segments.sync()
+        except OSError as e:
+            info_msg("Could not sync the files (%s), will try again." % e)
+            return
+        syncs = self.syncs
+        self.syncs = []
+        for callback in syncs:
+            callback()
+
+    def get_file(self, IoTID, filename):
+        if IoTID in self.files:
+            if self.files[IoTID][0] == filename:
+                self.files.move_to_end(IoTID)
+                return self.files[IoTID][1]
+            # The IoTD has moved on to a new file:
+            self.close_file(IoTID)
+        while len(self.files) >= self.max_open:
+            # Make room by closing the file that was written the longest time ago:
+            self.close_file(next(iter(self.files)))
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fp = open(filename, 'a+')
+        self.files[IoTID] = (filename, fp)
+        return fp
+
+    def close_file(self, IoTID):
+        if IoTID in self.files:
+            filename, fp = self.files.pop(IoTID)
+            if self.durable:
+                try:
+                    # The file may hold data the write-ahead log is waiting on, so make sure it is on the disk:
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                except OSError as e:
+                    info_msg("Could not sync %s (%s)" % (filename, e))
+            try:
+                fp.close()
+            except OSError as e:
+                info_msg("Could not close %s (%s)" % (filename, e))
+
+    def close_files(self):
+        for IoTID in list(self.files):
+            self.close_file(IoTID)
@@ -0,0 +1,224 @@
+""" Downsampling of sample series
+
+FILENAME
+    downsample.py
+
+DESCRIPTION
+    Functions that reduce a series of samples to a target number of points, for charts that cannot show more points
+    than they have pixels. Samples are tuples (or lists) starting with the time stamp, followed by the values.
+
+    Functions:
+        bucket_mean
+            Splits the time range in equal buckets, and returns one row per non-empty bucket holding the mean time
+            stamp and the mean of each value. Works on a stream of samples, with O(1) state.
+        bucket_minmax
+            Same buckets as bucket_mean, but returns the minimum and the maximum of each value, so peaks survive.
+        lttb
+            Largest-Triangle-Three-Buckets: picks the samples that best preserve the visual shape of one value. The
+            samples are given as columns, and the picked indexes are returned.
+        RollingMinMax
+            Keeps the minimum and maximum of one value per time bucket over a rolling span, as the samples arrive,
+            and reduces them to any number of chart columns.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+
+def bucket_index(t, start, stop, points):
+    # Return the bucket of time stamp t, when [start, stop) is split in points buckets:
+    ii = int((t - start) * points / (stop - start))
+    return min(max(ii, 0), points - 1)
+
+
+def bucket_mean(samples, start, stop, points):
+    # samples must be in time order. Yields (mean time, mean value 1, mean value 2, ...) for each non-empty bucket.
+    current = -1
+    count = 0
+    sums = None
+    for sample in samples:
+        ii = bucket_index(sample[0], start, stop, points)
+        if ii != current:
+            if count:
+                yield tuple(total / count for total in sums)
+            current = ii
+            count = 0
+            sums = [0.0] * len(sample)
+        count += 1
+        for jj in range(len(sample)):
+            sums[jj] += sample[jj]
+    if count:
+        yield tuple(total / count for total in sums)
+
+
+def bucket_minmax(samples, start, stop, points):
+    # samples must be in time order. Yields (bucket start time, min value 1, max value 1, min value 2, ...) for each
+    # non-empty bucket.
+    current = -1
+    lows = None
+    highs = None
+    for sample in samples:
+        ii = bucket_index(sample[0], start, stop, points)
+        if ii != current:
+            if lows is not None:
+                yield minmax_row(current, start, stop, points, lows, highs)
+            current = ii
+            lows = list(sample[1:])
+            highs = list(sample[1:])
+        else:
+            for jj in range(1, len(sample)):
+                value = sample[jj]
+                if value < lows[jj - 1]:
+                    lows[jj - 1] = value
+                elif value > highs[jj - 1]:
+                    highs[jj - 1] = value
+    if lows is not None:
+        yield minmax_row(current, start, stop, points, lows, highs)
+
+
+def minmax_row(ii, start, stop, points, lows, highs):
+    row = [start + (stop - start) * ii / points]
+    for low, high in zip(lows, highs):
+        row.append(low)
+        row.append(high)
+    return tuple(row)
+
+
+def lttb(x, y, points):
+    # Return the indexes of the samples picked by Largest-Triangle-Three-Buckets. x and y are sequences of the same
+    # length (lists, arrays or memoryviews), with x in increasing order.
+    n = len(x)
+    if points >= n:
+        return list(range(n))
+    if points < 3:
+        # Not enough points for a triangle, keep the end points:
+        return [0, n - 1][:max(points, 1)]
+    picked = [0]
+    every = (n - 2) / (points - 2)
+    a = 0
+    for ii in range(points - 2):
+        # The bucket we are picking from, and the next one, whose average is the third point of the triangle:
+        lo = int(ii * every) + 1
+        hi = int((ii + 1) * every) + 1
+        next_lo = hi
+        next_hi = min(int((ii + 2) * every) + 1, n)
+        if next_hi <= next_lo:
+            next_lo = n - 1
+            next_hi = n
+        avg_x = 0.0
+        avg_y = 0.0
+        for kk in range(next_lo, next_hi):
+            avg_x += x[kk]
+            avg_y += y[kk]
+        avg_x /= next_hi - next_lo
+        avg_y /= next_hi - next_lo
+        ax = x[a]
+        ay = y[a]
+        best = lo
+        best_area = -1.0
+        for kk in range(lo, hi):
+            area = abs((ax - avg_x) * (y[kk] - ay) - (ax - x[kk]) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                best = kk
+        picked.append(best)
+        a = best
+    picked.append(n - 1)
+    return picked
+
+
+class RollingMinMax(object):
+    """Minimum and maximum of one value over the last span seconds, updated as the samples arrive
+
+    The span is split in a ring of fixed time buckets. add() only touches the bucket of the sample, so the cost per
+    sample is O(1) and the whole history is never walked again. view() reduces the ring to a number of columns (the
+    pixel columns of a chart) in O(buckets) time. Each bucket is replaced by a new tuple in a single list store, so a
+    thread can take a view while another one adds samples.
+    """
+    def __init__(self, span, buckets, index):
+        # index is the position of the value in the samples:
+        self.width = float(span) / buckets
+        self.buckets = buckets
+        self.index = index
+        self.ring = [None] * buckets
+        # The number of the open bucket and its minimum and maximum:
+        self.current = None
+        self.low = None
+        self.high = None
+        # Counts the samples added, to tell whether the view changed:
+        self.version = 0
+
+    def add(self, sample):
+        nn = int(sample[0] // self.width)
+        value = sample[self.index]
+        if nn != self.current:
+            self.current = nn
+            self.low = value
+            self.high = value
+        elif value < self.low:
+            self.low = value
+        elif value > self.high:
+            self.high = value
+        self.ring[nn % self.buckets] = (nn, self.low, self.high)
+        self.version += 1
+
+    def add_earlier(self, sample):
+        # Add a sample older than the open bucket, like the history read after the first new samples:
+        nn = int(sample[0] // self.width)
+        if self.current is None or nn >= self.current:
+            self.add(sample)
+            return
+        value = sample[self.index]
+        entry = self.ring[nn % self.buckets]
+        if entry is None or entry[0] < nn:
+            # The slot is empty, or holds a bucket that is out of the span now:
+            self.ring[nn % self.buckets] = (nn, value, value)
+        elif entry[0] == nn:
+            self.ring[nn % self.buckets] = (nn, min(entry[1], value), max(entry[2], value))
+        else:
+            # The sample itself is out of the span:
+            return
+        self.version += 1
+
+    def view(self, columns):
+        # Return [(column, min, max), ...] for the non-empty columns, when the span up to the newest bucket is split
+        # in columns columns:
+        last = self.current
+        if last is None or columns < 1:
+            return []
+        first = last - self.buckets + 1
+        lows = [None] * columns
+        highs = [None] * columns
+        for entry in list(self.ring):
+            if entry is None or entry[0] < first or entry[0] > last:
+                continue
+            ii = (entry[0] - first) * columns // self.buckets
+            if lows[ii] is None:
+                lows[ii] = entry[1]
+                highs[ii] = entry[2]
+            else:
+                lows[ii] = min(lows[ii], entry[1])
+                highs[ii] = max(highs[ii], entry[2])
+        return [(ii, lows[ii], highs[ii]) for ii in range(columns) if lows[ii] is not None]
@@ -0,0 +1,204 @@
+import time
+from collections import deque
+import tornado.ioloop
+import broadcast
+""" Flow control of the WebSocket connections
+
+FILENAME
+    flowControl.py
+
+DESCRIPTION
+    Keeps one misbehaving IoTD from degrading the server for everybody else.
+    Inbound, every connection has a TokenBucket: it holds up to INBOUNDBURST samples and refills at INBOUNDRATE
+    samples per second. A message that arrives while the bucket is empty is dropped before it is even parsed. A
+    message holding a batch of samples takes all of them, so the bucket may go below zero and the connection then
+    waits for it to refill.
+    Outbound, every connection has a CommandQueue of up to QUEUELIMIT messages. A message is only written once the
+    previous one has been handed to the socket, so a slow or stalled IoTD can never buffer more than QUEUELIMIT
+    messages on the server. When the queue is full, the POLICY decides what happens:
+        drop-oldest     the oldest queued message is dropped
+        drop-newest     the new message is dropped
+        coalesce        a queued message for the same command (the text before the first comma) is replaced by
+                        the new one, otherwise the oldest message is dropped
+    A message can carry a Delivery, that reports what happened to it exactly once, as callback(IoT ID, message,
+    status) on the IOLoop. status is one of DELIVERYSTATUS: "sent" once it is written to the socket, "dropped" or
+    "coalesced" by the queue policy, "closed" if the connection went away, or "timeout" if none of these happened
+    within the timeout.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+# Inbound samples per second and per connection (0 for no limit), and the size of the bucket:
+INBOUNDRATE = 100.0
+INBOUNDBURST = 1000.0
+# Outgoing messages queued per connection, and what to do when the queue is full:
+QUEUELIMIT = 16
+POLICIES = ("drop-oldest", "drop-newest", "coalesce")
+POLICY = "coalesce"
+# Seconds to wait for a delivery when a timeout is not given:
+DELIVERYTIMEOUT = 10.0
+DELIVERYSTATUS = ("sent", "dropped", "coalesced", "closed", "timeout")
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[flowControl : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[flowControl : INFO] %s' % msg)
+
+
+def command_key(message):
+    # Messages for the same command share the text before the first comma, like "1" in "1,0.5":
+    if isinstance(message, str):
+        return message.split(",", 1)[0].strip()
+    return None
+
+
+class TokenBucket(object):
+    def __init__(self, rate=None, burst=None):
+        self.rate = INBOUNDRATE if rate is None else rate
+        self.burst = INBOUNDBURST if burst is None else burst
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def ready(self):
+        # Return True if a message may be taken now:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens > 0
+
+    def take(self, count):
+        # Take count samples, the bucket can go into debt:
+        if self.rate > 0:
+            self.tokens -= count
+
+
+class Delivery(object):
+    def __init__(self, callback, IoTID, message, timeout=None):
+        self.callback = callback
+        self.IoTID = IoTID
+        self.message = message
+        self.status = None
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        self.timeout = self.ioloop.call_later(DELIVERYTIMEOUT if timeout is None else timeout, self.finish,
+                                              "timeout")
+
+    def finish(self, status):
+        # Report the status, only the first one counts:
+        if self.status is not None:
+            return
+        self.status = status
+        self.ioloop.remove_timeout(self.timeout)
+        try:
+            self.callback(self.IoTID, self.message, status)
+        except Exception as e:
+            info_msg("Delivery callback failed: %s" % e)
+
+
+class CommandQueue(object):
+    def __init__(self, handler, limit=None, policy=None, on_drop=None):
+        # on_drop() is called for every message dropped by the policy:
+        self.handler = handler
+        self.limit = QUEUELIMIT if limit is None else limit
+        self.policy = POLICY if policy is None else policy
+        self.on_drop = on_drop
+        # Queued messages, as [key, message, binary, frame, delivery] lists:
+        self.items = deque()
+        # True while a message has been given to the socket but is not written yet:
+        self.writing = False
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, message, binary=False, frame=None, delivery=None):
+        # Queue a message, frame is the message already encoded by broadcast.encode_frame (or None).
+        # Returns False if the message was dropped.
+        key = command_key(message)
+        if self.policy == "coalesce" and key is not None:
+            for item in self.items:
+                if item[0] == key:
+                    if item[4] is not None:
+                        item[4].finish("coalesced")
+                    item[1:] = [message, binary, frame, delivery]
+                    return True
+        if len(self.items) >= self.limit:
+            self.dropped += 1
+            if self.on_drop is not None:
+                self.on_drop()
+            if self.policy == "drop-newest":
+                if delivery is not None:
+                    delivery.finish("dropped")
+                return False
+            oldest = self.items.popleft()
+            if oldest[4] is not None:
+                oldest[4].finish("dropped")
+        self.items.append([key, message, binary, frame, delivery])
+        if not self.writing:
+            self.send_next()
+        return True
+
+    def send_next(self):
+        # Write the queued messages until one cannot be handed to the socket straight away:
+        while self.items:
+            key, message, binary, frame, delivery = self.items.popleft()
+            if frame is None:
+                frame = broadcast.encode_frame(message, binary)
+            future = broadcast.write_frame(self.handler, frame, message, binary)
+            if future is None:
+                if delivery is not None:
+                    delivery.finish("closed")
+                continue
+            if not future.done():
+                self.writing = True
+                tornado.ioloop.IOLoop.current().add_future(future, lambda f, delivery=delivery: self.on_written(
+                    f, delivery))
+                return
+            if delivery is not None:
+                delivery.finish("sent" if future.exception() is None else "closed")
+        self.writing = False
+
+    def on_written(self, future, delivery):
+        if delivery is not None:
+            delivery.finish("sent" if future.exception() is None else "closed")
+        self.writing = False
+        self.send_next()
+
+    def close(self):
+        # The connection is gone, report the messages that will never be sent:
+        while self.items:
+            delivery = self.items.popleft()[4]
+            if delivery is not None:
+                delivery.finish("closed")
@@ -1,5 +1,7 @@
+import bisect
 from tkinter import *
 from tkinter import ttk
+import mbedWSClient
 """ PyWsServer GUI
 
 FILENAME
@@ -7,6 +9,15 @@ FILENAME
 
 DESCRIPTION
     This file builds the Server's GUI, and defines callbacks for all of the buttons.
+    The server thread never draws on the GUI itself. Instead, it puts the latest data from each IoTD in an
+    UpdateQueue, and the GUI drains the queue on a Tk timer, at most REFRESHRATE times per second. Only the latest
+    sample of each IoTD is kept in the queue, so a busy IoTD is drawn once per refresh no matter how fast it sends.
+    The IoT Monitor shows the IoTDs a page at a time, TILECOLUMNS x TILEROWS tiles per page, in the order of their
+    IoT IDs. Only the tiles of one page are ever built. When the page changes, the same tiles are bound to the IoTDs
+    of the new page, and the latest data of every IoTD is kept so that they can be drawn straight away. The data of
+    the IoTDs that are not on the page is never drawn.
+    The queue also keeps the history of each IoTD (a downsample.RollingMinMax, updated by the server thread as the
+    samples arrive), from which each tile draws the range of the recent temperatures in each pixel column.
 
 AUTHOR
     Damien Frost
@@ -39,6 +50,11 @@ INFOMSG = 1
 AllFrames = []
 MAJORLABELFONTNAME = "Calibri"
 MAAJORLABELFONTSIZE = 13
+# Maximum number of times per second the IoT display is redrawn:
+REFRESHRATE = 5.0
+# Tiles per page of the IoT Monitor:
+TILECOLUMNS = 8
+TILEROWS = 2
 
 def debug_msg(msg):
     if DEBUG:
@@ -50,10 +66,49 @@ def info_msg(msg):
         print('[GUI : INFO] %s' % msg)
 
 
+class UpdateQueue(object):
+    """Coalescing queue that hands the latest data of each IoTD from the server thread to the GUI
+
+    The queue is a dictionary keyed by IoT ID. put() and the single pop() in drain() are atomic dictionary operations,
+    so no lock is needed between the server thread and the Tk thread. A newer sample simply replaces an older one
+    that has not been drawn yet.
+    """
+    def __init__(self):
+        self.pending = {}
+        self.histories = {}
+
+    def put(self, IoTID, data, history=None):
+        if history is not None and IoTID not in self.histories:
+            self.histories[IoTID] = history
+        self.pending[IoTID] = data
+
+    def drain(self):
+        # Take a snapshot of the keys, and pop each entry so that data arriving meanwhile is kept for the next refresh:
+        for IoTID in list(self.pending):
+            data = self.pending.pop(IoTID, None)
+            if data is not None:
+                yield IoTID, data
+
+    def __len__(self):
+        return len(self.pending)
+
+
 class WSGui(object):
-    def __init__(self, thread):
+    def __init__(self, thread, refresh_rate=REFRESHRATE):
         self.root = Tk()
         self.tornado_thread = thread
+        # The IoT IDs in order, the latest data of each IoTD, the page shown, its tiles (mbedWSClient.IoTVisual) and
+        # the tile of each IoTD on the page:
+        self.iotIDs = []
+        self.latest = {}
+        self.page = 0
+        self.tiles = []
+        self.visible = {}
+        self.updateQueue = UpdateQueue()
+        self.refreshPeriod = max(1, int(1000.0 / refresh_rate))
+        # The number of IoTDs per delivery status of the last command, filled in from the server thread:
+        self.deliveries = {}
+        self.deliveriesShown = []
         # ****************************
         # *** Window Customization ***
         # ****************************
@@ -108,13 +163,17 @@ class WSGui(object):
         self.iotValueEntry.grid(row=3, column=1, sticky=W)
         # * Address Combo Box *
         self.iotAdrCombo = ttk.Combobox(self.iotFrame)
-        self.iotAdrCombo['values'] = ("All", "0", "1", "2")
+        self.iotAdrCombo['values'] = ("All",)
         self.iotAdrCombo.current(0)
         self.iotAdrCombo.grid(row=4, column=1, sticky=W)
         # * Send button *
         self.iotSendBut = Button(self.iotFrame, text="Send Command to IoTD")
         self.iotSendBut.grid(columnspan=2)
         self.iotSendBut.bind("<Button-1>", self.sendIotCommandCallBack)
+        # * Delivery label *
+        self.iotDeliveryVar = StringVar()
+        self.iotDeliveryLabel = Label(self.iotFrame, textvariable=self.iotDeliveryVar)
+        self.iotDeliveryLabel.grid(columnspan=2)
         # *******************
         # *** IoT Display ***
         # *******************
@@ -123,14 +182,87 @@ class WSGui(object):
         # * Label *
         self.iotFrameLabel = Label(self.iotFrame, text="IoT Monitor", font=(MAJORLABELFONTNAME, MAAJORLABELFONTSIZE))
         self.iotFrameLabel.pack(side=TOP, fill=X)
-        # Create the frame where all of the canvases will be packed against each other on the LEFT:
+        # * Page controls *
+        self.pageFrame = Frame(self.iotFrame)
+        self.pageFrame.pack(side=TOP, fill=X)
+        self.prevPageBut = Button(self.pageFrame, text="< Prev")
+        self.prevPageBut.bind("<Button-1>", self.prevPageCallBack)
+        self.prevPageBut.pack(side=LEFT)
+        self.nextPageBut = Button(self.pageFrame, text="Next >")
+        self.nextPageBut.bind("<Button-1>", self.nextPageCallBack)
+        self.nextPageBut.pack(side=RIGHT)
+        self.pageLabelVar = StringVar()
+        self.pageLabel = Label(self.pageFrame, textvariable=self.pageLabelVar)
+        self.pageLabel.pack(side=LEFT, fill=X, expand=YES)
+        # Create the frame where the tiles of the page are laid out in a grid:
         self.iotCanvasFrame = Frame(self.iotFrame, bd=5)
         self.iotCanvasFrame.pack(side=BOTTOM, fill=BOTH, expand=YES)
-        self.tornado_thread.setFrame(self.iotCanvasFrame)
+        for column in range(TILECOLUMNS):
+            Grid.columnconfigure(self.iotCanvasFrame, column, weight=1, uniform="tile")
+        for row in range(TILEROWS):
+            Grid.rowconfigure(self.iotCanvasFrame, row, weight=1, uniform="tile")
+        self.showPage()
+        self.tornado_thread.setUpdateQueue(self.updateQueue)
 
     def start(self):
+        self.root.after(self.refreshPeriod, self.refreshDisplay)
         self.root.mainloop()
 
+    def refreshDisplay(self):
+        # Keep the latest data of every IoTD that sent something since the last refresh, and draw the visible ones:
+        newIDs = False
+        for IoTID, data in self.updateQueue.drain():
+            if IoTID not in self.latest:
+                bisect.insort(self.iotIDs, IoTID)
+                newIDs = True
+            self.latest[IoTID] = data
+            tile = self.visible.get(IoTID)
+            if tile is not None:
+                tile.updateData(data, self.updateQueue.histories.get(IoTID))
+        if newIDs:
+            # Let the new IoTDs be picked as an address, and lay the page out again as they may have moved it:
+            self.iotAdrCombo['values'] = ("All",) + tuple("%d" % key for key in self.iotIDs)
+            self.showPage()
+        # Show the delivery of the last command:
+        deliveries = sorted(self.deliveries.items())
+        if deliveries != self.deliveriesShown:
+            self.deliveriesShown = deliveries
+            self.iotDeliveryVar.set("Delivery: " + ", ".join("%s %d" % (status, count) for status, count in deliveries))
+        self.root.after(self.refreshPeriod, self.refreshDisplay)
+
+    def showPage(self):
+        # Bind the tiles to the IoTDs of the page, building tiles only when the page has more IoTDs than ever before:
+        pageSize = TILECOLUMNS * TILEROWS
+        pages = max(1, (len(self.iotIDs) + pageSize - 1) // pageSize)
+        self.page = min(max(self.page, 0), pages - 1)
+        pageIDs = self.iotIDs[self.page * pageSize:(self.page + 1) * pageSize]
+        self.visible = {}
+        for nn, IoTID in enumerate(pageIDs):
+            if nn < len(self.tiles):
+                tile = self.tiles[nn]
+                if tile.ID != IoTID:
+                    tile.bind(IoTID, self.latest[IoTID], self.updateQueue.histories.get(IoTID))
+                else:
+                    tile.updateData(self.latest[IoTID], self.updateQueue.histories.get(IoTID))
+                tile.show()
+            else:
+                tile = mbedWSClient.IoTVisual(self.iotCanvasFrame, IoTID, nn // TILECOLUMNS, nn % TILECOLUMNS)
+                tile.updateData(self.latest[IoTID], self.updateQueue.histories.get(IoTID))
+                self.tiles.append(tile)
+            self.visible[IoTID] = tile
+        for tile in self.tiles[len(pageIDs):]:
+            tile.hide()
+        self.pageLabelVar.set("Page %d of %d (%d IoTDs)" % (self.page + 1, pages, len(self.iotIDs)))
+
+    def prevPageCallBack(self, event):
+        if self.page > 0:
+            self.page -= 1
+            self.showPage()
+
+    def nextPageCallBack(self, event):
+        self.page += 1
+        self.showPage()
+
     def startThreadButCallBack(self, event):
         self.tornado_thread.start()
 
@@ -142,8 +274,21 @@ class WSGui(object):
     def sendIotCommandCallBack(self, event):
         # Create the command string:
         cmd_string = "%s,%s" % (self.iotVarCombo.current()+1, Entry.get(self.iotValueEntry))
-        adr = int(self.iotAdrCombo.current()-1)
-        debug_msg("adr: %d" % adr)
-        self.tornado_thread.send_cmd(-1, cmd_string)
+        # The address is "All", the IoT ID of one IoTD, or the name of a group of IoTDs:
+        adr_string = self.iotAdrCombo.get().strip()
+        if adr_string == "All":
+            adr = -1
+        elif adr_string.isdigit():
+            adr = int(adr_string)
+        else:
+            adr = adr_string
+        debug_msg("adr: %s" % adr)
+        deliveries = {}
+        self.deliveries = deliveries
+        self.tornado_thread.send_cmd(adr, cmd_string, lambda IoTID, cmd, status: self.delivered(deliveries, status))
+
+    def delivered(self, deliveries, status):
+        # Called from the server thread, the counts are shown on the next refresh:
+        deliveries[status] = deliveries.get(status, 0) + 1
 
 
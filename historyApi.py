@@ -0,0 +1,249 @@
+import json
+import time
+import bisect
+from array import array
+from datetime import datetime
+from datetime import timedelta
+import tornado.web
+import tornado.ioloop
+import tornado.iostream
+import mbedWSClient
+import dayArchive
+import downsample
+import rollupStore
+""" HTTP API for the history of the IoTDs
+
+FILENAME
+    historyApi.py
+
+DESCRIPTION
+    Adds HTTP endpoints to the server's tornado.web.Application to read back the samples of one IoTD:
+
+        GET /history/<IoT ID>?start=<time>&end=<time>&points=<n>&method=<mean|minmax|lttb>&channel=<n>
+        GET /history/<IoT ID>?start=<time>&end=<time>&tier=<minute|hour>
+
+    start and end are in seconds since the epoch (end defaults to now, start to DEFAULTSPAN seconds before end).
+    Without points (or with points=0) every sample in the range is returned. Otherwise the samples are downsampled
+    to about points rows on the server, see downsample.py:
+        mean    the mean of each value in equal time buckets
+        minmax  the minimum and maximum of each value in equal time buckets
+        lttb    the samples picked by Largest-Triangle-Three-Buckets on the value in column 'channel'
+    The response is JSON: {"iotd": 1, "method": "mean", "columns": ["time", ...], "rows": [[...], ...]}. It is
+    written and flushed in chunks of CHUNKROWS rows, so a long range is never built in memory. lttb is the exception:
+    it needs all of the samples of the range, which are collected in compact arrays first.
+    mean and minmax are computed from the rollups (see rollupStore.py) when the buckets of a tier fit in the requested
+    buckets, so a long range is read without touching the raw samples. With tier, the rollup buckets of the range are
+    returned as they are: the bucket start, the count, then the sum, min, max and last of each column.
+    Samples come from the memory of the server for the most recent data, and from the segment files (when the
+    server saves segments) or the .csv files for older data.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+# Default length of the requested range, in seconds:
+DEFAULTSPAN = 24 * 3600
+CHUNKROWS = 1000
+METHODS = ("mean", "minmax", "lttb")
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[historyApi : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[historyApi : INFO] %s' % msg)
+
+
+def iter_csv(IoTID, start, stop, first_day=None):
+    # Yield the samples of IoTID with start <= time < stop from the daily .csv files (or their archives). The days
+    # before first_day are skipped if it is given:
+    day = datetime.fromtimestamp(start).date()
+    if first_day is not None:
+        day = max(day, first_day)
+    last_day = datetime.fromtimestamp(stop).date()
+    while day <= last_day:
+        for sample in dayArchive.read_day(mbedWSClient.csv_filename(IoTID, day)):
+            if start <= sample[0] < stop:
+                yield sample
+        day += timedelta(days=1)
+
+
+def iter_history(IoTID, start, stop, registry, segments=None):
+    # Return an iterator over the samples of IoTID with start <= time < stop, in time order.
+    # The most recent samples are copied from memory now, on the IOLoop. They start at the oldest sample still in
+    # memory. The files are read as the iterator is consumed, which can be on another thread:
+    memory = None
+    memory_start = stop
+    if IoTID in registry.data:
+        store = registry.data[IoTID].store
+        times = store.columns[0]
+        if len(times) > 0:
+            # A range that ends before the samples in memory is read from the disk only, up to stop:
+            memory_start = min(max(times[0], start), stop)
+            lo = store.first_index() + bisect.bisect_left(times, memory_start)
+            hi = store.first_index() + bisect.bisect_left(times, stop)
+            memory = store.columns_between(lo, hi)
+    first_day = None if registry.index is None else registry.index.first_day(IoTID)
+    return iter_stored(IoTID, start, memory_start, memory, segments, first_day)
+
+
+def iter_stored(IoTID, start, memory_start, memory, segments, first_day):
+    # Yield the samples from the disk with start <= time < memory_start, then the columns copied from memory:
+    if start < memory_start:
+        if segments is not None:
+            view = segments.read_range(IoTID, start, memory_start)
+            for sample in view.rows():
+                yield sample
+            view.release()
+        else:
+            for sample in iter_csv(IoTID, start, memory_start, first_day):
+                yield sample
+    if memory is not None:
+        for sample in zip(*memory):
+            yield sample
+
+
+def encode_rows(rows, count):
+    # Return the next count rows (or fewer at the end) as JSON. This reads the files and reduces the samples, it runs
+    # in the executor:
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(row))
+        if len(chunk) >= count:
+            break
+    return chunk
+
+
+class HistoryHandler(tornado.web.RequestHandler):
+    def initialize(self, registry, segments=None, rollups=None):
+        # registry is the mbedWSClient.DeviceRegistry of the server.
+        # segments is a segmentStore.SegmentStore used for reading, or None to read the .csv files.
+        # rollups is a rollupStore.RollupStore, or None to always read the raw samples:
+        self.registry = registry
+        self.segments = segments
+        self.rollups = rollups
+
+    async def get(self, iot_id):
+        IoTID = int(iot_id)
+        try:
+            stop = float(self.get_argument("end", time.time()))
+            start = float(self.get_argument("start", stop - DEFAULTSPAN))
+            points = int(self.get_argument("points", 0))
+            channel = int(self.get_argument("channel", mbedWSClient.TEMPIDX))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "start, end, points and channel must be numbers")
+        method = self.get_argument("method", "mean")
+        tier = self.get_argument("tier", None)
+        if stop <= start or points < 0 or method not in METHODS or not 0 < channel < mbedWSClient.MAXVALUES:
+            raise tornado.web.HTTPError(400, "Invalid history request")
+        if tier is not None and (self.rollups is None or tier not in dict(rollupStore.TIERS)):
+            raise tornado.web.HTTPError(400, "Invalid rollup tier")
+        debug_msg("History of IoTD %d from %.3f to %.3f, %d points (%s)" % (IoTID, start, stop, points, method))
+        ioloop = tornado.ioloop.IOLoop.current()
+        columns = list(mbedWSClient.COLUMNNAMES)
+        if tier is not None:
+            # The rollup buckets themselves:
+            rows = self.iter_rollups(IoTID, tier, start, stop)
+            columns = ["time", "count"]
+            for name in mbedWSClient.COLUMNNAMES:
+                columns.extend("%s_%s" % (name, stat) for stat in ("sum", "min", "max", "last"))
+            method = tier
+        elif points > 0:
+            # When the buckets of a tier fit in the requested buckets, they are used instead of the raw samples:
+            rollup_tier = None
+            if method != "lttb" and self.rollups is not None:
+                rollup_tier = rollupStore.choose_tier((stop - start) / points)
+                if rollup_tier is not None and not await ioloop.run_in_executor(
+                        None, self.rollups.covers, IoTID, rollup_tier, start):
+                    rollup_tier = None
+            if rollup_tier is not None:
+                rows = self.iter_rollups(IoTID, rollup_tier, start, stop)
+            else:
+                rows = iter_history(IoTID, start, stop, self.registry, self.segments)
+            if method == "mean":
+                if rollup_tier is not None:
+                    rows = rollupStore.bucket_mean(rows, start, stop, points)
+                else:
+                    rows = downsample.bucket_mean(rows, start, stop, points)
+            elif method == "minmax":
+                if rollup_tier is not None:
+                    rows = rollupStore.bucket_minmax(rows, start, stop, points)
+                else:
+                    rows = downsample.bucket_minmax(rows, start, stop, points)
+                columns = [columns[0]]
+                for name in mbedWSClient.COLUMNNAMES[1:]:
+                    columns.extend(("%s_min" % name, "%s_max" % name))
+            else:
+                rows = self.lttb_rows(rows, points, channel)
+        else:
+            rows = iter_history(IoTID, start, stop, self.registry, self.segments)
+            method = "raw"
+        self.set_header("Content-Type", "application/json")
+        self.write('{"iotd": %d, "method": "%s", "columns": %s, "rows": [' % (IoTID, method, json.dumps(columns)))
+        # rows is lazy: the files are read and the samples reduced in the executor, CHUNKROWS rows at a time, so that
+        # the IOLoop goes on serving the IoTDs meanwhile:
+        separator = ""
+        try:
+            while True:
+                chunk = await ioloop.run_in_executor(None, encode_rows, rows, CHUNKROWS)
+                if not chunk:
+                    break
+                self.write(separator + ", ".join(chunk))
+                separator = ", "
+                await self.flush()
+            self.write("]}")
+            await self.flush()
+        except tornado.iostream.StreamClosedError:
+            debug_msg("History client went away")
+
+    def iter_rollups(self, IoTID, tier, start, stop):
+        # Yield the rollup buckets of IoTID in the range, from the files and from the memory of the server. The
+        # buckets in memory are copied now, on the IOLoop, the file is read when the first bucket is asked for:
+        recent = None
+        if IoTID in self.registry.data:
+            recent = self.registry.data[IoTID].rollups.recent(tier)
+        return self.merge_rollups(IoTID, tier, start, stop, recent)
+
+    def merge_rollups(self, IoTID, tier, start, stop, recent):
+        records = self.rollups.read(IoTID, tier, start, stop)
+        if recent is not None:
+            records.extend(recent)
+        for bucket in rollupStore.merge(records, mbedWSClient.MAXVALUES, start, stop):
+            yield bucket
+
+    def lttb_rows(self, samples, points, channel):
+        # LTTB needs the whole range, collect it column by column:
+        columns = [array('d') for ii in range(mbedWSClient.MAXVALUES)]
+        for sample in samples:
+            for column, value in zip(columns, sample):
+                column.append(value)
+        for ii in downsample.lttb(columns[0], columns[channel], points):
+            yield tuple(column[ii] for column in columns)
@@ -0,0 +1,276 @@
+import os
+import json
+import socket
+import struct
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+""" Restart of the server without disconnecting every IoTD at once
+
+FILENAME
+    hotRestart.py
+
+DESCRIPTION
+    To deploy a new version, start it next to the running server:
+        python3 PyWsServer.py --headless --handoff                  the running server, ready to hand over
+        python3 PyWsServer.py --headless --handoff --takeover       the new one
+    The new server connects to the Unix socket of the running one (HANDOFFSOCKET), and the running server passes it
+    its listening sockets (SCM_RIGHTS) and its groups, then stops listening. The port never closes: the new
+    connections go to the new server from then on, and the IoTDs that are connected stay on the old one.
+    The old server then drains: its connections are closed with 1012 (service restart) one at a time, spread over
+    DRAINPERIOD seconds, so that the IoTDs reconnect to the new server a few at a time instead of all at once. It
+    stops once the last one is gone.
+    Only one process writes the files of an IoT ID at a time, as in cluster mode (see clusterServer.py): the new
+    server keeps the data of the IoT IDs the old one knows in memory ('held'), until the old server has saved the
+    data of the IoT ID, closed its files and sent 'released'. The samples it kept in memory for the IoT ID come with
+    it, so the new server does not read them back from the files. When the old server is gone, everything it did not
+    release is released.
+    The messages of the old server, after the listening sockets, are a length-prefixed JSON state, then one JSON
+    object per line:
+        {"op": "released", "id": n, "recent": [[time, ...], ...]}
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+# The server listens for a new server to hand over to when it is set (see the --handoff option of PyWsServer.py):
+ENABLED = False
+HANDOFFSOCKET = "./PyWsServer.handoff"
+# Seconds over which the old server closes its connections after a handoff:
+DRAINPERIOD = 30.0
+# Seconds between the checks for the IoT IDs the old server can release:
+DRAINCHECK = 0.25
+# The close code sent to the IoTDs, 1012 is "service restart":
+RESTARTCODE = 1012
+# The most listening sockets that are handed over:
+MAXSOCKETS = 16
+LENGTH = struct.Struct("<I")
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[hotRestart : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[hotRestart : INFO] %s' % msg)
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("The server closed the handoff socket")
+        data += chunk
+    return data
+
+
+def store_rows(store):
+    # The samples a sampleStore.SampleStore holds in memory, as lists:
+    return [list(row) for row in zip(*store.columns_between(store.first_index(), len(store)))]
+
+
+class Handoff(object):
+    """The running server's side: hands its listening sockets over to a new server, then drains"""
+    def __init__(self, thread, registry, path=None):
+        # thread is the PyWsServer.TornadoThread, its sockets are handed over:
+        self.thread = thread
+        self.registry = registry
+        self.path = HANDOFFSOCKET if path is None else path
+        self.listener = None
+        self.stream = None
+        self.draining = False
+        # The IoT IDs being released, whose files are not closed yet:
+        self.pending = set()
+        self.released = 0
+        self.checker = None
+
+    def start(self):
+        # Listen for a new server on the current IOLoop:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.listener = tornado.netutil.bind_unix_socket(self.path)
+        self.remove_handler = tornado.netutil.add_accept_handler(self.listener, self.on_connection)
+        info_msg("Ready to hand over to a new server on %s" % self.path)
+
+    def stop(self):
+        if self.listener is not None:
+            self.remove_handler()
+            self.listener.close()
+            self.listener = None
+            if not self.draining and os.path.exists(self.path):
+                os.remove(self.path)
+        if self.checker is not None:
+            self.checker.stop()
+            self.checker = None
+
+    def on_connection(self, connection, address):
+        if self.draining:
+            connection.close()
+            return
+        info_msg("Handing over to a new server")
+        # The path now belongs to the new server:
+        self.draining = True
+        self.remove_handler()
+        self.listener.close()
+        self.listener = None
+        os.remove(self.path)
+        state = {"pid": os.getpid(), "ids": sorted(self.registry.data),
+                 "groups": dict((group, sorted(self.registry.groups[group])) for group in self.registry.groups)}
+        try:
+            connection.setblocking(True)
+            socket.send_fds(connection, [b"IOTH"], [sock.fileno() for sock in self.thread.sockets])
+            state = json.dumps(state).encode("utf-8")
+            connection.sendall(LENGTH.pack(len(state)) + state)
+        except OSError as e:
+            info_msg("Handoff failed (%s), still serving" % e)
+            connection.close()
+            self.draining = False
+            self.start()
+            return
+        # The new server listens from now on. Nothing was accepted since the state was taken, this runs on the IOLoop:
+        self.thread.http_server.stop()
+        self.stream = tornado.iostream.IOStream(connection)
+        self.drain()
+
+    def drain(self):
+        # Close the connections one at a time over DRAINPERIOD seconds, and release the IoT IDs as they go:
+        ioloop = tornado.ioloop.IOLoop.current()
+        handlers = list(self.registry.connections)
+        step = DRAINPERIOD / len(handlers) if handlers else 0.0
+        for nn, handler in enumerate(handlers):
+            ioloop.call_later(nn * step, self.close_connection, handler)
+        info_msg("Draining %d connections over %.0f s" % (len(handlers), DRAINPERIOD if handlers else 0.0))
+        self.checker = tornado.ioloop.PeriodicCallback(self.check, DRAINCHECK * 1000)
+        self.checker.start()
+        self.check()
+
+    def close_connection(self, handler):
+        if handler in self.registry.connections:
+            handler.close(RESTARTCODE, "server restart")
+
+    def check(self):
+        # Release the IoT IDs without a connection, and stop once everything is released:
+        for IoTID in list(self.registry.data):
+            if self.registry.lookup(IoTID) is None and IoTID not in self.pending:
+                self.release(IoTID)
+        if not self.registry.data and not self.registry.connections and not self.pending:
+            self.finish()
+
+    def release(self, IoTID):
+        ioloop = tornado.ioloop.IOLoop.current()
+        recent = store_rows(self.registry.data[IoTID].store)
+        self.pending.add(IoTID)
+        # The callback comes from the disk writer thread, once the files are closed:
+        self.registry.release(IoTID, lambda: ioloop.add_callback(self.send_released, IoTID, recent))
+
+    def send_released(self, IoTID, recent):
+        self.pending.discard(IoTID)
+        self.released += 1
+        if self.stream is not None and not self.stream.closed():
+            self.stream.write((json.dumps({"op": "released", "id": IoTID, "recent": recent}) + "\n").encode("utf-8"))
+
+    def finish(self):
+        self.checker.stop()
+        self.checker = None
+        info_msg("Drained, %d IoTDs released to the new server" % self.released)
+        tornado.ioloop.IOLoop.current().spawn_callback(self.close_stream)
+
+    async def close_stream(self):
+        # Wait for the last messages to be written, then stop the server:
+        if self.stream is not None and not self.stream.closed():
+            try:
+                await self.stream.write(b"")
+            except tornado.iostream.StreamClosedError:
+                pass
+            self.stream.close()
+        self.thread.ioloop.stop()
+
+
+class Takeover(object):
+    """The new server's side: takes the listening sockets of the running server"""
+    def __init__(self, path=None):
+        # Connects at once, and blocks until the sockets and the state are received:
+        self.path = HANDOFFSOCKET if path is None else path
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(self.path)
+        msg, fds, flags, address = socket.recv_fds(self.connection, 4, MAXSOCKETS)
+        if msg != b"IOTH" or not fds:
+            raise ConnectionError("No listening socket was handed over")
+        self.sockets = [socket.socket(fileno=fd) for fd in fds]
+        for sock in self.sockets:
+            sock.setblocking(False)
+        length = LENGTH.unpack(recv_exactly(self.connection, LENGTH.size))[0]
+        state = json.loads(recv_exactly(self.connection, length).decode("utf-8"))
+        try:
+            self.pid = int(state["pid"])
+            self.ids = set(int(IoTID) for IoTID in state["ids"])
+            self.groups = dict((str(group), [int(IoTID) for IoTID in state["groups"][group]])
+                               for group in state["groups"])
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError("Bad state from the running server (%s: %s)" % (type(e).__name__, e))
+        self.registry = None
+        info_msg("Took over %d listening sockets from pid %d, %d IoTDs to be released" % (
+            len(self.sockets), self.pid, len(self.ids)))
+
+    def apply(self, registry):
+        # Keep the IoT IDs of the old server in memory until it releases them, and take its groups:
+        self.registry = registry
+        registry.held.update(self.ids)
+        for group in self.groups:
+            for IoTID in self.groups[group]:
+                registry.tag(IoTID, group)
+
+    def start(self):
+        # Read the messages of the old server on the current IOLoop:
+        tornado.ioloop.IOLoop.current().spawn_callback(self.read_loop)
+
+    async def read_loop(self):
+        stream = tornado.iostream.IOStream(self.connection)
+        try:
+            while True:
+                msg = json.loads((await stream.read_until(b"\n")).decode("utf-8"))
+                if msg.get("op") == "released":
+                    self.release(int(msg["id"]), msg.get("recent", ()))
+        except tornado.iostream.StreamClosedError:
+            pass
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            info_msg("Bad message from the old server: %s" % e)
+            stream.close()
+        # The old server is gone, its files are closed:
+        for IoTID in list(self.ids):
+            self.release(IoTID, ())
+        info_msg("The old server (pid %d) has stopped" % self.pid)
+
+    def release(self, IoTID, recent):
+        self.ids.discard(IoTID)
+        if recent and IoTID not in self.registry.data:
+            self.registry.handed[IoTID] = [tuple(row) for row in recent]
+        self.registry.grant(IoTID)
@@ -0,0 +1,168 @@
+import math
+import tornado.ioloop
+import tornado.websocket
+""" Heartbeats and idle timeouts of the WebSocket connections
+
+FILENAME
+    idleReaper.py
+
+DESCRIPTION
+    An IoTD that loses its power or its network does not close its connection, and the server used to keep the
+    half-open connection (and its file descriptor) for ever. The HeartbeatWheel pings every connection that has been
+    quiet for PINGINTERVAL seconds, and closes the connections that have sent nothing, not even a pong, for
+    IDLETIMEOUT seconds. IoTDs that send their data regularly are never pinged.
+    There is no timer per connection. The wheel is a ring of slots, one per TICK seconds, and a single timer moves it
+    on by one slot every tick. Each connection waits in the slot of its next deadline. A message or a pong only
+    records the tick it arrived on, the connection is not moved: when its slot comes round, the deadline is worked
+    out again from the last tick it was heard from, and the connection is put back in a later slot. Each connection
+    costs O(1) per message and per PINGINTERVAL, whatever the number of connections.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+# Seconds of silence before a connection is pinged, and before it is closed (0 to never do it):
+PINGINTERVAL = 20.0
+IDLETIMEOUT = 60.0
+# Seconds per slot of the wheel:
+TICK = 1.0
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[idleReaper : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[idleReaper : INFO] %s' % msg)
+
+
+class HeartbeatWheel(object):
+    def __init__(self, interval=None, timeout=None, tick=None, on_reap=None):
+        # on_reap(handler) is called for each connection closed for being idle:
+        self.interval = PINGINTERVAL if interval is None else interval
+        self.timeout = IDLETIMEOUT if timeout is None else timeout
+        self.tick = TICK if tick is None else tick
+        self.on_reap = on_reap
+        # One slot per tick of the longest wait, and one more so that a connection is never put back in the slot
+        # being run:
+        longest = max(self.interval, self.timeout, self.tick)
+        self.slots = [set() for ii in range(int(math.ceil(longest / self.tick)) + 1)]
+        self.ticks = 0
+        # The tick each connection was last heard from, and the slot it waits in:
+        self.last_seen = {}
+        self.slot_of = {}
+        self.pings = 0
+        self.reaped = 0
+        self.callback = None
+
+    def __len__(self):
+        return len(self.last_seen)
+
+    def enabled(self):
+        return self.interval > 0 or self.timeout > 0
+
+    def start(self):
+        # Start turning the wheel on the current IOLoop:
+        if self.enabled() and self.callback is None:
+            self.callback = tornado.ioloop.PeriodicCallback(self.advance, self.tick * 1000)
+            self.callback.start()
+
+    def stop(self):
+        if self.callback is not None:
+            self.callback.stop()
+            self.callback = None
+
+    def add(self, handler):
+        if not self.enabled():
+            return
+        self.last_seen[handler] = self.ticks
+        self.schedule(handler, self.next_wait(0.0))
+
+    def touch(self, handler):
+        # The connection was heard from, called for every message:
+        if handler in self.last_seen:
+            self.last_seen[handler] = self.ticks
+
+    def remove(self, handler):
+        self.last_seen.pop(handler, None)
+        slot = self.slot_of.pop(handler, None)
+        if slot is not None:
+            self.slots[slot].discard(handler)
+
+    def next_wait(self, idle):
+        # Seconds until something must be done about a connection idle for idle seconds:
+        waits = []
+        if self.timeout > 0:
+            waits.append(self.timeout - idle)
+        if self.interval > 0:
+            # Ping once it is quiet for interval seconds, then every interval seconds:
+            waits.append(self.interval - idle if idle < self.interval else self.interval)
+        return min(waits)
+
+    def schedule(self, handler, wait):
+        ticks = min(max(1, int(math.ceil(wait / self.tick))), len(self.slots) - 1)
+        slot = (self.ticks + ticks) % len(self.slots)
+        self.slots[slot].add(handler)
+        self.slot_of[handler] = slot
+
+    def advance(self):
+        # Move on by one tick, and check the connections whose deadline is now:
+        self.ticks += 1
+        slot = self.ticks % len(self.slots)
+        due = self.slots[slot]
+        self.slots[slot] = set()
+        for handler in due:
+            self.slot_of.pop(handler, None)
+            if handler in self.last_seen:
+                self.check(handler)
+
+    def check(self, handler):
+        idle = (self.ticks - self.last_seen[handler]) * self.tick
+        if self.timeout > 0 and idle >= self.timeout:
+            self.reap(handler)
+            return
+        if self.interval > 0 and idle >= self.interval:
+            try:
+                handler.ping(b"")
+                self.pings += 1
+            except tornado.websocket.WebSocketClosedError:
+                # It is closing already, on_close will remove it:
+                self.remove(handler)
+                return
+        self.schedule(handler, self.next_wait(idle))
+
+    def reap(self, handler):
+        debug_msg("Closing a connection idle for %.0f s" % ((self.ticks - self.last_seen[handler]) * self.tick))
+        self.remove(handler)
+        self.reaped += 1
+        if self.on_reap is not None:
+            self.on_reap(handler)
+        # Going away. A half-open connection never answers the close, Tornado aborts it after its close timeout:
+        handler.close(1001, "idle")
@@ -0,0 +1,218 @@
+import json
+import tornado.ioloop
+import tornado.websocket
+import broadcast
+import mbedWSClient
+""" Live stream of the samples for dashboards
+
+FILENAME
+    liveStream.py
+
+DESCRIPTION
+    Browser dashboards can watch the samples as they arrive, on the WebSocket route /live of the server:
+        ws://<server>:4444/live?ids=1,2     the samples of IoTDs 1 and 2
+        ws://<server>:4444/live             the samples of every IoTD
+    The subscriptions can be changed on the way by sending {"subscribe": [3]}, {"unsubscribe": [1]}, or "all" in place
+    of a list. A subscriber first gets {"columns": [...]}, then the latest sample of each IoTD it subscribed to, and
+    then a message every BATCHINTERVAL seconds, holding the latest sample of each IoTD that sent something:
+        {"samples": {"1": [time, send_counter, temperature], "2": [...]}}
+    The ingest path only keeps the latest sample of each watched IoTD in a dictionary. The LiveHub turns each sample
+    into JSON once per batch, and the message for the subscribers of every IoTD is built and framed once for all of
+    them. A subscriber is only written to once its previous message was handed to the socket. Until then, its
+    backlog keeps only the latest sample of each IoTD, so a slow viewer sees fewer updates, holds at most one sample
+    per IoTD, and never holds up the IoTDs or the other viewers.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+# Seconds between the messages to the subscribers:
+BATCHINTERVAL = 0.1
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[liveStream : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[liveStream : INFO] %s' % msg)
+
+
+def samples_message(fragments):
+    # Join the JSON fragments of a batch, {IoT ID: '"<IoT ID>": [...]'}, into a message:
+    return '{"samples": {%s}}' % ", ".join(fragments[IoTID] for IoTID in sorted(fragments))
+
+
+def parse_ids(value):
+    # "all" (or None) for every IoTD, else a list of IoT IDs, as a set:
+    if value is None or value == "all":
+        return None
+    if isinstance(value, str):
+        value = [part for part in value.split(",") if part.strip()]
+    return set(int(IoTID) for IoTID in value)
+
+
+class LiveHub(object):
+    def __init__(self, registry):
+        self.registry = registry
+        # The subscribers of every IoTD, and those of each IoT ID:
+        self.everything = set()
+        self.by_id = {}
+        # The latest sample of each watched IoTD since the last batch, as (time stamp, value 1, ...):
+        self.pending = {}
+        self.batches = 0
+        self.callback = None
+        registry.listeners.append(self.on_sample)
+
+    def start(self):
+        # Publish the batches on the current IOLoop:
+        if self.callback is None:
+            self.callback = tornado.ioloop.PeriodicCallback(self.publish, BATCHINTERVAL * 1000)
+            self.callback.start()
+
+    def stop(self):
+        if self.callback is not None:
+            self.callback.stop()
+            self.callback = None
+        if self.on_sample in self.registry.listeners:
+            self.registry.listeners.remove(self.on_sample)
+
+    def on_sample(self, IoTID, timestamp, sample):
+        # Called by the registry for every sample, this is all the live stream costs the ingest path:
+        if self.everything or IoTID in self.by_id:
+            self.pending[IoTID] = (timestamp,) + tuple(sample[1:mbedWSClient.MAXVALUES])
+
+    def subscribe(self, subscriber, ids):
+        # ids is a set of IoT IDs, or None for all of them. The subscriber gets their latest samples straight away:
+        if ids is None:
+            self.everything.add(subscriber)
+        else:
+            for IoTID in ids:
+                self.by_id.setdefault(IoTID, set()).add(subscriber)
+        latest = {}
+        for IoTID in (list(self.registry.data) if ids is None else ids):
+            iot_data = self.registry.data.get(IoTID)
+            if iot_data is not None and iot_data.store.latest() is not None:
+                latest[IoTID] = '"%d": %s' % (IoTID, json.dumps(iot_data.store.latest()))
+        if latest:
+            subscriber.offer(latest)
+
+    def unsubscribe(self, subscriber, ids):
+        if ids is None:
+            self.everything.discard(subscriber)
+            ids = list(self.by_id)
+        for IoTID in ids:
+            subscribers = self.by_id.get(IoTID)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.by_id[IoTID]
+
+    def remove(self, subscriber):
+        self.unsubscribe(subscriber, None)
+
+    def publish(self):
+        # Send the latest samples to the subscribers. Each sample is turned into JSON once:
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = {}
+        self.batches += 1
+        fragments = dict((IoTID, '"%d": %s' % (IoTID, json.dumps(pending[IoTID]))) for IoTID in pending)
+        if self.everything:
+            # One message, framed once, for all of the subscribers of every IoTD:
+            message = samples_message(fragments)
+            frame = broadcast.encode_frame(message)
+            for subscriber in list(self.everything):
+                subscriber.offer(fragments, message, frame)
+        targets = {}
+        for IoTID in fragments:
+            for subscriber in self.by_id.get(IoTID, ()):
+                if subscriber not in self.everything:
+                    targets.setdefault(subscriber, {})[IoTID] = fragments[IoTID]
+        for subscriber in targets:
+            subscriber.offer(targets[subscriber])
+
+
+class LiveHandler(tornado.websocket.WebSocketHandler):
+    def initialize(self, hub):
+        self.hub = hub
+        # True while a message is being written, and the latest samples waiting for it, by IoT ID:
+        self.writing = False
+        self.backlog = {}
+        self.coalesced = 0
+
+    def check_origin(self, origin):
+        # Dashboards are served from anywhere:
+        return True
+
+    def open(self):
+        try:
+            ids = parse_ids(self.get_argument("ids", None))
+        except ValueError:
+            self.close(1003, "ids must be a list of IoT IDs")
+            return
+        debug_msg("New subscriber from %s" % self.request.remote_ip)
+        self.write_message(json.dumps({"columns": list(mbedWSClient.COLUMNNAMES)}))
+        self.hub.subscribe(self, ids)
+
+    def on_message(self, message):
+        try:
+            request = json.loads(message)
+            if "subscribe" in request:
+                self.hub.subscribe(self, parse_ids(request["subscribe"]))
+            if "unsubscribe" in request:
+                self.hub.unsubscribe(self, parse_ids(request["unsubscribe"]))
+        except (ValueError, TypeError, AttributeError) as e:
+            debug_msg("Ignoring a message from a subscriber: %s" % e)
+
+    def on_close(self):
+        self.hub.remove(self)
+
+    def offer(self, fragments, message=None, frame=None):
+        # Send the samples of a batch, or keep the latest of each IoTD while the previous message is written:
+        if self.writing:
+            self.coalesced += len(self.backlog) + len(fragments) - len(set(self.backlog).union(fragments))
+            self.backlog.update(fragments)
+            return
+        if message is None:
+            message = samples_message(fragments)
+            frame = broadcast.encode_frame(message)
+        future = broadcast.write_frame(self, frame, message)
+        if future is not None and not future.done():
+            self.writing = True
+            tornado.ioloop.IOLoop.current().add_future(future, self.on_written)
+
+    def on_written(self, future):
+        self.writing = False
+        if future.exception() is None and self.backlog:
+            backlog = self.backlog
+            self.backlog = {}
+            self.offer(backlog)
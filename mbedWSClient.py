@@ -1,10 +1,16 @@
 import time
 import os
+import bisect
 import ResizingCanvas
+import sampleStore
+import diskWriter
+import messageParser
+import rollupStore
+import downsample
+import tornado.ioloop
 from tkinter import *
-from tkinter import messagebox
 from datetime import date
-from datetime import datetime
+from datetime import timedelta
 """ mbed Client classes
 
 FILENAME
@@ -15,20 +21,33 @@ DESCRIPTION
     to help send commands to them. Individual microcontrolelrs are identified by their IoT ID, NOT IP address.
 
     Classes:
+        DeviceRegistry
+            The server has one DeviceRegistry. It holds the MbedData of every IoT ID, the MbedWSClient of every open
+            connection, and which connection each IoT ID is currently using, so that a command can be sent to an IoT
+            ID with a single lookup. Connections are added when they open and removed when they close. IoT IDs can
+            also be put in named groups, to send a command to all of the IoTDs of a group.
+        RolloverScheduler
+            Keeps the day of the data in the DeviceRegistry, with a timer on the IOLoop that fires at midnight and
+            saves the data of the day that ended, for all of the IoTDs together. The date is never looked up for
+            each message.
         MbedWSClient
             Each _connection_ has an instance of the MbedWSClient created. This class manages the connection between
             the server and the microcontroller. If a microcontroller loses its connection and reconnects, a new
-            MbedWSClient instance is created for the new connection.
+            MbedWSClient instance is created for the new connection, and the IoT ID is bound to it.
         MbedData
             Each _IoT ID_ has an instance of the MbedData class created. All of the instances are saved in the
-            clientDict{} of the MbedWSClient class. When a new ID connects to the server, a new MbedData instance is
+            data{} of the DeviceRegistry. When a new ID connects to the server, a new MbedData instance is
             created. Therefore, if a microcontroller loses its connection and reconnects, its data is saved in the same
-            instance of MbedData that was created during its _first_ connection to the server.
+            instance of MbedData that was created during its _first_ connection to the server. The data is kept in a
+            sampleStore.SampleStore, which releases the samples that have been saved to disk once they fall outside of
+            the RETENTION window. The MbedData also keeps the rollups of the IoTD up to date (see rollupStore.py),
+            they are saved with the samples. When an IoTD known from the files of a previous run sends its first
+            sample, its last saved samples are read back into the store, off the IOLoop (see deviceIndex.py).
         IoTVisual
-            Each _IoT ID_ has an instance of hte IoTVisual class created. All instances of this class are saved in the
-            frameDict{} of the MbedWSClient class. Like the MbedData class, a new IoTVisual class is created for each
-            new IoT ID that connects to the server. This class is responsible for the GUI objects associated with each
-            IoT devices, and updating the GUI everytime new data is received.
+            A tile of the IoT Monitor of the WSGui, showing the latest data of one IoTD. The WSGui only builds the
+            tiles of the page that is shown, and binds them to the IoTDs of that page (see gui.py), so a tile can
+            show a different IoTD after the page changes. The canvas items of a tile are created once, and only moved
+            or changed when the value shown or the size of the canvas changes.
 
 AUTHOR
     Damien Frost
@@ -62,11 +81,20 @@ INFOMSG = 1
 SENDCOUNTERIDX = 1
 TEMPIDX = 2
 MAXVALUES = 3
+# Names of the values, as used by the history API:
+COLUMNNAMES = ("time", "send_counter", "temperature")
 
 TMAX = 125.0
 TMIN = -40.0
 SAVECOUNTER = 100
 DATADIRECTORY = "./Data/"
+# Number of saved samples kept in memory for each IoT ID:
+RETENTION = sampleStore.RETENTION
+# Seconds of temperature history drawn in each tile of the GUI, and the number of buckets it is kept in:
+HISTORYSPAN = 600.0
+HISTORYBUCKETS = 600
+# Where the data is saved: "csv" files, binary "segments" (see segmentStore.py), or "both":
+STORAGE = "csv"
 
 
 
@@ -80,117 +108,292 @@ def info_msg(msg):
         print('[mbedWSClient : INFO] %s' % msg)
 
 
-class MbedWSClient(object):
-    frameDict = {}
-    clientDict = {}
-    lastSaveDict = {}
-    lastSaveDate = {}
+def csv_filename(IoTID, day):
+    # The .csv file that holds the data of IoTID for a day (a datetime.date):
+    return "%sIoTD%03d_%d%02d%02d.csv" % (DATADIRECTORY, IoTID, day.year, day.month, day.day)
+
+
+class DeviceRegistry(object):
+    def __init__(self):
+        # The MbedData of every IoT ID ever seen, kept across reconnections:
+        self.data = {}
+        # The MbedWSClient of every open connection, keyed by its WSHandler:
+        self.connections = {}
+        # The MbedWSClient an IoT ID last sent data on:
+        self.by_id = {}
+        # The diskWriter.DiskWriter thread used to save the data, set by the server:
+        self.writer = None
+        # Named groups (tags) of IoT IDs, used to send commands to a subset of the IoTDs:
+        self.groups = {}
+        # IoT IDs whose data must not be saved yet, because another server process may still be writing their files:
+        self.held = set()
+        # Called with the IoT ID every time an IoT ID is bound to a connection:
+        self.bind_callback = None
+        # Called as listener(IoT ID, time stamp, sample) for every sample added:
+        self.listeners = []
+        # A serverMetrics.StageTimer when the stages of the incoming data are timed, else None:
+        self.stage_timer = None
+        # The writeAheadLog.WriteAheadLog every sample is logged to, set by the server, or None:
+        self.wal = None
+        # The day of the data that has not been saved yet, moved on by the RolloverScheduler:
+        self.day = date.today()
+        # The deviceIndex.DeviceIndex of the IoTDs known from the data files, set by the server, or None:
+        self.index = None
+        # The samples kept in memory by the server this one took over from, by IoT ID (see hotRestart.py):
+        self.handed = {}
+
+    def __len__(self):
+        return len(self.connections)
+
+    def add_connection(self, wshandle):
+        client = MbedWSClient(wshandle, self)
+        self.connections[wshandle] = client
+        return client
+
+    def remove_connection(self, wshandle):
+        # Forget a closed connection, and the IoT IDs that were bound to it:
+        client = self.connections.pop(wshandle, None)
+        if client is not None:
+            for IoTID in client.ids:
+                if self.by_id.get(IoTID) is client:
+                    del self.by_id[IoTID]
+        return client
+
+    def bind(self, IoTID, client):
+        # IoTID sends its data on client's connection:
+        previous = self.by_id.get(IoTID)
+        if previous is not client:
+            if previous is not None:
+                previous.ids.discard(IoTID)
+            self.by_id[IoTID] = client
+            client.ids.add(IoTID)
+            if self.bind_callback is not None:
+                self.bind_callback(IoTID)
+
+    def load_recent(self, IoTID, iot_data):
+        # Give iot_data, the new MbedData of IoTID, the samples saved by a previous run that fit in the retention
+        # window. The samples the server this one took over from kept in memory are added at once. The files are read
+        # in the executor instead of on the IOLoop, the IoTD only has its new samples until then:
+        if IoTID in self.handed:
+            rows = self.handed.pop(IoTID)
+            iot_data.add_recent(rows[max(0, len(rows) - RETENTION):])
+        elif self.index is not None and IoTID in self.index:
+            ioloop = tornado.ioloop.IOLoop.current()
+
+            def loaded(future):
+                # The IoT ID may have been released in the meantime:
+                if self.data.get(IoTID) is iot_data:
+                    iot_data.add_recent(future.result())
+
+            ioloop.add_future(ioloop.run_in_executor(None, self.index.recent, IoTID, RETENTION), loaded)
+
+    def lookup(self, IoTID):
+        # Return the MbedWSClient of an IoT ID, or None if it is not connected:
+        return self.by_id.get(IoTID)
+
+    def clients(self):
+        return list(self.connections.values())
+
+    def tag(self, IoTID, group):
+        # Add an IoT ID to a group. Groups are kept when the IoTD disconnects:
+        if group not in self.groups:
+            self.groups[group] = set()
+        self.groups[group].add(IoTID)
+
+    def untag(self, IoTID, group):
+        if group in self.groups:
+            self.groups[group].discard(IoTID)
+            if not self.groups[group]:
+                del self.groups[group]
+
+    def tags(self, IoTID):
+        return sorted(group for group in self.groups if IoTID in self.groups[group])
+
+    def group_clients(self, group):
+        # Return the connected MbedWSClients of the IoT IDs in a group, once each:
+        clients = {}
+        for IoTID in self.groups.get(group, ()):
+            client = self.by_id.get(IoTID)
+            if client is not None:
+                clients[client] = True
+        return list(clients)
+
+    def grant(self, IoTID):
+        # This process may now save the data of IoTID:
+        self.held.discard(IoTID)
+        if IoTID in self.data and self.data[IoTID].store.unsaved_count() > SAVECOUNTER:
+            self.save_iotd_to_disk(IoTID)
+
+    def release(self, IoTID, callback):
+        # Save the data of IoTID and forget it, so another process can take over its files. callback is called from
+        # the disk writer thread once the files are closed.
+        if IoTID in self.data:
+            self.data[IoTID].rollups.close()
+            self.save_iotd_to_disk(IoTID, force=True)
+            del self.data[IoTID]
+        self.held.discard(IoTID)
+        if self.writer is not None:
+            self.writer.release(IoTID, callback)
+        else:
+            callback()
 
-    def __init__(self, wshandle):
+    def close_rollups(self):
+        # Close the open rollup buckets of every IoT ID, so that they are saved with the rest of the data:
+        for IoTID in self.data:
+            self.data[IoTID].rollups.close()
+
+    def save_data_to_disk(self, iot_to_save, force=False):
+        # if iot_to_save = -1, save them all, else just iot_to_save:
+        if iot_to_save < 0:
+            # Save them all!
+            for IoTID in self.data:
+                self.save_iotd_to_disk(IoTID, force)
+        elif iot_to_save in self.data:
+            # save one iot:
+            self.save_iotd_to_disk(iot_to_save, force)
+
+    def rollover(self, day):
+        # The day has changed: save the data of the day that ended to its files, then move on to the new day.
+        midnight = time.mktime(day.timetuple())
+        info_msg("New day (%s), saving the data of %s" % (day, self.day))
+        for IoTID in self.data:
+            self.save_iotd_to_disk(IoTID, before=midnight)
+        self.day = day
+
+    def save_iotd_to_disk(self, IoTID, force=False, before=None):
+        # Save the data of IoTID that has not been saved yet, only up to the time stamp before if it is given.
+        if IoTID in self.held and not force:
+            # Keep the data in memory until this process is allowed to write the files of IoTID:
+            return
+        # Create the filename:
+        filename = csv_filename(IoTID, self.day)
+        # Take the data that has not been saved yet, this releases it from the store:
+        store = self.data[IoTID].store
+        save_upto = len(store)
+        if before is not None:
+            save_upto = store.first_index() + bisect.bisect_left(store.columns[0], before)
+        data_array = store.columns_between(store.saved, save_upto)
+        store.mark_saved(save_upto)
+        rollups = self.data[IoTID].rollups.take_pending()
+        if self.writer is not None:
+            # The disk writer thread formats and writes the data:
+            self.writer.submit(IoTID, filename, data_array)
+            for tier in rollups:
+                self.writer.submit_records(IoTID, rollupStore.rollup_filename(DATADIRECTORY, tier, IoTID),
+                                           rollups[tier])
+            return
+        if len(data_array[0]) > 0:
+            # No writer thread, write all of the data in one go:
+            if os.path.isdir(DATADIRECTORY) == FALSE:
+                os.mkdir(DATADIRECTORY)
+            lines = diskWriter.format_rows(data_array)
+            lines.append("")
+            diskWriter.append_to_file(filename, "\n".join(lines))
+        for tier in rollups:
+            if len(rollups[tier]) > 0:
+                rollup_file = rollupStore.rollup_filename(DATADIRECTORY, tier, IoTID)
+                os.makedirs(os.path.dirname(rollup_file), exist_ok=True)
+                with open(rollup_file, 'ab') as fp:
+                    fp.write(rollups[tier].tobytes())
+
+
+class RolloverScheduler(object):
+    def __init__(self, registry):
+        self.registry = registry
+        self.ioloop = None
+        self.timeout = None
+        # Called with the new day after every rollover:
+        self.listeners = []
+
+    def start(self, ioloop):
+        # Catch up if the day changed while the server was stopped, then wait for the next midnight:
+        self.ioloop = ioloop
+        self.check()
+
+    def stop(self):
+        if self.timeout is not None:
+            self.ioloop.remove_timeout(self.timeout)
+            self.timeout = None
+
+    def check(self):
+        self.timeout = None
+        today = date.today()
+        if today != self.registry.day:
+            self.registry.rollover(today)
+            for listener in self.listeners:
+                listener(today)
+        # Wait until the next midnight. If the timer fires a little early, check() waits again:
+        midnight = time.mktime((today + timedelta(days=1)).timetuple())
+        self.timeout = self.ioloop.call_later(max(midnight - time.time(), 0.0) + 0.001, self.check)
+
+
+class MbedWSClient(object):
+    def __init__(self, wshandle, registry):
         self.handle = wshandle
+        self.registry = registry
+        # The IoT IDs that send their data on this connection:
+        self.ids = set()
+        self.ID = None
         info_msg("Client added to list")
 
-    def append_data(self, data_string, iot_frame):
-        info_msg("Received: %s" % data_string)
-        # Parse the data:
-        data = data_string.split(",")
+    def append_data(self, data_string, update_queue=None):
+        # Parse a text message, and add the samples it holds:
+        for sample in messageParser.parse_text(data_string):
+            self.append_sample(sample, update_queue)
+
+    def append_sample(self, data, update_queue=None):
+        # data is a messageParser.Sample
+        debug_msg("Received: %s" % (data,))
+        timer = self.registry.stage_timer
+        if timer is not None:
+            lap = timer.start()
         # Check to see if the IoTD is in the dictionary:
-        IoTID = int(data[0])
-        if IoTID in self.clientDict:
-            # Check to see if the date has changed:
-            # Get the current date:
-            current_date = "%d%02d%02d" % (date.today().year, date.today().month, date.today().day)
-            if current_date != self.lastSaveDate[IoTID]:
-                # Save the data before we append the next day's data:
-                self.save_data_to_disk(IoTID)
-                self.lastSaveDate[IoTID] = current_date
+        IoTID = data.iot_id
+        if IoTID in self.registry.data:
+            iot_data = self.registry.data[IoTID]
             # Add data, and update the handle every time in case it changes:
-            self.clientDict[IoTID].append_data(data, self.handle)
+            iot_data.append_data(data, self.handle)
             debug_msg("New data for Client (%d) received" % IoTID)
         else:
             # create a new entry:
             debug_msg("New Client (%d) data received, adding to dictionary" % IoTID)
-            self.clientDict[IoTID] = MbedData(data, self.handle)
-            # Add a new canvas to the gui:
-            self.frameDict[IoTID] = IoTVisual(iot_frame, IoTID)
-            # Add a last save number:
-            self.lastSaveDict[IoTID] = 0
-            # Add the last save date:
-            self.lastSaveDate[IoTID] = "%d%02d%02d" % (date.today().year, date.today().month, date.today().day)
-        # Update the GUI:
-        self.frameDict[IoTID].updateData(data)
+            iot_data = MbedData(data, self.handle)
+            self.registry.data[IoTID] = iot_data
+            self.registry.load_recent(IoTID, iot_data)
+        if self.registry.wal is not None:
+            # Log the sample, so it survives a crash before it is saved:
+            self.registry.wal.append(IoTID, iot_data.store.latest())
+        if IoTID not in self.ids:
+            # The IoTD is new, or it has reconnected:
+            self.registry.bind(IoTID, self)
+            self.ID = IoTID
+        if timer is not None:
+            lap = timer.lap("store", lap)
+        # Hand the latest data to the GUI, it will be drawn on the next refresh:
+        if update_queue is not None:
+            update_queue.put(IoTID, data, iot_data.history)
+        if timer is not None:
+            lap = timer.lap("gui", lap)
+        if self.registry.listeners:
+            timestamp = iot_data.store.columns[0][-1]
+            for listener in self.registry.listeners:
+                listener(IoTID, timestamp, data)
+        if timer is not None:
+            lap = timer.start()
         # Check to see if we need to save the data:
-        if (len(self.clientDict[IoTID].data_array[0]) - self.lastSaveDict[IoTID]) > SAVECOUNTER:
-            self.save_data_to_disk(IoTID)
+        if iot_data.store.unsaved_count() > SAVECOUNTER:
+            self.registry.save_data_to_disk(IoTID)
+        if timer is not None:
+            timer.lap("flush", lap)
 
     def save_data_to_disk(self, iot_to_save):
-        # if iot_to_save = -1, save them all, else just iot_to_save:
-        if iot_to_save < 0:
-            # Save them all!
-            for key in self.clientDict:
-                IoTID = self.clientDict[key].ID
-                # Check to see if the data directory exists:
-                if os.path.isdir(DATADIRECTORY) == FALSE:
-                    # Create the data directory:
-                    os.mkdir(DATADIRECTORY)
-                # Create the filename:
-                filename = "%sIoTD%03d_%d%02d%02d.csv" % (DATADIRECTORY, IoTID, date.today().year, date.today().month,
-                                                          date.today().day)
-                # Open the file and write to it:
-                save_file = True
-                while save_file:
-                    try:
-                        fp = open(filename, 'a+')
-                        save_file = False
-                    except PermissionError:
-                        messagebox.showinfo("Permission Error",
-                                            "Permission denied when trying to save regular data. Press OK to try again.")
-                save_string = ""
-                for ii in range(self.lastSaveDict[IoTID], len(self.clientDict[IoTID].data_array[0])):
-                    # Create the string to write
-                    save_string = "%s%s" % (save_string, datetime.fromtimestamp(
-                        self.clientDict[IoTID].data_array[0][ii]).strftime("%H:%M:%S.%f"))
-                    for jj in range(1, MAXVALUES):
-                        save_string = "%s, %f" % (save_string, self.clientDict[IoTID].data_array[jj][ii])
-                    save_string = "%s\n" % save_string
-                # Write all of the data in one go:
-                fp.write(save_string)
-                # Close the file:
-                fp.close()
-                # Update the counters:
-                self.lastSaveDict[IoTID] = len(self.clientDict[IoTID].data_array[0])
-        else:
-            # save one iot:
-            IoTID = iot_to_save
-            # Check to see if the data directory exists:
-            if os.path.isdir(DATADIRECTORY) == FALSE:
-                # Create the data directory:
-                os.mkdir(DATADIRECTORY)
-            # Create the filename:
-            filename = "%sIoTD%03d_%d%02d%02d.csv" % (DATADIRECTORY, IoTID, date.today().year, date.today().month,
-                                                      date.today().day)
-            # Open the file and write to it:
-            fp = open(filename, 'a+')
-            save_string = ""
-            for ii in range(self.lastSaveDict[IoTID], len(self.clientDict[IoTID].data_array[0])):
-                # Create the string to write
-                save_string = "%s%s" % (save_string, datetime.fromtimestamp(
-                    self.clientDict[IoTID].data_array[0][ii]).strftime("%H:%M:%S.%f"))
-                for jj in range(1, MAXVALUES):
-                    save_string = "%s, %f" % (save_string, self.clientDict[IoTID].data_array[jj][ii])
-                save_string = "%s\n" % save_string
-            # Write all of the data in one go:
-            fp.write(save_string)
-            # Close the file:
-            fp.close()
-            # Update the counters:
-            self.lastSaveDict[IoTID] = len(self.clientDict[IoTID].data_array[0])
-
-    def send_command(self, cmd, value):
-        self.handle.send_message("%d, %.5f" % (cmd, value))
-
-    def send_cmdstr(self, cmd):
-        self.handle.send_message("%s" % cmd)
+        self.registry.save_data_to_disk(iot_to_save)
+
+    def send_command(self, cmd, value, delivery=None):
+        self.handle.send_message("%d, %.5f" % (cmd, value), delivery)
+
+    def send_cmdstr(self, cmd, delivery=None):
+        self.handle.send_message("%s" % cmd, delivery)
 
     def get_id(self):
         return self.ID
@@ -200,81 +403,155 @@ class MbedWSClient(object):
 
 
 class IoTVisual(object):
-    def __init__(self, parent_frame, id_num):
-        # Create a new canvas for this IoTD:
-        debug_msg("Creating a new cavas...")
+    def __init__(self, parent_frame, id_num, row=0, column=0):
+        # Create the tile in its cell of the grid of parent_frame:
+        debug_msg("Creating a new canvas...")
         self.IoTFrame = Frame(parent_frame, bd=5, relief=SUNKEN)
-        self.gsize = Grid.size(parent_frame)
-        # Shrink the frame to fit the new widget:
-        parent_frame.pack(side=BOTTOM, fill=NONE, expand=NO)
-        w = parent_frame.winfo_width()
-        h = parent_frame.winfo_height()
-        if self.gsize[0] > 0:
-            debug_msg("New width: %.3f" % (w * self.gsize[0] / (self.gsize[0] + 1) - 1))
-            Grid.grid_propagate(parent_frame, flag=FALSE)
-            parent_frame.config(width=(w * self.gsize[0] / (self.gsize[0] + 1) - 1))
-            parent_frame.update_idletasks()
-        self.IoTFrame.grid(row=0, column=self.gsize[0], sticky=N+S+E+W)
-        self.myCanvas = ResizingCanvas.RC(self.IoTFrame, width=100, height=200, bg='grey', highlightthickness=0)
+        self.IoTFrame.grid(row=row, column=column, sticky=N+S+E+W)
+        self.myCanvas = ResizingCanvas.RC(self.IoTFrame, width=100, height=200, bg='grey', highlightthickness=0,
+                                          on_resize=self.redraw)
         self.myCanvas.pack(side=TOP, fill=BOTH, expand=YES)
-        self.myIoTDLabel = Label(self.IoTFrame, text="IoTD: %d" % id_num)
+        self.IoTDLabelVar = StringVar()
+        self.myIoTDLabel = Label(self.IoTFrame, textvariable=self.IoTDLabelVar)
         self.myIoTDLabel.pack(side=TOP, fill=X)
         self.SendCounterLabelVar = StringVar()
-        self.SendCounterLabelVar.set("Waiting for IoTD Send Counter...")
         self.mySendCounterLabel = Label(self.IoTFrame, textvariable=self.SendCounterLabelVar)
         self.mySendCounterLabel.pack(side=TOP, fill=X)
-        Grid.columnconfigure(parent_frame, self.gsize[0], weight=1)
-        Grid.rowconfigure(parent_frame, 0, weight=1)
-        # Re-expand the canvas:
-        parent_frame.config(height=h)   # This is needed because the height will reset to 0
-        parent_frame.pack(side=BOTTOM, fill=BOTH, expand=YES)
-
-    def updateData(self, data):
-        # Get the dimensions of the canvas:
-        h = self.myCanvas.winfo_height()
-        w = self.myCanvas.winfo_width()
-        # Delete everything on the canvas:
-        self.myCanvas.delete(ALL)
-        # Redraw the voltages:
-        Temp = float(data[TEMPIDX])
-        nrect = 1
-        nr = 0
-        # Draw the temperature:
-        if Temp > TMIN:
-            self.myCanvas.create_rectangle(w/nrect*nr, h, w/nrect*(nr+1), h-h*(Temp-TMIN)/(TMAX-TMIN), fill="red")
-            self.myCanvas.create_text(w/(2*nrect)*(1+2*nr), h-h*(Temp-TMIN)/(TMAX-TMIN), anchor=N, text="%.3f deg C" % Temp)
-        elif Temp > TMAX:
-            self.myCanvas.create_rectangle(w / nrect * nr, h, w / nrect * (nr + 1), 0, fill="red")
-            self.myCanvas.create_text(w / (2 * nrect) * (1 + 2 * nr), 0, anchor=N, text="^ %.3f  deg C ^" % Temp)
-        else:
-            self.myCanvas.create_rectangle(w/nrect*nr, h, w/nrect*(nr+1), h, fill="red")
-            self.myCanvas.create_text(w/(2*nrect)*(1+2*nr), h, anchor=S, text="%.3f deg C" % Temp)
-        nr += 1
+        self.historyCanvas = ResizingCanvas.RC(self.IoTFrame, width=100, height=60, bg='grey', highlightthickness=0,
+                                               on_resize=self.redrawHistory)
+        self.historyCanvas.pack(side=TOP, fill=X)
+        # The canvas items, they are never deleted:
+        self.tempBar = self.myCanvas.create_rectangle(0, 0, 0, 0, fill="red")
+        self.tempText = self.myCanvas.create_text(0, 0, anchor=N, text="")
+        self.historyLine = self.historyCanvas.create_line(0, 0, 0, 0, fill="red")
+        self.historyText = self.historyCanvas.create_text(2, 2, anchor=NW, text="")
+        self.ID = None
+        self.data = None
+        self.history = None
+        # What is drawn at the moment, to skip the updates that would not change anything:
+        self.drawn = None
+        self.historyDrawn = None
+        self.sendCounter = None
+        self.bind(id_num)
+
+    def bind(self, id_num, data=None, history=None):
+        # Show the IoTD id_num in this tile, with its latest data and history if they are known:
+        self.ID = id_num
+        self.IoTDLabelVar.set("IoTD: %d" % id_num)
+        self.data = None
+        self.history = None
+        self.drawn = None
+        self.historyDrawn = None
+        self.sendCounter = None
+        self.myCanvas.coords(self.tempBar, 0, 0, 0, 0)
+        self.myCanvas.itemconfig(self.tempText, text="")
+        self.historyCanvas.coords(self.historyLine, 0, 0, 0, 0)
+        self.historyCanvas.itemconfig(self.historyText, text="")
+        self.SendCounterLabelVar.set("Waiting for IoTD Send Counter...")
+        if data is not None:
+            self.updateData(data, history)
+
+    def show(self):
+        self.IoTFrame.grid()
+
+    def hide(self):
+        # Take the tile off the grid, it keeps its cell for show():
+        self.IoTFrame.grid_remove()
+
+    def updateData(self, data, history=None):
+        # history is the downsample.RollingMinMax of the temperature of the IoTD:
+        self.data = data
+        if history is not None:
+            self.history = history
+        self.redraw()
+        self.redrawHistory()
         # Update the labels:
-        self.SendCounterLabelVar.set("Send Counter: %.0f" % float(data[SENDCOUNTERIDX]))
+        if data[SENDCOUNTERIDX] != self.sendCounter:
+            self.sendCounter = data[SENDCOUNTERIDX]
+            self.SendCounterLabelVar.set("Send Counter: %.0f" % self.sendCounter)
+
+    def redraw(self, event=None):
+        # Move the items to show the temperature, if it or the size of the canvas changed:
+        if self.data is None:
+            return
+        Temp = self.data[TEMPIDX]
+        w = self.myCanvas.width
+        h = self.myCanvas.height
+        if (Temp, w, h) == self.drawn:
+            return
+        self.drawn = (Temp, w, h)
+        if Temp > TMAX:
+            top = 0
+            anchor = N
+            text = "^ %.3f deg C ^" % Temp
+        elif Temp > TMIN:
+            top = h - h * (Temp - TMIN) / (TMAX - TMIN)
+            anchor = N
+            text = "%.3f deg C" % Temp
+        else:
+            top = h
+            anchor = S
+            text = "%.3f deg C" % Temp
+        self.myCanvas.coords(self.tempBar, 0, h, w, top)
+        self.myCanvas.coords(self.tempText, w / 2, top)
+        self.myCanvas.itemconfig(self.tempText, text=text, anchor=anchor)
+
+    def redrawHistory(self, event=None):
+        # Draw the range of the temperature in each pixel column, scaled to the range of the whole history. The
+        # number of points only depends on the width of the canvas:
+        if self.history is None:
+            return
+        w = self.historyCanvas.width
+        h = self.historyCanvas.height
+        if (self.history.version, w, h) == self.historyDrawn:
+            return
+        self.historyDrawn = (self.history.version, w, h)
+        columns = self.history.view(max(int(w), 1))
+        if not columns:
+            return
+        low = min(column[1] for column in columns)
+        high = max(column[2] for column in columns)
+        scale = (h - 1) / (high - low) if high > low else 0.0
+        middle = (h - 1) / 2.0 if high == low else 0.0
+        points = []
+        for x, cmin, cmax in columns:
+            points.extend((x, h - 1 - middle - (cmax - low) * scale, x, h - 1 - middle - (cmin - low) * scale))
+        if len(points) == 4:
+            # A single column, make it visible:
+            points.extend((points[0] + 1, points[3]))
+        self.historyCanvas.coords(self.historyLine, *points)
+        self.historyCanvas.itemconfig(self.historyText, text="%.1f .. %.1f deg C" % (low, high))
 
 
 class MbedData(object):
     def __init__(self, data, handle):
-        # Initialize the data array:
-        self.data_array = [[0.0 for ii in range(1)] for ii in range(MAXVALUES)]
-        self.ID = int(data[0])
+        # Initialize the sample store, column 0 holds the time stamps:
+        self.store = sampleStore.SampleStore(MAXVALUES, RETENTION)
+        self.rollups = rollupStore.RollupSet(MAXVALUES)
+        # The recent temperatures, decimated for the GUI:
+        self.history = downsample.RollingMinMax(HISTORYSPAN, HISTORYBUCKETS, TEMPIDX)
+        self.ID = data.iot_id
         self.handle = handle
-        for ii in range(0, MAXVALUES):
-            if ii == 0:
-                self.data_array[0][0] = float(time.time())
-            else:
-                self.data_array[ii][0] = float(data[ii])
+        self.append_data(data, handle)
+        # The time stamp of the first sample received, the samples saved before it are added by add_recent:
+        self.started = self.store.columns[0][0]
+
+    def add_recent(self, recent):
+        # recent holds the last samples saved by a previous run of the server, they are already on disk. They go in
+        # front of the samples received since, the newest ones may already be on disk too:
+        recent = [sample[0:MAXVALUES] for sample in recent if sample[0] < self.started]
+        self.store.prepend(recent)
+        for sample in recent:
+            self.history.add_earlier(sample)
 
     def append_data(self, data, handle):
-        # Data is a list of strings
+        # Data is a messageParser.Sample
         self.handle = handle
-        # Add data:
-        for ii in range(0, MAXVALUES):
-            if ii == 0:
-                self.data_array[0].append(float(time.time()))
-            else:
-                self.data_array[ii].append(float(data[ii]))
+        # Add data, with the time stamp in place of the IoT ID:
+        sample = (time.time(),) + data[1:MAXVALUES]
+        self.store.append(sample)
+        self.rollups.add(sample)
+        self.history.add(sample)
         debug_msg("Data appended to IoTD.")
 
 
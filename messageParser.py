@@ -0,0 +1,83 @@
+import struct
+from collections import namedtuple
+""" Parser for the messages sent by the IoTDs
+
+FILENAME
+    messageParser.py
+
+DESCRIPTION
+    Every message from an IoTD is parsed once, here, into Sample records. The rest of the server only deals with
+    Samples, whose fields are in the same positions as in the text message, so SENDCOUNTERIDX and TEMPIDX still apply.
+
+    Text messages hold one sample in the format "<IoT ID>,<send counter>,<temperature>". Several samples can be sent
+    in one message, separated by ';' or new lines.
+    Binary messages are only accepted from IoTDs that asked for them when connecting, either with the
+    BINARYSUBPROTOCOL WebSocket subprotocol, or by connecting to /ws?format=binary. A binary message holds one or
+    more BINARYRECORD records, back to back:
+        uint32  IoT ID
+        uint32  send counter
+        float32 temperature
+    all little-endian (the byte order of the mbed microcontrollers).
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+BINARYSUBPROTOCOL = "iot-binary"
+BINARYRECORD = struct.Struct("<IIf")
+
+Sample = namedtuple("Sample", ["iot_id", "send_counter", "temperature"])
+
+
+class ParseError(ValueError):
+    pass
+
+
+def parse_line(line):
+    # Parse one "<IoT ID>,<send counter>,<temperature>" sample:
+    fields = line.split(",")
+    try:
+        return Sample(int(fields[0]), float(fields[1]), float(fields[2]))
+    except (IndexError, ValueError):
+        raise ParseError("Could not parse: %r" % line)
+
+
+def parse_text(message):
+    # Return the list of Samples in a text message. Most messages hold a single sample, so check for that first:
+    if ";" not in message and "\n" not in message:
+        return [parse_line(message)]
+    return [parse_line(line) for line in message.replace(";", "\n").split("\n") if line.strip()]
+
+
+def parse_binary(message):
+    # Return the list of Samples in a binary message:
+    if len(message) == 0 or len(message) % BINARYRECORD.size != 0:
+        raise ParseError("Binary message of %d bytes is not a whole number of records" % len(message))
+    return [Sample._make(record) for record in BINARYRECORD.iter_unpack(message)]
+
+
+def pack_binary(samples):
+    # Build a binary message from Samples (or tuples), as an IoTD would:
+    return b"".join(BINARYRECORD.pack(int(s[0]), int(s[1]), s[2]) for s in samples)
@@ -0,0 +1,285 @@
+import os
+from array import array
+import downsample
+""" Incremental rollups of the samples
+
+FILENAME
+    rollupStore.py
+
+DESCRIPTION
+    Keeps aggregates of the samples of every IoTD in fixed time buckets, so that a chart of a month of data does not
+    have to read the raw samples. There is one tier per bucket width in TIERS (a minute and an hour). For each
+    bucket, and each column of the samples (the time stamp included), a tier keeps the count, sum, minimum, maximum
+    and last value. The buckets are updated as each sample arrives, in O(1) time and memory per sample.
+    Closed buckets wait in memory with the unsaved samples of their IoTD, and are appended to their file by the disk
+    writer when the samples are saved:
+        <DATADIRECTORY>/rollups/<tier>/IoTD001.rlp
+    Each record is 2 + STATS * num_values doubles (see record_values), with num_values the columns of a sample
+    (mbedWSClient.MAXVALUES), in the byte order of the host: the bucket start (seconds since the epoch, aligned to
+    the width of the tier), the count, then (sum, min, max, last) for every column. The open buckets are
+    written when the server stops, so a bucket can be written twice when the server is restarted within it. Readers
+    merge consecutive records with the same start.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+ROLLUPDIRECTORY = "rollups"
+# The tiers, as (name, bucket width in seconds), finest first:
+TIERS = (("minute", 60), ("hour", 3600))
+# Values kept per column: sum, min, max, last
+STATS = 4
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[rollupStore : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[rollupStore : INFO] %s' % msg)
+
+
+def record_values(num_values):
+    # The number of doubles in a record:
+    return 2 + STATS * num_values
+
+
+def rollup_filename(directory, tier, IoTID):
+    return os.path.join(directory, ROLLUPDIRECTORY, tier, "IoTD%03d.rlp" % IoTID)
+
+
+def tier_width(tier):
+    return dict(TIERS)[tier]
+
+
+def choose_tier(span):
+    # Return the coarsest tier with buckets no wider than span seconds, or None if they are all too wide:
+    best = None
+    for name, width in TIERS:
+        if width <= span:
+            best = name
+    return best
+
+
+def merge(records, num_values, start=None, stop=None):
+    # records is a flat array of records, in time order. Yields each bucket as a list, the records of a bucket that
+    # was written more than once are merged. Only the buckets with start <= bucket start < stop are kept.
+    n = record_values(num_values)
+    current = None
+    for ii in range(0, len(records), n):
+        record = records[ii:ii + n]
+        if (start is not None and record[0] < start) or (stop is not None and record[0] >= stop):
+            continue
+        if current is not None and current[0] == record[0]:
+            current[1] += record[1]
+            for kk in range(2, n, STATS):
+                current[kk] += record[kk]
+                current[kk + 1] = min(current[kk + 1], record[kk + 1])
+                current[kk + 2] = max(current[kk + 2], record[kk + 2])
+                current[kk + 3] = record[kk + 3]
+        else:
+            if current is not None:
+                yield current
+            current = list(record)
+    if current is not None:
+        yield current
+
+
+def bucket_mean(buckets, start, stop, points):
+    # Like downsample.bucket_mean, from rollup buckets instead of samples:
+    current = -1
+    count = 0
+    sums = None
+    for bucket in buckets:
+        ii = downsample.bucket_index(bucket[0], start, stop, points)
+        if ii != current:
+            if count:
+                yield tuple(total / count for total in sums)
+            current = ii
+            count = 0
+            sums = [0.0] * ((len(bucket) - 2) // STATS)
+        count += bucket[1]
+        for jj in range(len(sums)):
+            sums[jj] += bucket[2 + STATS * jj]
+    if count:
+        yield tuple(total / count for total in sums)
+
+
+def bucket_minmax(buckets, start, stop, points):
+    # Like downsample.bucket_minmax, from rollup buckets instead of samples:
+    current = -1
+    lows = None
+    highs = None
+    for bucket in buckets:
+        ii = downsample.bucket_index(bucket[0], start, stop, points)
+        columns = (len(bucket) - 2) // STATS
+        if ii != current:
+            if lows is not None:
+                yield downsample.minmax_row(current, start, stop, points, lows, highs)
+            current = ii
+            lows = [bucket[3 + STATS * jj] for jj in range(1, columns)]
+            highs = [bucket[4 + STATS * jj] for jj in range(1, columns)]
+        else:
+            for jj in range(1, columns):
+                lows[jj - 1] = min(lows[jj - 1], bucket[3 + STATS * jj])
+                highs[jj - 1] = max(highs[jj - 1], bucket[4 + STATS * jj])
+    if lows is not None:
+        yield downsample.minmax_row(current, start, stop, points, lows, highs)
+
+
+class Rollup(object):
+    # The open bucket of one tier of an IoTD:
+    def __init__(self, width, num_values):
+        self.width = width
+        self.start = None
+        self.count = 0
+        self.stats = [0.0] * (STATS * num_values)
+
+    def add(self, sample):
+        # Add a sample (a tuple starting with the time stamp). Returns the record of the bucket it closed, or None:
+        start = sample[0] - sample[0] % self.width
+        stats = self.stats
+        if start != self.start:
+            closed = self.close()
+            self.start = start
+            self.count = 1
+            kk = 0
+            for value in sample:
+                stats[kk] = stats[kk + 1] = stats[kk + 2] = stats[kk + 3] = value
+                kk += STATS
+            return closed
+        self.count += 1
+        kk = 0
+        for value in sample:
+            stats[kk] += value
+            if value < stats[kk + 1]:
+                stats[kk + 1] = value
+            elif value > stats[kk + 2]:
+                stats[kk + 2] = value
+            stats[kk + 3] = value
+            kk += STATS
+        return None
+
+    def record(self):
+        # The open bucket as a record, or None if it is empty:
+        if self.count == 0:
+            return None
+        record = array('d', (self.start, self.count))
+        record.extend(self.stats)
+        return record
+
+    def close(self):
+        record = self.record()
+        self.start = None
+        self.count = 0
+        return record
+
+
+class RollupSet(object):
+    # Every tier of one IoTD, and the closed buckets that have not been saved yet:
+    def __init__(self, num_values):
+        self.num_values = num_values
+        self.tiers = [(name, Rollup(width, num_values)) for name, width in TIERS]
+        self.pending = dict((name, array('d')) for name, width in TIERS)
+
+    def add(self, sample):
+        for name, rollup in self.tiers:
+            closed = rollup.add(sample)
+            if closed is not None:
+                self.pending[name].extend(closed)
+
+    def close(self):
+        # Close the open buckets, they are saved with the next batch:
+        for name, rollup in self.tiers:
+            closed = rollup.close()
+            if closed is not None:
+                self.pending[name].extend(closed)
+
+    def take_pending(self):
+        # Return the closed buckets of each tier as {tier: array of records}, and forget them:
+        pending = self.pending
+        self.pending = dict((name, array('d')) for name, width in TIERS)
+        return pending
+
+    def recent(self, tier):
+        # Return the closed buckets that have not been saved yet and the open bucket of a tier, as one array:
+        records = array('d', self.pending[tier])
+        for name, rollup in self.tiers:
+            if name == tier:
+                record = rollup.record()
+                if record is not None:
+                    records.extend(record)
+        return records
+
+
+class RollupStore(object):
+    # Reads the rollup files:
+    def __init__(self, directory, num_values):
+        self.directory = directory
+        self.num_values = num_values
+        self.record_size = 8 * record_values(num_values)
+
+    def read(self, IoTID, tier, start, stop):
+        # Return the records of a tier with start <= bucket start < stop, as a flat array of doubles:
+        records = array('d')
+        try:
+            fp = open(rollup_filename(self.directory, tier, IoTID), 'rb')
+        except FileNotFoundError:
+            return records
+        with fp:
+            count = os.fstat(fp.fileno()).st_size // self.record_size
+            lo = self.find(fp, count, start)
+            hi = self.find(fp, count, stop)
+            if hi > lo:
+                fp.seek(lo * self.record_size)
+                records.frombytes(fp.read((hi - lo) * self.record_size))
+        return records
+
+    def covers(self, IoTID, tier, start):
+        # Return True if the rollups of a tier go back to start, data from before the rollups were kept has none:
+        try:
+            with open(rollup_filename(self.directory, tier, IoTID), 'rb') as fp:
+                first = fp.read(8)
+        except FileNotFoundError:
+            return False
+        return len(first) == 8 and array('d', first)[0] <= start
+
+    def find(self, fp, count, t):
+        # Return the number of records with a bucket start before t, by bisection over the file:
+        lo = 0
+        hi = count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            fp.seek(mid * self.record_size)
+            if array('d', fp.read(8))[0] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
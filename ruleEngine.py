@@ -0,0 +1,409 @@
+import json
+import math
+import time
+from collections import deque, OrderedDict
+import tornado.ioloop
+import mbedWSClient
+""" Rules evaluated on the samples as they arrive
+
+FILENAME
+    ruleEngine.py
+
+DESCRIPTION
+    With --rules FILE, every sample is checked against the rules of its IoTD as it is stored, instead of polling the
+    .csv files. The file holds a JSON list of rules, for instance:
+        [{"name": "hot", "when": "above", "limit": 30, "ids": [1, 2], "send": "1,1"},
+         {"name": "heating", "when": "rate_above", "limit": 0.05},
+         {"name": "noisy", "when": "stddev_above", "limit": 2.0, "samples": 20},
+         {"name": "warm", "when": "mean_above", "limit": 25, "seconds": 600, "group": "lab"},
+         {"name": "silent", "when": "missing", "seconds": 30}]
+    The keys of a rule are:
+        name        the name it is reported with
+        when        the condition (see below)
+        value       the column it is checked on, "temperature" by default (see mbedWSClient.COLUMNNAMES)
+        limit       the threshold of the condition
+        samples     the window of a windowed condition, as a number of samples...
+        seconds     ...or as seconds. For "missing", the seconds of silence
+        ids, group  the IoTDs it applies to, by IoT ID or group name (the groups as they are when the IoTD first
+                    sends data). Every IoTD by default
+        send        a command sent when it fires, to the IoTD itself or to "to" (an IoT ID, a group or "All")
+    The conditions are:
+        above, below                    the value is above or below limit
+        rate_above, rate_below          its change per second since the previous sample is above or below limit
+        mean_above, mean_below          the mean over the window is above or below limit
+        stddev_above                    the standard deviation over the window is above limit
+        max_above, min_below            the largest value over the window is above limit, the smallest is below it
+        missing                         the IoTD has sent nothing for seconds
+    A rule fires when its condition becomes true, and is cleared when it is false again, so an IoTD that stays above
+    a limit fires once. A windowed condition is checked once the window holds samples samples, or two samples for a
+    window in seconds. The callbacks of the RuleEngine are called as callback(name, IoT ID, event, value, time
+    stamp), where event is "fired" or "cleared".
+    The rules of each IoTD are worked out when it first sends data, so a sample only costs the rules of its IoTD.
+    The windows are shared by the rules that use the same column and length, and are updated in O(1) per sample:
+    running sums for the mean and the standard deviation, and monotonic deques for the largest and smallest values.
+    The silent IoTDs are found without looking at the others: each "missing" rule keeps its IoTDs in the order they
+    were last heard from, and a timer only looks at the front of that order every CHECKINTERVAL seconds.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+# The rules of the server, loaded from the --rules file of PyWsServer.py:
+RULES = []
+# Seconds between the checks for silent IoTDs:
+CHECKINTERVAL = 1.0
+
+THRESHOLDS = ("above", "below")
+RATES = ("rate_above", "rate_below")
+WINDOWED = ("mean_above", "mean_below", "stddev_above", "max_above", "min_below")
+CONDITIONS = THRESHOLDS + RATES + WINDOWED + ("missing",)
+# The keys of a rule in the rules file, and the JSON types of their values:
+KEYTYPES = {"name": str, "when": str, "limit": (int, float), "value": str, "samples": int, "seconds": (int, float),
+            "ids": list, "group": str, "send": str, "to": (int, str)}
+KEYNAMES = {str: "a string", int: "an integer", list: "a list", (int, float): "a number",
+            (int, str): "an IoT ID, a group or All"}
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[ruleEngine : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[ruleEngine : INFO] %s' % msg)
+
+
+class Rule(object):
+    def __init__(self, name, when, limit=None, value="temperature", samples=None, seconds=None, ids=None,
+                 group=None, send=None, to=None):
+        # Raises ValueError if the rule does not make sense:
+        if when not in CONDITIONS:
+            raise ValueError("Rule %s: unknown condition %r" % (name, when))
+        if value not in mbedWSClient.COLUMNNAMES[1:]:
+            raise ValueError("Rule %s: unknown value %r" % (name, value))
+        if when != "missing" and limit is None:
+            raise ValueError("Rule %s: %s needs a limit" % (name, when))
+        if when in WINDOWED and (samples is None) == (seconds is None):
+            raise ValueError("Rule %s: %s needs either samples or seconds" % (name, when))
+        if when == "missing" and not seconds:
+            raise ValueError("Rule %s: missing needs seconds" % name)
+        if (samples is not None and int(samples) < 1) or (seconds is not None and float(seconds) <= 0):
+            raise ValueError("Rule %s: the window must not be empty" % name)
+        self.name = name
+        self.when = when
+        self.limit = None if limit is None else float(limit)
+        self.value = value
+        # The position of the value in a messageParser.Sample, and in the columns of the sample store:
+        self.column = mbedWSClient.COLUMNNAMES.index(value)
+        self.samples = None if samples is None else int(samples)
+        self.seconds = None if seconds is None else float(seconds)
+        self.ids = None if ids is None else set(int(IoTID) for IoTID in ids)
+        self.group = group
+        self.send = send
+        self.to = to
+
+    def applies_to(self, IoTID, registry):
+        if self.ids is None and self.group is None:
+            return True
+        if self.ids is not None and IoTID in self.ids:
+            return True
+        return self.group is not None and IoTID in registry.groups.get(self.group, ())
+
+    def window_key(self):
+        return (self.column, self.samples, self.seconds)
+
+
+def parse_rule(spec):
+    # Build a Rule from its JSON object, raises ValueError if it is not a valid rule:
+    if not isinstance(spec, dict) or "when" not in spec:
+        raise ValueError("A rule must be an object with a 'when': %r" % (spec,))
+    name = spec.get("name", spec["when"])
+    unknown = [key for key in spec if key not in KEYTYPES]
+    if unknown:
+        raise ValueError("Rule %s: unknown keys %s" % (name, ", ".join(sorted(unknown))))
+    for key in spec:
+        value = spec[key]
+        if value is not None and (not isinstance(value, KEYTYPES[key]) or isinstance(value, bool)):
+            raise ValueError("Rule %s: %s must be %s, not %r" % (name, key, KEYNAMES[KEYTYPES[key]], value))
+    if spec.get("ids") is not None and not all(isinstance(IoTID, int) for IoTID in spec["ids"]):
+        raise ValueError("Rule %s: ids must be a list of IoT IDs" % name)
+    spec = dict(spec)
+    spec.setdefault("name", spec["when"])
+    to = spec.get("to")
+    if isinstance(to, str):
+        spec["to"] = -1 if to == "All" else int(to) if to.isdigit() else to
+    return Rule(**spec)
+
+
+def load_rules(filename):
+    # Read the rules from a JSON file, raises ValueError or OSError:
+    with open(filename, 'r') as fp:
+        specs = json.load(fp)
+    if not isinstance(specs, list):
+        raise ValueError("The rules must be a JSON list")
+    rules = []
+    for nn, spec in enumerate(specs):
+        try:
+            rules.append(parse_rule(spec))
+        except ValueError as e:
+            raise ValueError("item %d of the list: %s" % (nn, e))
+    return rules
+
+
+class RollingWindow(object):
+    """The last samples samples, or the samples of the last seconds seconds, of one value"""
+    def __init__(self, samples=None, seconds=None):
+        self.samples = samples
+        self.seconds = seconds
+        # (time stamp, value) of each sample in the window:
+        self.values = deque()
+        # Running sums of the values less shift, to keep the sum of squares accurate:
+        self.shift = None
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        # (number, value) of the candidates for the largest and the smallest value, in decreasing and increasing
+        # order. The number of each sample counts the samples that went through the window:
+        self.maxima = deque()
+        self.minima = deque()
+        self.added = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, timestamp, value):
+        if self.shift is None:
+            self.shift = value
+        self.values.append((timestamp, value))
+        delta = value - self.shift
+        self.sum += delta
+        self.sum_squares += delta * delta
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((self.added, value))
+        while self.minima and self.minima[-1][1] >= value:
+            self.minima.pop()
+        self.minima.append((self.added, value))
+        self.added += 1
+        if self.samples is not None:
+            while len(self.values) > self.samples:
+                self.drop()
+        else:
+            while timestamp - self.values[0][0] > self.seconds:
+                self.drop()
+
+    def drop(self):
+        timestamp, value = self.values.popleft()
+        delta = value - self.shift
+        self.sum -= delta
+        self.sum_squares -= delta * delta
+        first = self.added - len(self.values)
+        if self.maxima[0][0] < first:
+            self.maxima.popleft()
+        if self.minima[0][0] < first:
+            self.minima.popleft()
+
+    def ready(self):
+        # Enough samples to check the conditions on:
+        if self.samples is not None:
+            return len(self.values) >= self.samples
+        return len(self.values) >= 2
+
+    def mean(self):
+        return self.shift + self.sum / len(self.values)
+
+    def stddev(self):
+        count = len(self.values)
+        mean = self.sum / count
+        return math.sqrt(max(0.0, self.sum_squares / count - mean * mean))
+
+    def maximum(self):
+        return self.maxima[0][1]
+
+    def minimum(self):
+        return self.minima[0][1]
+
+
+class RuleState(object):
+    def __init__(self, rule, window=None):
+        self.rule = rule
+        self.window = window
+        self.active = False
+
+
+class DeviceRules(object):
+    """The rules of one IoTD, and the windows and previous values they use"""
+    def __init__(self, rules):
+        self.windows = {}
+        self.states = []
+        self.missing = []
+        # (time stamp, value) of the previous sample, by column, for the rates:
+        self.previous = {}
+        for rule in rules:
+            window = None
+            if rule.when in WINDOWED:
+                key = rule.window_key()
+                if key not in self.windows:
+                    self.windows[key] = RollingWindow(rule.samples, rule.seconds)
+                window = self.windows[key]
+            self.states.append(RuleState(rule, window))
+        self.rate_columns = sorted(set(rule.column for rule in rules if rule.when in RATES))
+
+
+class MissingTracker(object):
+    """The IoTDs of a missing rule, in the order they were last heard from"""
+    def __init__(self, rule):
+        self.rule = rule
+        self.last_seen = OrderedDict()
+        # The IoTDs it has fired for, until they send data again:
+        self.silent = set()
+
+    def seen(self, IoTID, timestamp):
+        # Returns True if the IoTD was silent:
+        self.last_seen[IoTID] = timestamp
+        self.last_seen.move_to_end(IoTID)
+        if IoTID in self.silent:
+            self.silent.discard(IoTID)
+            return True
+        return False
+
+    def expired(self, now):
+        # Remove and return the IoTDs silent for longer than the rule allows:
+        expired = []
+        while self.last_seen:
+            IoTID, timestamp = next(iter(self.last_seen.items()))
+            if now - timestamp <= self.rule.seconds:
+                break
+            self.last_seen.popitem(last=False)
+            self.silent.add(IoTID)
+            expired.append((IoTID, timestamp))
+        return expired
+
+
+class RuleEngine(object):
+    def __init__(self, registry, rules=(), send=None):
+        # send(adr, cmd) sends a command, from the IOLoop (see PyWsServer.TornadoThread.send_cmd_now):
+        self.registry = registry
+        self.rules = list(rules)
+        self.send = send
+        # Called as callback(name, IoT ID, event, value, time stamp):
+        self.callbacks = []
+        # The DeviceRules of each IoT ID that sent data:
+        self.devices = {}
+        self.trackers = dict((rule, MissingTracker(rule)) for rule in self.rules if rule.when == "missing")
+        self.fired = 0
+        self.callback = None
+        registry.listeners.append(self.on_sample)
+
+    def add_rule(self, rule):
+        # The rules of the IoTDs are worked out again, their windows start empty:
+        self.rules.append(rule)
+        if rule.when == "missing":
+            self.trackers[rule] = MissingTracker(rule)
+        self.devices = {}
+
+    def start(self):
+        # Look for the silent IoTDs on the current IOLoop:
+        if self.trackers and self.callback is None:
+            self.callback = tornado.ioloop.PeriodicCallback(self.check_missing, CHECKINTERVAL * 1000)
+            self.callback.start()
+
+    def stop(self):
+        if self.callback is not None:
+            self.callback.stop()
+            self.callback = None
+        if self.on_sample in self.registry.listeners:
+            self.registry.listeners.remove(self.on_sample)
+
+    def device(self, IoTID):
+        device = self.devices.get(IoTID)
+        if device is None:
+            rules = [rule for rule in self.rules if rule.applies_to(IoTID, self.registry)]
+            device = DeviceRules([rule for rule in rules if rule.when != "missing"])
+            device.missing = [self.trackers[rule] for rule in rules if rule.when == "missing"]
+            self.devices[IoTID] = device
+        return device
+
+    def on_sample(self, IoTID, timestamp, sample):
+        # Called by the registry for every sample stored:
+        device = self.device(IoTID)
+        for tracker in device.missing:
+            if tracker.seen(IoTID, timestamp):
+                self.fire(tracker.rule, IoTID, "cleared", None, timestamp)
+        for key in device.windows:
+            device.windows[key].add(timestamp, sample[key[0]])
+        for state in device.states:
+            active = self.evaluate(state, device, timestamp, sample)
+            if active is not None and active != state.active:
+                state.active = active
+                self.fire(state.rule, IoTID, "fired" if active else "cleared", sample[state.rule.column],
+                          timestamp)
+        for column in device.rate_columns:
+            device.previous[column] = (timestamp, sample[column])
+
+    def evaluate(self, state, device, timestamp, sample):
+        # Return whether the condition of a rule holds, or None if it cannot be told yet:
+        rule = state.rule
+        when = rule.when
+        if when == "above":
+            return sample[rule.column] > rule.limit
+        if when == "below":
+            return sample[rule.column] < rule.limit
+        if when in RATES:
+            previous = device.previous.get(rule.column)
+            if previous is None or timestamp <= previous[0]:
+                return None
+            rate = (sample[rule.column] - previous[1]) / (timestamp - previous[0])
+            return rate > rule.limit if when == "rate_above" else rate < rule.limit
+        window = state.window
+        if not window.ready():
+            return None
+        if when == "mean_above":
+            return window.mean() > rule.limit
+        if when == "mean_below":
+            return window.mean() < rule.limit
+        if when == "stddev_above":
+            return window.stddev() > rule.limit
+        if when == "max_above":
+            return window.maximum() > rule.limit
+        return window.minimum() < rule.limit
+
+    def check_missing(self):
+        now = time.time()
+        for rule in self.trackers:
+            for IoTID, timestamp in self.trackers[rule].expired(now):
+                self.fire(rule, IoTID, "fired", now - timestamp, now)
+
+    def fire(self, rule, IoTID, event, value, timestamp):
+        if event == "fired":
+            self.fired += 1
+        info_msg("Rule %s %s for IoTD %d (%s)" % (rule.name, event, IoTID, value))
+        for callback in self.callbacks:
+            callback(rule.name, IoTID, event, value, timestamp)
+        if event == "fired" and rule.send is not None and self.send is not None:
+            self.send(IoTID if rule.to is None else rule.to, rule.send)
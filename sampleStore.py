@@ -0,0 +1,114 @@
+from array import array
+""" Compact in-memory sample store
+
+FILENAME
+    sampleStore.py
+
+DESCRIPTION
+    Each IoT ID keeps its samples in a SampleStore. The samples are stored column by column, one array('d') per value
+    (column 0 is the time stamp), so each value costs 8 bytes instead of a boxed float and a list slot.
+    The store keeps track of the samples that have been saved to disk. Once they are saved, only the last 'retention'
+    samples are kept in memory, older samples are released. Samples that have not been saved yet are never released.
+    Samples are addressed by their absolute index: the number of samples appended to the store before them. The
+    absolute index of a sample does not change when older samples are released.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+# Default number of saved samples kept in memory for each IoT ID:
+RETENTION = 1000
+
+
+class SampleStore(object):
+    def __init__(self, num_values, retention=RETENTION):
+        self.columns = [array('d') for ii in range(num_values)]
+        # Absolute index of the first sample still in memory:
+        self.offset = 0
+        # Absolute index of the first sample not saved to disk yet:
+        self.saved = 0
+        self.retention = max(0, int(retention))
+
+    def __len__(self):
+        # The total number of samples ever appended:
+        return self.offset + len(self.columns[0])
+
+    def append(self, values):
+        # values holds one number per column, starting with the time stamp:
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def first_index(self):
+        return self.offset
+
+    def unsaved_count(self):
+        return len(self) - self.saved
+
+    def unsaved(self):
+        # Return a copy of the samples that have not been saved yet, one array per column:
+        return self.columns_between(self.saved, len(self))
+
+    def mark_saved(self, upto=None):
+        # All of the samples before the absolute index upto are now on disk:
+        if upto is None:
+            upto = len(self)
+        self.saved = max(self.saved, min(upto, len(self)))
+        self.release()
+
+    def prepend(self, rows):
+        # Put samples that are already on disk in front of those in memory. rows holds tuples in time order, all older
+        # than the samples in memory. The absolute indices of the samples in memory move on by len(rows):
+        columns = [array('d') for column in self.columns]
+        for row in rows:
+            for column, value in zip(columns, row):
+                column.append(value)
+        for column, older in zip(self.columns, columns):
+            column[0:0] = older
+        self.saved += len(rows)
+        self.release()
+
+    def release(self):
+        # Free the saved samples that are outside of the retention window:
+        keep_from = min(self.saved, len(self) - self.retention)
+        drop = keep_from - self.offset
+        if drop > 0:
+            for column in self.columns:
+                del column[:drop]
+            self.offset += drop
+
+    def columns_between(self, start, stop):
+        # Return a copy of the samples from absolute index start up to (not including) stop:
+        start = max(start, self.offset) - self.offset
+        stop = max(min(stop, len(self)), self.offset) - self.offset
+        return [column[start:stop] for column in self.columns]
+
+    def latest(self):
+        # Return the last sample as a tuple, or None if there is none in memory:
+        if len(self.columns[0]) == 0:
+            return None
+        return tuple(column[-1] for column in self.columns)
+
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in self.columns)
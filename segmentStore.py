@@ -0,0 +1,334 @@
+import os
+import mmap
+import threading
+import bisect
+import struct
+from array import array
+from collections import OrderedDict
+""" Append-only binary segment storage
+
+FILENAME
+    segmentStore.py
+
+DESCRIPTION
+    An optional storage backend that keeps the samples of each IoT ID in binary segment files, next to (or instead
+    of) the .csv files. Each sample is a fixed-width record of MAXVALUES doubles, in the byte order of the host: the
+    full time stamp (seconds since the epoch) followed by the values from the IoTD. Records are only ever appended.
+    The files of an IoTD are kept in their own directory:
+        <DATADIRECTORY>/segments/IoTD001/<first time stamp in microseconds>.seg
+        <DATADIRECTORY>/segments/IoTD001/<first time stamp in microseconds>.idx
+    A segment holds up to SEGMENTRECORDS records, then a new one is started. The .idx file is a sparse time index:
+    one (time stamp, record number) pair for every INDEXINTERVAL records.
+    A time range read memory-maps the segments that overlap the range, uses the sparse index to narrow down where the
+    range starts and ends, and returns memoryviews of the mapped records, so nothing is parsed or copied.
+    Samples are assumed to be appended in time order, which is the case for the time stamps taken by the server.
+
+    Classes:
+        SegmentWriter
+            Appends records to the segments of one IoT ID. Only one SegmentWriter may write to an IoT ID at a time.
+        SegmentStore
+            Finds the SegmentWriter of each IoT ID, and reads time ranges back.
+        RangeView
+            The result of a time range read: a list of zero-copy views of the records, one per segment.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+SEGMENTDIRECTORY = "segments"
+SEGMENTRECORDS = 1 << 20
+INDEXINTERVAL = 256
+# Number of closed segments kept memory-mapped by the reader:
+MAXMAPPED = 64
+
+INDEXENTRY = struct.Struct("<dQ")
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[segmentStore : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[segmentStore : INFO] %s' % msg)
+
+
+def device_directory(directory, IoTID):
+    return os.path.join(directory, SEGMENTDIRECTORY, "IoTD%03d" % IoTID)
+
+
+def list_segments(device_dir):
+    # Return the sorted (first time stamp, path without extension) of every segment of a device:
+    segments = []
+    if os.path.isdir(device_dir):
+        for name in os.listdir(device_dir):
+            if name.endswith(".seg"):
+                try:
+                    start = int(name[:-4])
+                except ValueError:
+                    continue
+                segments.append((start / 1e6, os.path.join(device_dir, name[:-4])))
+    segments.sort()
+    return segments
+
+
+class SegmentWriter(object):
+    def __init__(self, directory, IoTID, num_values):
+        self.device_dir = device_directory(directory, IoTID)
+        self.num_values = num_values
+        self.record_size = 8 * num_values
+        self.seg_file = None
+        self.idx_file = None
+        self.records = 0
+        os.makedirs(self.device_dir, exist_ok=True)
+        # Carry on with the last segment if it is not full:
+        segments = list_segments(self.device_dir)
+        if segments:
+            path = segments[-1][1]
+            size = os.path.getsize(path + ".seg")
+            records = size // self.record_size
+            if records < SEGMENTRECORDS:
+                if records * self.record_size != size:
+                    # Drop a record that was only partly written:
+                    info_msg("Truncating a partial record in %s.seg" % path)
+                    with open(path + ".seg", 'r+b') as fp:
+                        fp.truncate(records * self.record_size)
+                self.open_segment(path, records)
+
+    def open_segment(self, path, records):
+        self.close()
+        self.seg_file = open(path + ".seg", 'ab')
+        self.idx_file = open(path + ".idx", 'ab')
+        self.records = records
+
+    def new_segment(self, start_time):
+        path = os.path.join(self.device_dir, "%d" % int(start_time * 1e6))
+        while os.path.exists(path + ".seg"):
+            # Two segments starting in the same microsecond, keep the names in order:
+            path = os.path.join(self.device_dir, "%d" % (int(os.path.basename(path)) + 1))
+        debug_msg("New segment %s" % path)
+        self.open_segment(path, 0)
+
+    def append(self, columns):
+        # Append a batch of samples, given column by column (column 0 holds the time stamps):
+        count = len(columns[0])
+        ii = 0
+        while ii < count:
+            if self.seg_file is None or self.records >= SEGMENTRECORDS:
+                self.new_segment(columns[0][ii])
+            n = min(count - ii, SEGMENTRECORDS - self.records)
+            records = array('d')
+            index = []
+            for kk in range(ii, ii + n):
+                if (self.records + kk - ii) % INDEXINTERVAL == 0:
+                    index.append(INDEXENTRY.pack(columns[0][kk], self.records + kk - ii))
+                records.extend(column[kk] for column in columns)
+            self.seg_file.write(records.tobytes())
+            if index:
+                self.idx_file.write(b"".join(index))
+            self.records += n
+            ii += n
+        self.flush()
+
+    def flush(self):
+        if self.seg_file is not None:
+            self.seg_file.flush()
+            self.idx_file.flush()
+
+    def sync(self):
+        # Make sure everything appended so far is on the disk itself, not just in the OS cache:
+        if self.seg_file is not None:
+            self.flush()
+            os.fsync(self.seg_file.fileno())
+            os.fsync(self.idx_file.fileno())
+
+    def close(self):
+        if self.seg_file is not None:
+            self.sync()
+            self.seg_file.close()
+            self.idx_file.close()
+            self.seg_file = None
+            self.idx_file = None
+
+
+class RangeView(object):
+    """Records of one IoT ID in a time range, as zero-copy views of the memory-mapped segments
+
+    views is a list of flat memoryviews of doubles, one per segment, each holding whole records of num_values values.
+    """
+    def __init__(self, num_values):
+        self.num_values = num_values
+        self.views = []
+
+    def __len__(self):
+        return sum(len(view) for view in self.views) // self.num_values
+
+    def column(self, jj):
+        # Return the values of column jj, as one strided view per segment:
+        return [view[jj::self.num_values] for view in self.views]
+
+    def rows(self):
+        # Iterate over the records as tuples:
+        n = self.num_values
+        for view in self.views:
+            for ii in range(0, len(view), n):
+                yield tuple(view[ii:ii + n])
+
+    def release(self):
+        # Release the views, so that the segments can be unmapped:
+        for view in self.views:
+            view.release()
+        self.views = []
+
+
+class SegmentStore(object):
+    def __init__(self, directory, num_values):
+        self.directory = directory
+        self.num_values = num_values
+        self.record_size = 8 * num_values
+        # The SegmentWriter of each IoT ID:
+        self.writers = {}
+        # Memory-mapped segments, least recently used first: path -> (records, view, index times, index records)
+        self.mapped = OrderedDict()
+        self.lock = threading.Lock()
+
+    def append(self, IoTID, columns):
+        if IoTID not in self.writers:
+            self.writers[IoTID] = SegmentWriter(self.directory, IoTID, self.num_values)
+        self.writers[IoTID].append(columns)
+
+    def sync(self):
+        for IoTID in self.writers:
+            self.writers[IoTID].sync()
+
+    def close(self):
+        for IoTID in self.writers:
+            self.writers[IoTID].close()
+        self.writers = {}
+
+    def release(self, IoTID):
+        # Close the segment of IoTID, so that another writer can carry on with it:
+        if IoTID in self.writers:
+            self.writers.pop(IoTID).close()
+
+    def devices(self):
+        # Return the IoT IDs that have segments:
+        devices = []
+        seg_dir = os.path.join(self.directory, SEGMENTDIRECTORY)
+        if os.path.isdir(seg_dir):
+            for name in os.listdir(seg_dir):
+                if name.startswith("IoTD") and name[4:].isdigit():
+                    devices.append(int(name[4:]))
+        devices.sort()
+        return devices
+
+    def segments(self, IoTID):
+        return list_segments(device_directory(self.directory, IoTID))
+
+    def last_time(self, IoTID):
+        # Return the time stamp of the last whole record of IoTID, or None if it has none:
+        for start, path in reversed(self.segments(IoTID)):
+            records = os.path.getsize(path + ".seg") // self.record_size
+            if records > 0:
+                with open(path + ".seg", 'rb') as fp:
+                    fp.seek((records - 1) * self.record_size)
+                    return array('d', fp.read(8))[0]
+        return None
+
+    def last_rows(self, IoTID, count):
+        # Return the last count records of IoTID (or all of them if it has fewer) as tuples, in time order:
+        values = array('d')
+        for start, path in reversed(self.segments(IoTID)):
+            needed = count - len(values) // self.num_values
+            if needed <= 0:
+                break
+            records = os.path.getsize(path + ".seg") // self.record_size
+            if records > 0:
+                with open(path + ".seg", 'rb') as fp:
+                    fp.seek(max(0, records - needed) * self.record_size)
+                    chunk = array('d', fp.read(min(records, needed) * self.record_size))
+                chunk.extend(values)
+                values = chunk
+        n = self.num_values
+        return [tuple(values[ii:ii + n]) for ii in range(0, len(values), n)]
+
+    def read_range(self, IoTID, start, stop):
+        # Return a RangeView of the records of IoTID with start <= time stamp < stop:
+        result = RangeView(self.num_values)
+        segments = self.segments(IoTID)
+        starts = [segment[0] for segment in segments]
+        first = max(0, bisect.bisect_right(starts, start) - 1)
+        for ii in range(first, len(segments)):
+            if segments[ii][0] >= stop:
+                break
+            mapped = self.map_segment(segments[ii][1])
+            if mapped is None:
+                continue
+            lo = self.find(mapped, start)
+            hi = self.find(mapped, stop)
+            if hi > lo:
+                result.views.append(mapped[1][lo * self.num_values:hi * self.num_values])
+        return result
+
+    def find(self, mapped, t):
+        # Return the number of records in a mapped segment with a time stamp before t:
+        records, view, index_times, index_records = mapped
+        # The sparse index narrows the search down to INDEXINTERVAL records:
+        k = bisect.bisect_left(index_times, t)
+        lo = min(index_records[k - 1], records) if k > 0 else 0
+        hi = min(index_records[k], records) if k < len(index_times) else records
+        return bisect.bisect_left(view[0::self.num_values], t, lo, hi)
+
+    def map_segment(self, path):
+        # The history requests read from the threads of the executor, one thread at a time maps a segment:
+        with self.lock:
+            records = os.path.getsize(path + ".seg") // self.record_size
+            if path in self.mapped:
+                self.mapped.move_to_end(path)
+                if self.mapped[path][0] == records:
+                    return self.mapped[path]
+            if records == 0:
+                return None
+            with open(path + ".seg", 'rb') as fp:
+                mm = mmap.mmap(fp.fileno(), records * self.record_size, access=mmap.ACCESS_READ)
+            view = memoryview(mm).cast('d')
+            index_times = array('d')
+            index_records = array('Q')
+            if os.path.exists(path + ".idx"):
+                with open(path + ".idx", 'rb') as fp:
+                    data = fp.read()
+                data = data[:len(data) - len(data) % INDEXENTRY.size]
+                for t, record in INDEXENTRY.iter_unpack(data):
+                    index_times.append(t)
+                    index_records.append(record)
+            # The views handed out keep the mapping alive, so old mappings are simply forgotten:
+            self.mapped[path] = (records, view, index_times, index_records)
+            while len(self.mapped) > MAXMAPPED:
+                self.mapped.popitem(last=False)
+            return self.mapped[path]
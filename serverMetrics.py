@@ -0,0 +1,261 @@
+import time
+import bisect
+import tornado.web
+import tornado.ioloop
+""" Operational metrics of the server
+
+FILENAME
+    serverMetrics.py
+
+DESCRIPTION
+    Collects counters, gauges and histograms about the server, and serves them at /metrics in the Prometheus text
+    format. The metrics cover:
+        connections             open connections, and connections opened and closed so far
+        messages and samples    messages received, samples stored per IoTD, and the rates over the last
+                                RATEINTERVAL seconds, overall and per IoTD
+        parse errors            messages that could not be parsed
+        disk flushes            number and duration of the disk writer's rounds of writes, and its queue depth
+        IOLoop lag              how late a timer that should fire every LAGINTERVAL seconds actually fires
+        last seen               the age of the last sample of each IoTD
+    When stage timing is switched on (--stage-timing, or ServerMetrics.stage_timing), every message is also timed
+    through each stage of WSHandler.on_message: parse, store (appending to the sample store), gui (handing the
+    sample to the GUI) and flush (handing data to the disk writer). Stage timing is off by default, it costs a few
+    clock reads per message.
+    All of the metrics are updated on the IOLoop. The disk writer reports its flushes from its own thread, through
+    IOLoop.add_callback.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+# Seconds between IOLoop lag measurements, and between rate calculations:
+LAGINTERVAL = 0.5
+RATEINTERVAL = 10.0
+
+# Histogram buckets, in seconds:
+STAGEBUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.1)
+FLUSHBUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+LAGBUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+STAGES = ("parse", "store", "gui", "flush")
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else "%d" % value
+
+
+class Histogram(object):
+    """A Prometheus histogram, optionally with one label"""
+    def __init__(self, name, help_text, buckets, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label = label
+        # Per label value: [counts per bucket (not cumulative) + the overflow, sum]
+        self.series = {}
+
+    def observe(self, value, label_value=None):
+        series = self.series.get(label_value)
+        if series is None:
+            series = [[0] * (len(self.buckets) + 1), 0.0]
+            self.series[label_value] = series
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def lines(self):
+        yield "# HELP %s %s" % (self.name, self.help_text)
+        yield "# TYPE %s histogram" % self.name
+        for label_value in sorted(self.series, key=str):
+            counts, total = self.series[label_value]
+            labels = "" if self.label is None else '%s="%s",' % (self.label, label_value)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield '%s_bucket{%sle="%s"} %d' % (self.name, labels, format_value(bound), cumulative)
+            labels = "{%s}" % labels.rstrip(",") if labels else ""
+            yield "%s_sum%s %s" % (self.name, labels, repr(total))
+            yield "%s_count%s %d" % (self.name, labels, cumulative)
+
+
+class StageTimer(object):
+    """Times the stages of on_message into a histogram"""
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def start(self):
+        return time.perf_counter()
+
+    def lap(self, stage, since):
+        # Record the time spent in stage since 'since', and return the current time for the next stage:
+        now = time.perf_counter()
+        self.histogram.observe(now - since, stage)
+        return now
+
+
+class ServerMetrics(object):
+    def __init__(self, registry):
+        self.registry = registry
+        self.writer = None
+        self.connections_opened = 0
+        self.connections_closed = 0
+        self.messages = 0
+        self.parse_errors = 0
+        self.rate_limited = 0
+        self.commands_dropped = 0
+        self.idle_reaped = 0
+        self.rules_fired = 0
+        self.flushes = 0
+        # Samples stored, and the time stamp of the last one, per IoT ID:
+        self.samples = {}
+        self.last_seen = {}
+        # Rates over the last RATEINTERVAL seconds:
+        self.message_rate = 0.0
+        self.sample_rates = {}
+        self.rate_snapshot = (time.time(), 0, {})
+        self.lag = 0.0
+        self.flush_histogram = Histogram("iot_flush_duration_seconds", "Duration of the disk writer's rounds of "
+                                         "writes.", FLUSHBUCKETS)
+        self.lag_histogram = Histogram("iot_ioloop_lag_seconds", "How late the IOLoop runs a timer.", LAGBUCKETS)
+        self.stage_histogram = Histogram("iot_stage_duration_seconds", "Time spent in each stage of on_message.",
+                                         STAGEBUCKETS, "stage")
+        # The StageTimer when stage timing is on, else None:
+        self.stage_timer = None
+        self.ioloop = None
+        # The handles of the lag timer and of the rates' PeriodicCallback while started, else None:
+        self.lag_timeout = None
+        self.rates_callback = None
+        registry.listeners.append(self.on_sample)
+
+    @property
+    def stage_timing(self):
+        return self.stage_timer is not None
+
+    @stage_timing.setter
+    def stage_timing(self, on):
+        self.stage_timer = StageTimer(self.stage_histogram) if on else None
+        self.registry.stage_timer = self.stage_timer
+
+    def start(self, ioloop, writer):
+        # Start the periodic measurements on the server's IOLoop, and listen to the flushes of its disk writer:
+        self.ioloop = ioloop
+        self.writer = writer
+        writer.flush_listeners.append(self.on_flush_thread)
+        self.expected = ioloop.time() + LAGINTERVAL
+        self.lag_timeout = ioloop.call_later(LAGINTERVAL, self.measure_lag)
+        self.rates_callback = tornado.ioloop.PeriodicCallback(self.update_rates, RATEINTERVAL * 1000)
+        self.rates_callback.start()
+
+    def stop(self):
+        # Cancel the periodic measurements, and stop listening to the disk writer:
+        if self.lag_timeout is not None:
+            self.ioloop.remove_timeout(self.lag_timeout)
+            self.lag_timeout = None
+        if self.rates_callback is not None:
+            self.rates_callback.stop()
+            self.rates_callback = None
+        if self.writer is not None and self.on_flush_thread in self.writer.flush_listeners:
+            self.writer.flush_listeners.remove(self.on_flush_thread)
+
+    def measure_lag(self):
+        now = self.ioloop.time()
+        self.lag = max(0.0, now - self.expected)
+        self.lag_histogram.observe(self.lag)
+        self.expected = now + LAGINTERVAL
+        self.lag_timeout = self.ioloop.call_later(LAGINTERVAL, self.measure_lag)
+
+    def update_rates(self):
+        now = time.time()
+        then, messages, samples = self.rate_snapshot
+        elapsed = max(now - then, 1e-6)
+        self.message_rate = (self.messages - messages) / elapsed
+        self.sample_rates = {}
+        for IoTID in self.samples:
+            self.sample_rates[IoTID] = (self.samples[IoTID] - samples.get(IoTID, 0)) / elapsed
+        self.rate_snapshot = (now, self.messages, dict(self.samples))
+
+    def on_sample(self, IoTID, timestamp, sample):
+        self.samples[IoTID] = self.samples.get(IoTID, 0) + 1
+        self.last_seen[IoTID] = timestamp
+
+    def on_flush_thread(self, seconds, batches):
+        # Called from the disk writer thread:
+        if self.ioloop is not None:
+            self.ioloop.add_callback(self.on_flush, seconds)
+
+    def on_command_dropped(self):
+        self.commands_dropped += 1
+
+    def on_flush(self, seconds):
+        self.flushes += 1
+        self.flush_histogram.observe(seconds)
+
+    def lines(self):
+        now = time.time()
+        for name, kind, help_text, value in (
+                ("iot_connections", "gauge", "Open connections.", len(self.registry)),
+                ("iot_connections_opened_total", "counter", "Connections opened.", self.connections_opened),
+                ("iot_connections_closed_total", "counter", "Connections closed.", self.connections_closed),
+                ("iot_messages_total", "counter", "Messages received.", self.messages),
+                ("iot_messages_per_second", "gauge", "Messages received per second.", self.message_rate),
+                ("iot_parse_errors_total", "counter", "Messages that could not be parsed.", self.parse_errors),
+                ("iot_rate_limited_total", "counter", "Messages dropped by the inbound rate limit.",
+                 self.rate_limited),
+                ("iot_commands_queued", "gauge", "Outgoing messages waiting in the connection queues.",
+                 sum(len(client.handle.commands) for client in self.registry.clients()
+                     if getattr(client.handle, "commands", None) is not None)),
+                ("iot_commands_dropped_total", "counter", "Outgoing messages dropped by the queue policy.",
+                 self.commands_dropped),
+                ("iot_connections_reaped_total", "counter", "Connections closed for being idle.", self.idle_reaped),
+                ("iot_rules_fired_total", "counter", "Rules that fired, see ruleEngine.py.", self.rules_fired),
+                ("iot_flushes_total", "counter", "Rounds of writes by the disk writer.", self.flushes),
+                ("iot_write_queue_depth", "gauge", "Batches waiting for the disk writer.",
+                 self.writer.queue_depth() if self.writer is not None else 0),
+                ("iot_ioloop_lag_last_seconds", "gauge", "Last measured IOLoop lag.", self.lag)):
+            yield "# HELP %s %s" % (name, help_text)
+            yield "# TYPE %s %s" % (name, kind)
+            yield "%s %s" % (name, format_value(value))
+        for name, kind, help_text, values in (
+                ("iot_samples_total", "counter", "Samples stored per IoTD.", self.samples),
+                ("iot_samples_per_second", "gauge", "Samples stored per second per IoTD.", self.sample_rates),
+                ("iot_last_seen_age_seconds", "gauge", "Seconds since the last sample of each IoTD.",
+                 dict((IoTID, now - self.last_seen[IoTID]) for IoTID in self.last_seen))):
+            yield "# HELP %s %s" % (name, help_text)
+            yield "# TYPE %s %s" % (name, kind)
+            for IoTID in sorted(values):
+                yield '%s{iotd="%d"} %s' % (name, IoTID, format_value(values[IoTID]))
+        for histogram in (self.flush_histogram, self.lag_histogram, self.stage_histogram):
+            for line in histogram.lines():
+                yield line
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, metrics):
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write("\n".join(self.metrics.lines()) + "\n")
@@ -0,0 +1,132 @@
+import json
+import asyncio
+import unittest
+import tornado.ioloop
+import tornado.iostream
+import clusterServer
+import mbedWSClient
+""" Tests of the hold/grant/release handshake of clusterServer.py
+
+FILENAME
+    tests/test_clusterServer.py
+
+DESCRIPTION
+    The coordinator and the worker link are driven with streams that only record what is written to them, or replay
+    the given lines.
+"""
+
+
+class RecordingStream(object):
+    def __init__(self, lines=(), hang=False):
+        self.messages = []
+        self.lines = list(lines)
+        # When hang is set, the stream stays open after the lines until hang_up() is called:
+        self.hang = hang
+        self.hung_up = asyncio.Event()
+
+    def write(self, data):
+        self.messages.append(json.loads(data.decode("utf-8")))
+
+    def closed(self):
+        return False
+
+    def close(self):
+        pass
+
+    async def read_until(self, delimiter):
+        if not self.lines:
+            if self.hang:
+                await self.hung_up.wait()
+            raise tornado.iostream.StreamClosedError()
+        return (json.dumps(self.lines.pop(0)) + "\n").encode("utf-8")
+
+
+class CoordinatorTest(unittest.TestCase):
+    def setUp(self):
+        clusterServer.INFOMSG = 0
+        self.coordinator = clusterServer.Coordinator()
+        self.streams = {1: RecordingStream(), 2: RecordingStream()}
+        self.coordinator.workers.update(self.streams)
+
+    def test_first_bind_is_granted(self):
+        self.coordinator.bind(7, 1)
+        self.assertEqual(self.streams[1].messages, [{"op": "grant", "id": 7}])
+        self.assertEqual(self.coordinator.owners, {7: 1})
+
+    def test_move_waits_for_release(self):
+        self.coordinator.bind(7, 1)
+        self.coordinator.bind(7, 2)
+        self.coordinator.bind(7, 2)
+        # The owner is asked once, and the new worker is not granted before the owner let go:
+        self.assertEqual(self.streams[1].messages[1:], [{"op": "release", "id": 7}])
+        self.assertEqual(self.streams[2].messages, [])
+        self.coordinator.released(7, 1)
+        self.assertEqual(self.streams[2].messages, [{"op": "grant", "id": 7}])
+        self.assertEqual(self.coordinator.owners, {7: 2})
+        self.assertEqual(self.coordinator.waiting, {})
+
+    def test_owner_gone_grants_at_once(self):
+        self.coordinator.bind(7, 1)
+        del self.coordinator.workers[1]
+        self.coordinator.bind(7, 2)
+        self.assertEqual(self.streams[2].messages, [{"op": "grant", "id": 7}])
+
+
+class WorkerLinkTest(unittest.TestCase):
+    def setUp(self):
+        clusterServer.INFOMSG = 0
+        self.registry = mbedWSClient.DeviceRegistry()
+        self.link = clusterServer.WorkerLink(1, None, None, self.registry)
+        self.reconnects = 0
+
+    async def reconnect(self):
+        self.reconnects += 1
+
+    def test_bind_without_coordinator_is_not_held(self):
+        self.registry.bind_callback(7)
+        self.assertEqual(self.registry.held, set())
+        self.assertEqual(self.link.owned, {7})
+
+    def test_bind_is_held_until_granted(self):
+        self.link.stream = RecordingStream([{"op": "grant", "id": 7}])
+        self.link.connected = True
+        self.link.connect = self.reconnect
+        self.registry.bind_callback(7)
+        self.registry.bind_callback(7)
+        self.assertEqual(self.registry.held, {7})
+        self.assertEqual(self.link.stream.messages, [{"op": "bind", "id": 7}])
+        tornado.ioloop.IOLoop.current().run_sync(self.link.read_loop)
+        self.assertEqual(self.registry.held, set())
+
+    def test_lost_coordinator_releases_the_hold(self):
+        self.link.stream = RecordingStream()
+        self.link.connected = True
+        self.link.connect = self.reconnect
+        self.registry.bind_callback(7)
+        tornado.ioloop.IOLoop.current().run_sync(self.link.read_loop)
+        self.assertEqual(self.registry.held, set())
+        self.assertFalse(self.link.connected)
+        self.assertEqual(self.reconnects, 1)
+
+    def test_release(self):
+        stream = RecordingStream([{"op": "release", "id": 7}], hang=True)
+        self.link.stream = stream
+        self.link.connected = True
+        self.link.connect = self.reconnect
+        self.registry.bind_callback(7)
+
+        async def run():
+            reading = asyncio.ensure_future(self.link.read_loop())
+            # The released message is written from a callback:
+            while stream.messages[-1]["op"] != "released":
+                await asyncio.sleep(0.001)
+            stream.hung_up.set()
+            await reading
+
+        tornado.ioloop.IOLoop.current().run_sync(run, timeout=5)
+        self.assertEqual(self.link.owned, set())
+        self.assertEqual(stream.messages, [{"op": "bind", "id": 7}, {"op": "released", "id": 7}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import math
+import shutil
+import tempfile
+import unittest
+from array import array
+from datetime import date
+import dayArchive
+import diskWriter
+""" Tests of dayArchive.py
+
+FILENAME
+    tests/test_dayArchive.py
+
+DESCRIPTION
+    The archives are written to a temporary directory and read back.
+"""
+
+# A time stamp on the day of the files (2016-10-24):
+NOON = 1477303200.0
+
+
+def write_csv(filename, columns):
+    lines = diskWriter.format_rows(columns)
+    lines.append("")
+    with open(filename, 'w') as fp:
+        fp.write("\n".join(lines))
+
+
+def make_columns(first, count):
+    times = array('d', (NOON + ii * 3.0 for ii in range(first, first + count)))
+    return [times, array('d', (float(ii) for ii in range(first, first + count))),
+            array('d', (20.0 + ii * 0.125 for ii in range(first, first + count)))]
+
+
+class EncodingTest(unittest.TestCase):
+    def test_shuffle(self):
+        data = bytes(range(64))
+        self.assertEqual(dayArchive.unshuffle(dayArchive.shuffle(data)), data)
+
+    def test_scaled_column(self):
+        column = array('d', (1477303200.123456 + ii * 3.000001 for ii in range(100)))
+        scale, data = dayArchive.encode_column(column)
+        self.assertEqual(scale, dayArchive.SCALE)
+        for value, decoded in zip(column, dayArchive.decode_column(scale, data)):
+            self.assertAlmostEqual(value, decoded, places=6)
+
+    def test_raw_column(self):
+        column = array('d', [1.5, float("nan"), float("inf")])
+        scale, data = dayArchive.encode_column(column)
+        self.assertEqual(scale, 0.0)
+        decoded = dayArchive.decode_column(scale, data)
+        self.assertEqual(decoded[0], 1.5)
+        self.assertTrue(math.isnan(decoded[1]))
+        self.assertEqual(decoded[2], float("inf"))
+
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        dayArchive.INFOMSG = 0
+        self.directory = tempfile.mkdtemp()
+        day = date.fromtimestamp(NOON).strftime("%Y%m%d")
+        self.csv_file = os.path.join(self.directory, "IoTD001_%s.csv" % day)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_and_read(self):
+        archive = os.path.join(self.directory, "IoTD001_20161024.iotz")
+        columns = make_columns(0, 50)
+        dayArchive.write_archive(archive, columns)
+        # Only the archive is left, the temporary file was renamed:
+        self.assertEqual(os.listdir(self.directory), ["IoTD001_20161024.iotz"])
+        self.assertEqual(dayArchive.read_columns(archive), columns)
+        self.assertEqual(len(dayArchive.read_columns(archive, 1)), 1)
+
+    def test_damaged_archive(self):
+        archive = os.path.join(self.directory, "IoTD001_20161024.iotz")
+        with open(archive, 'wb') as fp:
+            fp.write(b"CSV!" + bytes(20))
+        with self.assertRaises(ValueError):
+            dayArchive.read_columns(archive)
+
+    def test_archive_file_replaces_the_csv(self):
+        write_csv(self.csv_file, make_columns(0, 20))
+        expected = list(diskWriter.read_csv_file(self.csv_file))
+        dayArchive.archive_file(self.csv_file)
+        self.assertFalse(os.path.exists(self.csv_file))
+        self.assertEqual(list(dayArchive.read_day(self.csv_file)), expected)
+
+    def test_late_samples_are_merged(self):
+        write_csv(self.csv_file, make_columns(0, 20))
+        dayArchive.archive_file(self.csv_file)
+        write_csv(self.csv_file, make_columns(15, 10))
+        dayArchive.archive_file(self.csv_file)
+        rows = list(dayArchive.read_day(self.csv_file))
+        self.assertEqual([row[1] for row in rows], [float(ii) for ii in range(25)])
+
+    def test_closed_days(self):
+        write_csv(self.csv_file, make_columns(0, 2))
+        day = date.fromtimestamp(NOON)
+        self.assertEqual(dayArchive.closed_days(self.directory, day), [])
+        self.assertEqual(dayArchive.closed_days(self.directory, date(day.year + 1, 1, 1)), [self.csv_file])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import downsample
+""" Tests of downsample.py
+
+FILENAME
+    tests/test_downsample.py
+
+DESCRIPTION
+    Run from the top directory of the repository with:
+        python -m unittest
+"""
+
+
+class BucketTest(unittest.TestCase):
+    def test_bucket_index_clamps(self):
+        self.assertEqual(downsample.bucket_index(-5.0, 0.0, 10.0, 5), 0)
+        self.assertEqual(downsample.bucket_index(3.9, 0.0, 10.0, 5), 1)
+        self.assertEqual(downsample.bucket_index(10.0, 0.0, 10.0, 5), 4)
+
+    def test_bucket_mean(self):
+        samples = [(0.0, 1.0), (1.0, 3.0), (5.0, 10.0), (9.0, 20.0)]
+        rows = list(downsample.bucket_mean(samples, 0.0, 10.0, 2))
+        self.assertEqual(rows, [(0.5, 2.0), (7.0, 15.0)])
+
+    def test_bucket_mean_skips_empty_buckets(self):
+        rows = list(downsample.bucket_mean([(0.0, 1.0), (9.0, 2.0)], 0.0, 10.0, 10))
+        self.assertEqual(rows, [(0.0, 1.0), (9.0, 2.0)])
+
+    def test_bucket_minmax(self):
+        samples = [(0.0, 5.0, 1.0), (1.0, 2.0, 7.0), (2.0, 9.0, 4.0), (6.0, 3.0, 3.0)]
+        rows = list(downsample.bucket_minmax(samples, 0.0, 10.0, 2))
+        self.assertEqual(rows, [(0.0, 2.0, 9.0, 1.0, 7.0), (5.0, 3.0, 3.0, 3.0, 3.0)])
+
+
+class LttbTest(unittest.TestCase):
+    def test_short_series_is_kept(self):
+        self.assertEqual(downsample.lttb([0, 1, 2], [5, 6, 7], 10), [0, 1, 2])
+
+    def test_too_few_points_keeps_the_ends(self):
+        self.assertEqual(downsample.lttb(list(range(10)), [0] * 10, 2), [0, 9])
+        self.assertEqual(downsample.lttb(list(range(10)), [0] * 10, 1), [0])
+
+    def test_picks_points_in_order(self):
+        x = list(range(1000))
+        y = [(ii * 37) % 101 for ii in x]
+        picked = downsample.lttb(x, y, 50)
+        self.assertEqual(len(picked), 50)
+        self.assertEqual(picked[0], 0)
+        self.assertEqual(picked[-1], 999)
+        self.assertEqual(picked, sorted(set(picked)))
+
+    def test_keeps_a_spike(self):
+        x = list(range(100))
+        y = [0.0] * 100
+        y[42] = 100.0
+        self.assertIn(42, downsample.lttb(x, y, 10))
+
+
+class RollingMinMaxTest(unittest.TestCase):
+    def test_view(self):
+        history = downsample.RollingMinMax(10.0, 10, 1)
+        for t, value in ((0.5, 3.0), (0.7, 1.0), (1.5, 4.0), (9.5, 2.0)):
+            history.add((t, value))
+        self.assertEqual(history.view(10), [(0, 1.0, 3.0), (1, 4.0, 4.0), (9, 2.0, 2.0)])
+
+    def test_old_buckets_leave_the_span(self):
+        history = downsample.RollingMinMax(10.0, 10, 1)
+        history.add((0.5, 3.0))
+        history.add((10.5, 5.0))
+        self.assertEqual(history.view(10), [(9, 5.0, 5.0)])
+
+    def test_add_earlier_matches_add_in_order(self):
+        samples = [(0.2 * ii, float((ii * 7) % 11)) for ii in range(60)]
+        in_order = downsample.RollingMinMax(10.0, 10, 1)
+        for sample in samples:
+            in_order.add(sample)
+        late = downsample.RollingMinMax(10.0, 10, 1)
+        for sample in samples[40:]:
+            late.add(sample)
+        for sample in reversed(samples[:40]):
+            late.add_earlier(sample)
+        self.assertEqual(late.view(5), in_order.view(5))
+
+
+if __name__ == "__main__":
+    unittest.main()
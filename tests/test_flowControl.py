@@ -0,0 +1,58 @@
+import unittest
+from unittest import mock
+import flowControl
+""" Tests of the inbound rate limit of flowControl.py
+
+FILENAME
+    tests/test_flowControl.py
+
+DESCRIPTION
+    The token bucket is driven with a fake clock.
+"""
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_starts_full(self):
+        bucket = flowControl.TokenBucket(10.0, 50.0)
+        self.assertTrue(bucket.ready())
+        self.assertEqual(bucket.tokens, 50.0)
+
+    def test_debt_waits_for_the_refill(self):
+        bucket = flowControl.TokenBucket(10.0, 50.0)
+        bucket.take(70)
+        self.assertFalse(bucket.ready())
+        self.now += 1.5
+        self.assertFalse(bucket.ready())
+        self.assertAlmostEqual(bucket.tokens, -5.0)
+        self.now += 1.0
+        self.assertTrue(bucket.ready())
+        self.assertAlmostEqual(bucket.tokens, 5.0)
+
+    def test_refill_stops_at_the_burst(self):
+        bucket = flowControl.TokenBucket(10.0, 50.0)
+        bucket.take(20)
+        self.now += 60.0
+        self.assertTrue(bucket.ready())
+        self.assertEqual(bucket.tokens, 50.0)
+
+    def test_no_limit(self):
+        bucket = flowControl.TokenBucket(0.0, 1.0)
+        bucket.take(1000)
+        self.assertTrue(bucket.ready())
+
+
+class CommandKeyTest(unittest.TestCase):
+    def test_key(self):
+        self.assertEqual(flowControl.command_key("1,0.5"), "1")
+        self.assertEqual(flowControl.command_key(" led "), "led")
+        self.assertIsNone(flowControl.command_key(b"\x01"))
+
+
+if __name__ == "__main__":
+    unittest.main()
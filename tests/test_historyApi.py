@@ -0,0 +1,66 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from array import array
+from datetime import date
+from types import SimpleNamespace
+import diskWriter
+import historyApi
+import mbedWSClient
+import sampleStore
+""" Tests of the reading of the history in historyApi.py
+
+FILENAME
+    tests/test_historyApi.py
+
+DESCRIPTION
+    An IoTD has an hour of samples in its .csv file, and keeps the last RETAINED of them in memory.
+"""
+
+IOTID = 5
+COUNT = 360
+RETAINED = 100
+
+
+class IterHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = mbedWSClient.DATADIRECTORY
+        mbedWSClient.DATADIRECTORY = tempfile.mkdtemp() + os.sep
+        # One sample every 10 seconds from 10:00 today:
+        self.base = time.mktime(date.today().timetuple()) + 10 * 3600
+        columns = [array('d', (self.base + 10.0 * ii for ii in range(COUNT))),
+                   array('d', (float(ii) for ii in range(COUNT))), array('d', [20.0] * COUNT)]
+        lines = diskWriter.format_rows(columns)
+        lines.append("")
+        with open(mbedWSClient.csv_filename(IOTID, date.today()), 'w') as fp:
+            fp.write("\n".join(lines))
+        store = sampleStore.SampleStore(mbedWSClient.MAXVALUES, RETAINED)
+        for row in zip(*columns):
+            store.append(row)
+        store.mark_saved()
+        self.registry = mbedWSClient.DeviceRegistry()
+        self.registry.data[IOTID] = SimpleNamespace(store=store)
+
+    def tearDown(self):
+        shutil.rmtree(mbedWSClient.DATADIRECTORY)
+        mbedWSClient.DATADIRECTORY = self.directory
+
+    def counters(self, start, stop):
+        return [row[1] for row in historyApi.iter_history(IOTID, start, stop, self.registry)]
+
+    def test_range_before_the_memory(self):
+        # Regression: the files were read up to the oldest sample in memory, past the end of the range:
+        self.assertEqual(self.counters(self.base, self.base + 600.0), [float(ii) for ii in range(60)])
+
+    def test_range_across_the_memory(self):
+        self.assertEqual(self.counters(self.base + 2000.0, self.base + 3000.0), [float(ii) for ii in range(200, 300)])
+
+    def test_range_in_the_memory(self):
+        self.assertEqual(self.counters(self.base + 3500.0, self.base + 4000.0),
+                         [float(ii) for ii in range(350, COUNT)])
+
+
+if __name__ == "__main__":
+    unittest.main()
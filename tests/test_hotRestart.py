@@ -0,0 +1,95 @@
+import os
+import json
+import socket
+import shutil
+import tempfile
+import threading
+import unittest
+import tornado.ioloop
+import hotRestart
+import mbedWSClient
+""" Tests of the new server's side of hotRestart.py
+
+FILENAME
+    tests/test_hotRestart.py
+
+DESCRIPTION
+    A thread plays the running server on a Unix socket: it hands over a listening socket and a state, then sends the
+    given messages and hangs up.
+"""
+
+
+class TakeoverTest(unittest.TestCase):
+    def setUp(self):
+        hotRestart.INFOMSG = 0
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "handoff")
+        self.listening = socket.create_server(("127.0.0.1", 0))
+        self.registry = mbedWSClient.DeviceRegistry()
+
+    def tearDown(self):
+        self.listening.close()
+        shutil.rmtree(self.directory)
+
+    def old_server(self, state, messages=()):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(1)
+
+        def run():
+            connection, address = server.accept()
+            socket.send_fds(connection, [b"IOTH"], [self.listening.fileno()])
+            data = json.dumps(state).encode("utf-8")
+            connection.sendall(hotRestart.LENGTH.pack(len(data)) + data)
+            for msg in messages:
+                connection.sendall((json.dumps(msg) + "\n").encode("utf-8"))
+            connection.close()
+            server.close()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def take_over(self):
+        takeover = hotRestart.Takeover(self.path)
+        for sock in takeover.sockets:
+            self.addCleanup(sock.close)
+        return takeover
+
+    def test_takes_the_sockets_and_holds_the_ids(self):
+        self.old_server({"pid": 12, "ids": [3, 4], "groups": {"lab": [3]}})
+        takeover = self.take_over()
+        self.assertEqual(len(takeover.sockets), 1)
+        self.assertEqual(takeover.sockets[0].getsockname(), self.listening.getsockname())
+        takeover.apply(self.registry)
+        self.assertEqual(self.registry.held, {3, 4})
+        self.assertEqual(self.registry.groups, {"lab": {3}})
+
+    def test_released_ids_are_granted_with_their_samples(self):
+        recent = [[100.0, 1.0, 20.5], [103.0, 2.0, 20.75]]
+        self.old_server({"pid": 12, "ids": [3, 4], "groups": {}}, [{"op": "released", "id": 3, "recent": recent}])
+        takeover = self.take_over()
+        takeover.apply(self.registry)
+        tornado.ioloop.IOLoop.current().run_sync(takeover.read_loop)
+        # IoTD 4 is granted when the old server hangs up:
+        self.assertEqual(self.registry.held, set())
+        self.assertEqual(self.registry.handed, {3: [(100.0, 1.0, 20.5), (103.0, 2.0, 20.75)]})
+
+    def test_bad_state(self):
+        self.old_server({"pid": 12, "ids": 3})
+        with self.assertRaises(ValueError):
+            self.take_over()
+
+
+class StoreRowsTest(unittest.TestCase):
+    def test_rows_in_memory(self):
+        store = mbedWSClient.sampleStore.SampleStore(3, 2)
+        for ii in range(5):
+            store.append((float(ii), float(ii), 20.0))
+        # The last two are kept, the last one is not saved yet:
+        store.mark_saved(4)
+        self.assertEqual(hotRestart.store_rows(store), [[3.0, 3.0, 20.0], [4.0, 4.0, 20.0]])
+
+
+if __name__ == "__main__":
+    unittest.main()
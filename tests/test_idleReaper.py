@@ -0,0 +1,86 @@
+import unittest
+import tornado.websocket
+import idleReaper
+""" Tests of the timer wheel of idleReaper.py
+
+FILENAME
+    tests/test_idleReaper.py
+
+DESCRIPTION
+    The wheel is turned by hand, one tick at a time, over handlers that record the pings and the close.
+"""
+
+
+class FakeHandler(object):
+    def __init__(self, closing=False):
+        self.pings = []
+        self.closed = None
+        self.closing = closing
+
+    def ping(self, data):
+        if self.closing:
+            raise tornado.websocket.WebSocketClosedError()
+        self.pings.append(data)
+
+    def close(self, code=None, reason=None):
+        self.closed = (code, reason)
+
+
+class HeartbeatWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.reaped = []
+        # Ping after 2 quiet seconds, close after 5, one tick per second:
+        self.wheel = idleReaper.HeartbeatWheel(2.0, 5.0, 1.0, on_reap=self.reaped.append)
+
+    def turn(self, ticks):
+        for ii in range(ticks):
+            self.wheel.advance()
+
+    def test_quiet_connection_is_pinged_then_reaped(self):
+        handler = FakeHandler()
+        self.wheel.add(handler)
+        self.turn(2)
+        self.assertEqual(len(handler.pings), 1)
+        self.turn(2)
+        self.assertEqual(len(handler.pings), 2)
+        self.assertIsNone(handler.closed)
+        self.turn(1)
+        self.assertEqual(handler.closed, (1001, "idle"))
+        self.assertEqual(self.reaped, [handler])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_touch_postpones_the_deadline(self):
+        handler = FakeHandler()
+        self.wheel.add(handler)
+        for ii in range(20):
+            self.wheel.advance()
+            self.wheel.touch(handler)
+        self.assertEqual(handler.pings, [])
+        self.assertIsNone(handler.closed)
+        self.turn(5)
+        self.assertEqual(self.reaped, [handler])
+
+    def test_removed_connection_is_left_alone(self):
+        handler = FakeHandler()
+        self.wheel.add(handler)
+        self.wheel.remove(handler)
+        self.turn(10)
+        self.assertEqual(handler.pings, [])
+        self.assertIsNone(handler.closed)
+
+    def test_closing_connection_is_dropped(self):
+        handler = FakeHandler(closing=True)
+        self.wheel.add(handler)
+        self.turn(10)
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.reaped, [])
+
+    def test_disabled(self):
+        wheel = idleReaper.HeartbeatWheel(0.0, 0.0, 1.0)
+        wheel.add(FakeHandler())
+        self.assertFalse(wheel.enabled())
+        self.assertEqual(len(wheel), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+import downsample
+import rollupStore
+""" Tests of rollupStore.py
+
+FILENAME
+    tests/test_rollupStore.py
+
+DESCRIPTION
+    The rollups are checked against the statistics of the raw samples.
+"""
+
+NUMVALUES = 3
+
+
+def make_samples(start, count, step):
+    # (time, counter, temperature) samples, step seconds apart:
+    return [(start + ii * step, float(ii), 20.0 + (ii * 7) % 5) for ii in range(count)]
+
+
+def roll(samples):
+    # The records of the minute tier, with the open bucket closed:
+    rollups = rollupStore.RollupSet(NUMVALUES)
+    for sample in samples:
+        rollups.add(sample)
+    rollups.close()
+    return rollups.take_pending()["minute"]
+
+
+class RollupTest(unittest.TestCase):
+    def test_buckets_match_the_samples(self):
+        samples = make_samples(6000.0, 50, 7.0)
+        buckets = list(rollupStore.merge(roll(samples), NUMVALUES))
+        self.assertEqual(len(buckets), len(set(sample[0] // 60 for sample in samples)))
+        for bucket in buckets:
+            inside = [sample for sample in samples if bucket[0] <= sample[0] < bucket[0] + 60]
+            self.assertEqual(bucket[1], len(inside))
+            for jj in range(NUMVALUES):
+                values = [sample[jj] for sample in inside]
+                kk = 2 + rollupStore.STATS * jj
+                self.assertEqual(bucket[kk:kk + rollupStore.STATS], [sum(values), min(values), max(values), values[-1]])
+
+    def test_merge_joins_a_bucket_written_twice(self):
+        # A restart within a bucket writes it twice:
+        samples = make_samples(6000.0, 20, 5.0)
+        records = roll(samples[:7])
+        records.extend(roll(samples[7:]))
+        self.assertEqual(list(rollupStore.merge(records, NUMVALUES)), list(rollupStore.merge(roll(samples), NUMVALUES)))
+
+    def test_merge_range(self):
+        records = roll(make_samples(6000.0, 40, 10.0))
+        starts = [bucket[0] for bucket in rollupStore.merge(records, NUMVALUES, 6060.0, 6240.0)]
+        self.assertEqual(starts, [6060.0, 6120.0, 6180.0])
+
+    def test_recent_includes_the_open_bucket(self):
+        rollups = rollupStore.RollupSet(NUMVALUES)
+        for sample in make_samples(6000.0, 10, 10.0):
+            rollups.add(sample)
+        starts = [bucket[0] for bucket in rollupStore.merge(rollups.recent("minute"), NUMVALUES)]
+        self.assertEqual(starts, [6000.0, 6060.0])
+
+    def test_bucket_mean_matches_the_samples(self):
+        samples = make_samples(6000.0, 120, 5.0)
+        buckets = rollupStore.merge(roll(samples), NUMVALUES)
+        expected = list(downsample.bucket_mean(samples, 6000.0, 6600.0, 5))
+        for row, want in zip(rollupStore.bucket_mean(buckets, 6000.0, 6600.0, 5), expected):
+            for value, wanted in zip(row, want):
+                self.assertAlmostEqual(value, wanted)
+
+    def test_bucket_minmax_matches_the_samples(self):
+        samples = make_samples(6000.0, 120, 5.0)
+        buckets = rollupStore.merge(roll(samples), NUMVALUES)
+        self.assertEqual(list(rollupStore.bucket_minmax(buckets, 6000.0, 6600.0, 5)),
+                         list(downsample.bucket_minmax(samples, 6000.0, 6600.0, 5)))
+
+
+class RollupStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = rollupStore.RollupStore(self.directory, NUMVALUES)
+        filename = rollupStore.rollup_filename(self.directory, "minute", 3)
+        os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as fp:
+            roll(make_samples(6000.0, 60, 10.0)).tofile(fp)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_range(self):
+        records = self.store.read(3, "minute", 6100.0, 6300.0)
+        self.assertIsInstance(records, array)
+        starts = [bucket[0] for bucket in rollupStore.merge(records, NUMVALUES)]
+        self.assertEqual(starts, [6120.0, 6180.0, 6240.0])
+
+    def test_covers(self):
+        self.assertTrue(self.store.covers(3, "minute", 6000.0))
+        self.assertFalse(self.store.covers(3, "minute", 5999.0))
+        self.assertFalse(self.store.covers(4, "minute", 6000.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
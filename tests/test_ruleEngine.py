@@ -0,0 +1,135 @@
+import os
+import json
+import math
+import random
+import tempfile
+import unittest
+import mbedWSClient
+import ruleEngine
+""" Tests of ruleEngine.py
+
+FILENAME
+    tests/test_ruleEngine.py
+
+DESCRIPTION
+    The windowed statistics are checked against a direct computation over the same samples, and the rules are fed
+    samples through the listeners of a DeviceRegistry.
+"""
+
+
+class RollingWindowTest(unittest.TestCase):
+    def check(self, window, expected):
+        self.assertEqual(len(window), len(expected))
+        mean = sum(expected) / len(expected)
+        self.assertAlmostEqual(window.mean(), mean)
+        self.assertAlmostEqual(window.stddev(), math.sqrt(sum((value - mean) ** 2 for value in expected) /
+                                                          len(expected)), places=6)
+        self.assertEqual(window.maximum(), max(expected))
+        self.assertEqual(window.minimum(), min(expected))
+
+    def test_samples_window(self):
+        generator = random.Random(1)
+        window = ruleEngine.RollingWindow(samples=10)
+        values = []
+        for ii in range(200):
+            value = 1000.0 + generator.uniform(-5.0, 5.0)
+            values.append(value)
+            window.add(float(ii), value)
+            self.assertEqual(window.ready(), len(values) >= 10)
+            self.check(window, values[-10:])
+
+    def test_seconds_window(self):
+        generator = random.Random(2)
+        window = ruleEngine.RollingWindow(seconds=30.0)
+        samples = []
+        timestamp = 0.0
+        for ii in range(200):
+            timestamp += generator.uniform(0.5, 6.0)
+            samples.append((timestamp, generator.choice((1.0, 2.0, 2.0, 3.0)) * ii))
+            window.add(*samples[-1])
+            self.check(window, [value for t, value in samples if timestamp - t <= 30.0])
+
+
+class LoadRulesTest(unittest.TestCase):
+    def load(self, specs):
+        handle, filename = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(handle, 'w') as fp:
+            json.dump(specs, fp)
+        self.addCleanup(os.remove, filename)
+        return ruleEngine.load_rules(filename)
+
+    def test_load(self):
+        rules = self.load([{"when": "above", "limit": 30}, {"name": "noisy", "when": "stddev_above", "limit": 2.5,
+                                                             "samples": 20, "ids": [1, 2], "send": "alarm",
+                                                             "to": "All"}])
+        self.assertEqual([rule.name for rule in rules], ["above", "noisy"])
+        self.assertEqual(rules[1].ids, {1, 2})
+        self.assertEqual(rules[1].to, -1)
+
+    def test_bad_rules_raise_value_error(self):
+        for specs in ([{"when": "above", "limit": 30}, {"when": "above", "limit": [1]}],
+                      [{"when": "above", "limit": 30}, {"when": "mean_above", "limit": 1, "samples": "5"}],
+                      [{"when": "above", "limit": 30}, {"when": "above", "limit": 1, "ids": ["a"]}],
+                      [{"when": "above", "limit": 30}, {"when": "above", "limit": 1, "colour": "red"}],
+                      [{"when": "above", "limit": 30}, {"when": "mean_above", "limit": 1}],
+                      [{"when": "above", "limit": 30}, ["above"]]):
+            with self.assertRaisesRegex(ValueError, "item 1 "):
+                self.load(specs)
+        with self.assertRaises(ValueError):
+            self.load({"when": "above"})
+
+
+class RuleEngineTest(unittest.TestCase):
+    def setUp(self):
+        ruleEngine.INFOMSG = 0
+        self.registry = mbedWSClient.DeviceRegistry()
+        self.sent = []
+        self.events = []
+
+    def engine(self, specs):
+        engine = ruleEngine.RuleEngine(self.registry, [ruleEngine.parse_rule(spec) for spec in specs],
+                                       send=lambda adr, cmd: self.sent.append((adr, cmd)))
+        engine.callbacks.append(lambda name, IoTID, event, value, timestamp: self.events.append((name, IoTID, event)))
+        return engine
+
+    def feed(self, IoTID, temperatures, start=0.0, step=1.0):
+        for ii, temperature in enumerate(temperatures):
+            timestamp = start + ii * step
+            for listener in self.registry.listeners:
+                listener(IoTID, timestamp, (timestamp, float(ii), temperature))
+
+    def test_fires_once_and_clears(self):
+        self.engine([{"name": "hot", "when": "above", "limit": 30, "send": "fan,1"}])
+        self.feed(1, [20.0, 31.0, 32.0, 25.0])
+        self.assertEqual(self.events, [("hot", 1, "fired"), ("hot", 1, "cleared")])
+        self.assertEqual(self.sent, [(1, "fan,1")])
+
+    def test_mean_needs_a_full_window(self):
+        self.engine([{"name": "warm", "when": "mean_above", "limit": 25, "samples": 3}])
+        self.feed(1, [40.0, 40.0])
+        self.assertEqual(self.events, [])
+        self.feed(1, [40.0, 40.0, 40.0])
+        self.assertEqual(self.events, [("warm", 1, "fired")])
+
+    def test_rate(self):
+        self.engine([{"name": "rising", "when": "rate_above", "limit": 1.0}])
+        self.feed(1, [20.0, 20.5, 23.0, 23.5], step=1.0)
+        self.assertEqual(self.events, [("rising", 1, "fired"), ("rising", 1, "cleared")])
+
+    def test_rules_apply_to_their_ids(self):
+        self.engine([{"name": "hot", "when": "above", "limit": 30, "ids": [2]}])
+        self.feed(1, [40.0])
+        self.feed(2, [40.0])
+        self.assertEqual(self.events, [("hot", 2, "fired")])
+
+    def test_missing(self):
+        engine = self.engine([{"name": "quiet", "when": "missing", "seconds": 10}])
+        self.feed(1, [20.0], start=0.0)
+        self.feed(2, [20.0], start=8.0)
+        self.assertEqual(engine.trackers[engine.rules[0]].expired(12.0), [(1, 0.0)])
+        self.feed(1, [20.0], start=13.0)
+        self.assertEqual(self.events, [("quiet", 1, "cleared")])
+
+
+if __name__ == "__main__":
+    unittest.main()
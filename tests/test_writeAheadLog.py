@@ -0,0 +1,79 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from datetime import date
+import diskWriter
+import mbedWSClient
+import writeAheadLog
+""" Tests of the recovery of writeAheadLog.py
+
+FILENAME
+    tests/test_writeAheadLog.py
+
+DESCRIPTION
+    Each test logs samples to a log in a temporary data directory, then replays it with recover() as the next start
+    of the server would.
+"""
+
+
+class RecoverTest(unittest.TestCase):
+    def setUp(self):
+        writeAheadLog.INFOMSG = 0
+        diskWriter.INFOMSG = 0
+        self.directory = mbedWSClient.DATADIRECTORY
+        mbedWSClient.DATADIRECTORY = tempfile.mkdtemp() + os.sep
+        # Noon today, so that the samples are all in the file of one day:
+        self.noon = time.mktime(date.today().timetuple()) + 12 * 3600
+
+    def tearDown(self):
+        shutil.rmtree(mbedWSClient.DATADIRECTORY)
+        mbedWSClient.DATADIRECTORY = self.directory
+
+    def log(self, IoTID, first, count):
+        # Log count samples of IoTID, one per second from first seconds after noon:
+        wal = writeAheadLog.WriteAheadLog()
+        wal.start()
+        for ii in range(first, first + count):
+            wal.append(IoTID, (self.noon + ii, float(ii), 20.0 + ii))
+        wal.stop()
+
+    def saved(self, IoTID):
+        filename = mbedWSClient.csv_filename(IoTID, date.today())
+        if not os.path.exists(filename):
+            return []
+        return [row[1] for row in diskWriter.read_csv_file(filename)]
+
+    def test_recovers_the_samples_and_deletes_the_log(self):
+        self.log(3, 0, 10)
+        self.assertEqual(writeAheadLog.recover(), 10)
+        self.assertEqual(self.saved(3), [float(ii) for ii in range(10)])
+        self.assertEqual(writeAheadLog.list_files(), [])
+        self.assertEqual(writeAheadLog.recover(), 0)
+
+    def test_skips_the_samples_already_saved(self):
+        self.log(3, 0, 10)
+        writeAheadLog.recover()
+        self.log(3, 5, 10)
+        self.assertEqual(writeAheadLog.recover(), 5)
+        self.assertEqual(self.saved(3), [float(ii) for ii in range(15)])
+
+    def test_stops_at_a_cut_group(self):
+        self.log(3, 0, 4)
+        self.log(4, 0, 4)
+        path = writeAheadLog.list_files()[-1][2]
+        with open(path, 'rb+') as fp:
+            fp.truncate(os.path.getsize(path) - 1)
+        self.assertEqual(writeAheadLog.recover(), 4)
+        self.assertEqual(self.saved(3), [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(self.saved(4), [])
+
+    def test_only_the_given_name(self):
+        self.log(3, 0, 4)
+        self.assertEqual(writeAheadLog.recover("worker1"), 0)
+        self.assertEqual(len(writeAheadLog.list_files("main")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
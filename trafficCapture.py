@@ -0,0 +1,174 @@
+import os
+import time
+import struct
+import threading
+from collections import deque
+""" Capture of the traffic of the IoTDs
+
+FILENAME
+    trafficCapture.py
+
+DESCRIPTION
+    With --capture FILE, the server records every connection that opens, every message it receives (before it is
+    parsed or rate limited) and every connection that closes, so that the same traffic can be played again with
+    trafficReplay.py. In cluster mode each worker writes its own file, FILE.worker<N>. An existing capture is never
+    written over: if FILE exists, the time and the process id go before its extension, as in
+    capture.20161024-093000.1234.iotc.
+    The file starts with HEADER: MAGIC, VERSION and the time the capture started (seconds since the epoch). Each event
+    is then a RECORD, followed by its payload:
+        seconds since the start (double), connection number (uint32), event (uint8), payload length (uint32)
+    The events are OPEN (the payload is b"binary" for a connection that sends binary messages), TEXT and BINARY
+    messages, and CLOSE. The connections are numbered in the order they opened.
+    The IOLoop only packs the records and adds them to a deque. A Recorder thread takes them from the deque and
+    writes them to the file every FLUSHINTERVAL seconds.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+# The server captures its traffic to this file when it is set (see the --capture option of PyWsServer.py):
+CAPTUREFILE = None
+FLUSHINTERVAL = 0.5
+
+MAGIC = b"IOTC"
+VERSION = 1
+HEADER = struct.Struct("<4sHd")
+RECORD = struct.Struct("<dIBI")
+OPEN = 0
+TEXT = 1
+BINARY = 2
+CLOSE = 3
+EVENTNAMES = ("open", "text", "binary", "close")
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[trafficCapture : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[trafficCapture : INFO] %s' % msg)
+
+
+def read_capture(filename):
+    # Yield the events of a capture file as (seconds since the start, connection number, event, payload). A record
+    # cut short at the end of the file (the server was killed) is ignored.
+    with open(filename, 'rb') as fp:
+        header = fp.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        magic, version, started = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d capture" % (filename, VERSION))
+        while True:
+            record = fp.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            t, connection, event, length = RECORD.unpack(record)
+            payload = fp.read(length)
+            if len(payload) < length:
+                return
+            yield t, connection, event, payload
+
+
+def unique_filename(filename):
+    # filename with the time and the process id before its extension:
+    root, extension = os.path.splitext(filename)
+    return "%s.%s.%d%s" % (root, time.strftime("%Y%m%d-%H%M%S"), os.getpid(), extension)
+
+
+def capture_start(filename):
+    # The time the capture started, in seconds since the epoch:
+    with open(filename, 'rb') as fp:
+        return HEADER.unpack(fp.read(HEADER.size))[2]
+
+
+class Recorder(threading.Thread):
+    def __init__(self, filename):
+        threading.Thread.__init__(self, name="Recorder", daemon=True)
+        self.filename = filename
+        self.started = time.time()
+        self.origin = time.monotonic()
+        self.connections = 0
+        self.records = deque()
+        self.events = 0
+        self.stopping = threading.Event()
+        try:
+            self.fp = open(filename, 'xb')
+        except FileExistsError:
+            self.filename = unique_filename(filename)
+            self.fp = open(self.filename, 'xb')
+            info_msg("%s exists, capturing to %s" % (filename, self.filename))
+        self.fp.write(HEADER.pack(MAGIC, VERSION, self.started))
+
+    def open(self, binary=False):
+        # Record a new connection, and return its number:
+        self.connections += 1
+        self.record(self.connections, OPEN, b"binary" if binary else b"")
+        return self.connections
+
+    def message(self, connection, message):
+        if isinstance(message, bytes):
+            self.record(connection, BINARY, message)
+        else:
+            self.record(connection, TEXT, message.encode("utf-8"))
+
+    def close(self, connection):
+        self.record(connection, CLOSE, b"")
+
+    def record(self, connection, event, payload):
+        # Called from the IOLoop, the deque is emptied by the thread:
+        self.records.append(RECORD.pack(time.monotonic() - self.origin, connection, event, len(payload)) + payload)
+        self.events += 1
+
+    def run(self):
+        while not self.stopping.wait(FLUSHINTERVAL):
+            self.write()
+        self.write()
+        self.fp.close()
+        info_msg("%d events captured to %s" % (self.events, self.filename))
+
+    def write(self):
+        records = []
+        while self.records:
+            records.append(self.records.popleft())
+        if records:
+            try:
+                self.fp.write(b"".join(records))
+                self.fp.flush()
+            except OSError as e:
+                info_msg("Could not write the capture (%s)" % e)
+
+    def stop(self):
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+        elif not self.fp.closed:
+            self.write()
+            self.fp.close()
@@ -0,0 +1,371 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from array import array
+import tornado.gen
+import tornado.ioloop
+import tornado.websocket
+import diskWriter
+import mbedWSClient
+import messageParser
+import trafficCapture
+import wsBench
+""" Replay of a captured traffic
+
+FILENAME
+    trafficReplay.py
+
+DESCRIPTION
+    Plays the traffic captured by the server (see trafficCapture.py and the --capture option of PyWsServer.py) again,
+    to compare the builds of the server on the same real traffic:
+        python trafficReplay.py capture.iotc                  as it was captured, over local sockets
+        python trafficReplay.py capture.iotc --speed 10       ten times faster
+        python trafficReplay.py capture.iotc --speed 0        as fast as the server takes it
+        python trafficReplay.py capture.iotc --inproc         straight into MbedWSClient, without the sockets
+    Over the sockets, the replay starts its own headless server on --port (as wsBench.py does), or drives a running
+    one with --url. Each captured connection is opened again at the time it was opened, with the binary subprotocol
+    if it was a binary connection, and sends its messages at the times they were received.
+    In process, a DeviceRegistry and a DiskWriter are created in a temporary data directory, and each message is
+    parsed and given to MbedWSClient.append_sample, as WSHandler.on_message does.
+    Both report the throughput, the ingest latency of the samples (every wsBench.LATENCYEVERY-th send counter of each
+    IoTD over the sockets, every message in process), and how late the events were played compared to the capture.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[trafficReplay : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[trafficReplay : INFO] %s' % msg)
+
+
+def load_events(filename):
+    # Return the events of a capture, as (time, connection number, event, payload), in the order they were captured.
+    # A connection without an OPEN (the capture file was cut) is opened as the kind of its first message:
+    events = []
+    opened = set()
+    for t, connection, event, payload in trafficCapture.read_capture(filename):
+        if connection not in opened:
+            opened.add(connection)
+            if event != trafficCapture.OPEN:
+                kind = b"binary" if event == trafficCapture.BINARY else b""
+                events.append((t, connection, trafficCapture.OPEN, kind))
+        events.append((t, connection, event, payload))
+    return events
+
+
+def by_connection(events):
+    # {connection number: [(time, event, payload), ...]}:
+    connections = {}
+    for t, connection, event, payload in events:
+        connections.setdefault(connection, []).append((t, event, payload))
+    return connections
+
+
+def timed_samples(payload, binary):
+    # The (IoT ID, send counter) of the samples of a message whose ingest time is measured over the sockets:
+    try:
+        samples = messageParser.parse_binary(payload) if binary else messageParser.parse_text(payload.decode("utf-8"))
+    except (messageParser.ParseError, UnicodeDecodeError):
+        return []
+    return [(sample.iot_id, int(sample.send_counter)) for sample in samples
+            if int(sample.send_counter) % wsBench.LATENCYEVERY == 0]
+
+
+class Replay(object):
+    def __init__(self, events, speed):
+        # speed is how many times faster than the capture to replay, 0 for as fast as possible:
+        self.events = events
+        self.connections = by_connection(events)
+        self.speed = speed
+        self.messages = 0
+        self.payload_bytes = 0
+        self.connects = 0
+        self.connect_errors = 0
+        self.send_errors = 0
+        # How late each event was played compared to the capture, in seconds, when the replay is timed:
+        self.lateness = array('d')
+        self.start = None
+        self.elapsed = None
+
+    def due(self, t):
+        # The time.perf_counter() at which an event captured t seconds after the start must be played:
+        return self.start + t / self.speed
+
+    def lag(self, t):
+        # Seconds to wait before an event is due, the lateness is recorded when it is due already:
+        if not self.speed:
+            return 0.0
+        wait = self.due(t) - time.perf_counter()
+        if wait <= 0:
+            self.lateness.append(-wait)
+        return wait
+
+
+class InprocReplay(Replay):
+    def __init__(self, events, speed, data_directory):
+        Replay.__init__(self, events, speed)
+        mbedWSClient.INFOMSG = 0
+        diskWriter.INFOMSG = 0
+        mbedWSClient.DATADIRECTORY = data_directory
+        self.registry = mbedWSClient.DeviceRegistry()
+        self.writer = diskWriter.DiskWriter()
+        self.registry.writer = self.writer
+        self.registry.listeners.append(self.on_sample)
+        self.ingested = 0
+        self.parse_errors = 0
+        # Seconds taken by each message, from the parsing to the last sample it holds:
+        self.latencies = array('d')
+        self.flush = None
+
+    def on_sample(self, IoTID, timestamp, sample):
+        self.ingested += 1
+
+    def run(self):
+        clients = {}
+        binary = {}
+        self.writer.start()
+        self.start = time.perf_counter()
+        for t, connection, event, payload in self.events:
+            wait = self.lag(t)
+            if wait > 0:
+                time.sleep(wait)
+            if event == trafficCapture.OPEN:
+                clients[connection] = self.registry.add_connection(("replay", connection))
+                binary[connection] = payload == b"binary"
+                self.connects += 1
+            elif event == trafficCapture.CLOSE:
+                self.registry.remove_connection(("replay", connection))
+                clients.pop(connection, None)
+            elif connection in clients:
+                self.messages += 1
+                self.payload_bytes += len(payload)
+                began = time.perf_counter()
+                try:
+                    if event == trafficCapture.BINARY:
+                        if not binary[connection]:
+                            raise messageParser.ParseError("Binary message on a text connection")
+                        samples = messageParser.parse_binary(payload)
+                    else:
+                        samples = messageParser.parse_text(payload.decode("utf-8"))
+                except (messageParser.ParseError, UnicodeDecodeError):
+                    self.parse_errors += 1
+                    continue
+                client = clients[connection]
+                for sample in samples:
+                    client.append_sample(sample)
+                self.latencies.append(time.perf_counter() - began)
+        self.elapsed = time.perf_counter() - self.start
+        # Save what is left, as the server does when it stops:
+        began = time.perf_counter()
+        self.registry.close_rollups()
+        self.registry.save_data_to_disk(-1)
+        self.writer.stop()
+        self.flush = time.perf_counter() - began
+
+    def results(self):
+        return {
+            "ingested": self.ingested,
+            "ingested_per_second": self.ingested / self.elapsed if self.elapsed else None,
+            "parse_errors": self.parse_errors,
+            "message_latency_ms": wsBench.percentiles(self.latencies),
+            "final_save_ms": self.flush * 1000.0,
+        }
+
+
+class SocketReplay(Replay):
+    def __init__(self, events, speed, url):
+        Replay.__init__(self, events, speed)
+        self.url = url
+        # Send time of the timed samples, keyed by (IoT ID, send counter):
+        self.send_times = {}
+
+    async def connection(self, events):
+        t, event, payload = events[0]
+        wait = self.lag(t)
+        if wait > 0:
+            await tornado.gen.sleep(wait)
+        binary = payload == b"binary"
+        try:
+            conn = await tornado.websocket.websocket_connect(
+                self.url, subprotocols=[messageParser.BINARYSUBPROTOCOL] if binary else None)
+        except Exception as e:
+            self.connect_errors += 1
+            debug_msg("Could not connect: %s" % e)
+            return
+        self.connects += 1
+        tornado.ioloop.IOLoop.current().spawn_callback(self.read_commands, conn)
+        for t, event, payload in events[1:]:
+            if event == trafficCapture.CLOSE:
+                break
+            wait = self.lag(t)
+            if wait > 0:
+                await tornado.gen.sleep(wait)
+            sent = time.time()
+            for key in timed_samples(payload, event == trafficCapture.BINARY):
+                self.send_times[key] = sent
+            try:
+                if event == trafficCapture.BINARY:
+                    future = conn.write_message(payload, binary=True)
+                else:
+                    future = conn.write_message(payload.decode("utf-8"))
+                if not self.speed:
+                    # As fast as the server takes it, but no faster:
+                    await future
+            except tornado.websocket.WebSocketClosedError:
+                self.send_errors += 1
+                break
+            self.messages += 1
+            self.payload_bytes += len(payload)
+        conn.close()
+
+    async def read_commands(self, conn):
+        # The commands sent to the IoTDs are read and dropped:
+        while await conn.read_message() is not None:
+            pass
+
+    async def run(self):
+        self.start = time.perf_counter()
+        await tornado.gen.multi([self.connection(self.connections[connection]) for connection in self.connections])
+        self.elapsed = time.perf_counter() - self.start
+        # Let the last messages arrive:
+        await tornado.gen.sleep(1.0)
+
+    def results(self, stats):
+        if stats is None:
+            return {}
+        latencies = []
+        for IoTID, counter, t in zip(*stats["ingest"]):
+            sent = self.send_times.get((IoTID, counter))
+            if sent is not None:
+                latencies.append(t - sent)
+        return {
+            "ingested": stats["ingested"],
+            "ingested_per_second": stats["ingested"] / self.elapsed if self.elapsed else None,
+            "ingest_latency_ms": wsBench.percentiles(latencies),
+            "flush_latency_ms": wsBench.percentiles(stats["flushes"]),
+        }
+
+
+def report(args, replay, results):
+    results.update({
+        "capture": args.capture,
+        "mode": "inproc" if args.inproc else "sockets",
+        "speed": args.speed,
+        "events": len(replay.events),
+        "connections": len(replay.connections),
+        "duration": replay.elapsed,
+        "messages": replay.messages,
+        "messages_per_second": replay.messages / replay.elapsed if replay.elapsed else None,
+        "payload_bytes": replay.payload_bytes,
+        "connects": replay.connects,
+        "connect_errors": replay.connect_errors,
+        "send_errors": replay.send_errors,
+        "send_lateness_ms": wsBench.percentiles(replay.lateness),
+    })
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print("Capture: %s, %d events on %d connections, replayed %s at %s in %.3f s" % (
+        args.capture, len(replay.events), len(replay.connections), results["mode"],
+        "%gx" % args.speed if args.speed else "full speed", replay.elapsed))
+    print("Sent: %d messages (%.1f msg/s), %d bytes, %d connects, %d connect errors, %d send errors" % (
+        replay.messages, results["messages_per_second"] or 0.0, replay.payload_bytes, replay.connects,
+        replay.connect_errors, replay.send_errors))
+    if "ingested" in results:
+        print("Ingested: %d samples (%.1f samples/s)" % (results["ingested"], results["ingested_per_second"] or 0.0))
+    if results.get("parse_errors"):
+        print("Parse errors: %d" % results["parse_errors"])
+    for name, key in (("Message latency", "message_latency_ms"), ("Ingest latency", "ingest_latency_ms"),
+                      ("Flush latency", "flush_latency_ms"), ("Send lateness", "send_lateness_ms")):
+        if results.get(key):
+            p = results[key]
+            print("%s (ms, %d samples): p50 %.3f  p90 %.3f  p99 %.3f  max %.3f" % (
+                name, p["count"], p["p50"], p["p90"], p["p99"], p["max"]))
+    if "final_save_ms" in results:
+        print("Final save: %.1f ms" % results["final_save_ms"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay of a traffic captured by the IoT WebSocket server")
+    parser.add_argument("capture", help="capture file written with the --capture option of PyWsServer.py")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="times faster than the capture, 0 for as fast as possible (default: %(default)s)")
+    parser.add_argument("--inproc", action="store_true",
+                        help="give the messages straight to MbedWSClient instead of sending them over sockets")
+    parser.add_argument("--port", type=int, default=wsBench.BENCHPORT, help="port of the replay's own server")
+    parser.add_argument("--data", default=None, help="data directory of the replay (default: a temporary one)")
+    parser.add_argument("--url", default=None, help="replay to a running server instead, e.g. ws://host:4444/ws")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+    if args.speed < 0:
+        parser.error("--speed must be 0 or more")
+    try:
+        events = load_events(args.capture)
+    except (OSError, ValueError) as e:
+        parser.error("Could not read the capture: %s" % e)
+    data_directory = args.data or tempfile.mkdtemp(prefix="replay_") + os.sep
+    if args.inproc:
+        replay = InprocReplay(events, args.speed, data_directory)
+        replay.run()
+        report(args, replay, replay.results())
+        return
+    # As many file descriptors as the capture has connections:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    child = None
+    stats = None
+    if args.url is None:
+        args.url = "ws://127.0.0.1:%d/ws" % args.port
+        conn, child_conn = multiprocessing.Pipe()
+        child = multiprocessing.Process(target=wsBench.serve, args=(args.port, data_directory, child_conn))
+        child.start()
+        conn.recv()
+        info_msg("Replay server started, saving to %s" % data_directory)
+    replay = SocketReplay(events, args.speed, args.url)
+    tornado.ioloop.IOLoop.current().run_sync(replay.run)
+    if child is not None:
+        conn.send(("stop",))
+        stats = conn.recv()[1]
+        child.join()
+    report(args, replay, replay.results(stats))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
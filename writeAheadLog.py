@@ -0,0 +1,344 @@
+import os
+import queue
+import struct
+import threading
+import zlib
+import tornado.ioloop
+from array import array
+from datetime import date
+import diskWriter
+import mbedWSClient
+import rollupStore
+""" Crash-safe write-ahead log of the incoming samples
+
+FILENAME
+    writeAheadLog.py
+
+DESCRIPTION
+    The samples of an IoTD are only saved once SAVECOUNTER of them have arrived, so a crash or a power cut used to
+    lose up to 100 samples per IoTD (about 5 minutes at the 3-second send rate). With the write-ahead log, every
+    sample is also appended to a log file as soon as it arrives, and the log is replayed when the server starts
+    again.
+    Appending a sample only packs it into a buffer. The buffer is handed to the log thread every COMMITINTERVAL
+    seconds, or as soon as it holds COMMITBYTES, and the thread writes everything it has been given and calls fsync
+    once for all of it (a group commit). So a crash loses at most the last COMMITINTERVAL seconds of data, for one
+    fsync per interval instead of one per sample.
+    The log files are kept in <DATADIRECTORY>/wal/<name>-<sequence>.wal, where name tells the server processes apart
+    in cluster mode. Every CHECKPOINTINTERVAL seconds, the server starts a new log file, saves all of the data in
+    memory and asks the disk writer to fsync its files. Once that is done, the older log files are deleted.
+    Each commit is written as a group: its length and CRC32, followed by fixed-width records of the IoT ID and the
+    MAXVALUES doubles of a sample (time stamp first). When the log is replayed, it stops at the first group that was
+    not completely written. Samples that are already in the data files (they are older than the last row saved for
+    their IoTD) are skipped, the others are saved to the files of the day they arrived on, and to the rollups.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+# The log is only kept when this is set (see the --wal option of PyWsServer.py):
+ENABLED = False
+WALDIRECTORY = "wal"
+# Seconds between group commits, and the number of buffered bytes that triggers one early:
+COMMITINTERVAL = 0.5
+COMMITBYTES = 1 << 20
+# Seconds between checkpoints, after which the old log files are deleted:
+CHECKPOINTINTERVAL = 300
+
+# The .csv files keep the time stamps to the microsecond, so a logged sample that is this close to the last saved
+# one is taken to be the same sample:
+TIMERESOLUTION = 1e-6
+
+GROUPHEADER = struct.Struct("<II")
+RECORD = struct.Struct("<I%dd" % mbedWSClient.MAXVALUES)
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[writeAheadLog : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[writeAheadLog : INFO] %s' % msg)
+
+
+def log_directory():
+    return os.path.join(mbedWSClient.DATADIRECTORY, WALDIRECTORY)
+
+
+def list_files(name=None):
+    # Return the sorted (name, sequence, path) of the log files, only those of one name if it is given:
+    files = []
+    directory = log_directory()
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if filename.endswith(".wal") and "-" in filename:
+                file_name, sequence = filename[:-4].rsplit("-", 1)
+                if sequence.isdigit() and (name is None or file_name == name):
+                    files.append((file_name, int(sequence), os.path.join(directory, filename)))
+    files.sort()
+    return files
+
+
+def read_file(path):
+    # Yield the (IoT ID, sample) records of a log file, up to the first group that was not completely written:
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    pos = 0
+    while pos < len(data):
+        if pos + GROUPHEADER.size > len(data):
+            info_msg("Ignoring a cut group at the end of %s" % path)
+            break
+        length, crc = GROUPHEADER.unpack_from(data, pos)
+        pos += GROUPHEADER.size
+        group = data[pos:pos + length]
+        if len(group) != length or length % RECORD.size != 0 or zlib.crc32(group) != crc:
+            info_msg("Ignoring a damaged group at the end of %s" % path)
+            break
+        for record in RECORD.iter_unpack(group):
+            yield record[0], record[1:]
+        pos += length
+
+
+def last_saved(IoTID, csv_files, segments):
+    # Return the time stamp of the last sample of IoTID in the data files, or None if some of them have none:
+    times = []
+    if csv_files is not None:
+        row = None
+        if IoTID in csv_files:
+            try:
+                row = diskWriter.read_last_row(csv_files[IoTID])
+            except OSError as e:
+                info_msg("Could not read %s (%s)" % (csv_files[IoTID], e))
+        times.append(None if row is None else row[0])
+    if segments is not None:
+        times.append(segments.last_time(IoTID))
+    if not times or None in times:
+        return None
+    return min(times)
+
+
+def recover(name=None, csv=True, segments=None):
+    # Save the samples left in the log files of a server that did not stop cleanly, then delete the files. Only the
+    # files of one name are replayed if it is given. Returns the number of samples recovered.
+    files = list_files(name)
+    if not files:
+        return 0
+    samples = {}
+    for file_name, sequence, path in files:
+        try:
+            for IoTID, sample in read_file(path):
+                if IoTID not in samples:
+                    samples[IoTID] = []
+                samples[IoTID].append(sample)
+        except OSError as e:
+            info_msg("Could not read %s (%s)" % (path, e))
+            return 0
+    writer = diskWriter.DiskWriter(csv, segments, durable=True)
+    csv_files = diskWriter.latest_csv_files(mbedWSClient.DATADIRECTORY) if csv else None
+    recovered = 0
+    for IoTID in sorted(samples):
+        last = last_saved(IoTID, csv_files, segments)
+        day = None
+        columns = None
+        rollups = rollupStore.RollupSet(mbedWSClient.MAXVALUES)
+        for sample in samples[IoTID]:
+            if last is not None and sample[0] <= last + TIMERESOLUTION:
+                # Already saved before the server stopped:
+                continue
+            rollups.add(sample)
+            sample_day = date.fromtimestamp(sample[0])
+            if sample_day != day:
+                if columns is not None:
+                    writer.submit(IoTID, mbedWSClient.csv_filename(IoTID, day), columns)
+                day = sample_day
+                columns = [array('d') for value in sample]
+            for column, value in zip(columns, sample):
+                column.append(value)
+            recovered += 1
+        if columns is not None:
+            writer.submit(IoTID, mbedWSClient.csv_filename(IoTID, day), columns)
+        rollups.close()
+        pending = rollups.take_pending()
+        for tier in pending:
+            writer.submit_records(IoTID, rollupStore.rollup_filename(mbedWSClient.DATADIRECTORY, tier, IoTID),
+                                  pending[tier])
+    synced = []
+    writer.sync(lambda: synced.append(True))
+    writer.start()
+    writer.stop()
+    if not synced:
+        info_msg("Could not save the samples of the log files, they are kept for the next start.")
+        return 0
+    for file_name, sequence, path in files:
+        try:
+            os.remove(path)
+        except OSError as e:
+            info_msg("Could not delete %s (%s)" % (path, e))
+    info_msg("Recovered %d samples from %d log files" % (recovered, len(files)))
+    return recovered
+
+
+class WriteAheadLog(threading.Thread):
+    def __init__(self, name="main", interval=None, budget=None):
+        threading.Thread.__init__(self, name="WriteAheadLog", daemon=True)
+        self.directory = log_directory()
+        self.name = name
+        self.interval = COMMITINTERVAL if interval is None else interval
+        self.budget = COMMITBYTES if budget is None else budget
+        # Records waiting for the next commit:
+        self.buffer = bytearray()
+        self.queue = queue.Queue()
+        # Files left behind by an earlier run (if they could not be recovered) are never deleted by this log:
+        existing = list_files(name)
+        self.first_sequence = existing[-1][1] + 1 if existing else 0
+        # The sequence of the file being written, as seen from the IOLoop and from the log thread:
+        self.sequence = self.first_sequence
+        self.file_sequence = self.first_sequence
+        self.fp = None
+        self.timers = []
+        self.commits = 0
+        self.fsyncs = 0
+
+    def append(self, IoTID, sample):
+        # Called from the IOLoop for every sample, a tuple of MAXVALUES numbers starting with the time stamp:
+        self.buffer += RECORD.pack(IoTID, *sample)
+        if len(self.buffer) >= self.budget:
+            self.commit()
+
+    def commit(self):
+        # Hand the buffered records to the log thread:
+        if self.buffer:
+            data = self.buffer
+            self.buffer = bytearray()
+            self.queue.put(("write", data))
+
+    def rotate(self):
+        # Commit, and start a new log file. Returns the sequence of the new file:
+        self.commit()
+        self.sequence += 1
+        self.queue.put(("rotate", self.sequence))
+        return self.sequence
+
+    def checkpoint(self, registry, writer):
+        # Save everything in memory, and delete the old log files once the disk writer has synced it:
+        if registry.held:
+            # Some of the data cannot be saved yet, keep the log:
+            debug_msg("Checkpoint skipped, %d IoT IDs are held" % len(registry.held))
+            return
+        sequence = self.rotate()
+        registry.save_data_to_disk(-1)
+        writer.sync(lambda: self.queue.put(("delete", sequence)))
+
+    def start_timers(self, registry, writer):
+        # Start the commit and checkpoint timers on the current IOLoop:
+        self.timers = [tornado.ioloop.PeriodicCallback(self.commit, self.interval * 1000),
+                       tornado.ioloop.PeriodicCallback(lambda: self.checkpoint(registry, writer),
+                                                       CHECKPOINTINTERVAL * 1000)]
+        for timer in self.timers:
+            timer.start()
+
+    def stop(self):
+        # Commit what is left, and exit the thread once everything queued is done:
+        for timer in self.timers:
+            timer.stop()
+        self.timers = []
+        self.commit()
+        self.queue.put(None)
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        info_msg("Write-ahead log started")
+        stopping = False
+        while not stopping:
+            items = [self.queue.get()]
+            # Take everything else that is waiting, it is all synced together:
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            written = False
+            for item in items:
+                if item is None:
+                    stopping = True
+                    continue
+                kind, value = item
+                try:
+                    if kind == "write":
+                        if self.fp is None:
+                            self.open_file()
+                        self.fp.write(GROUPHEADER.pack(len(value), zlib.crc32(value)))
+                        self.fp.write(value)
+                        self.commits += 1
+                        written = True
+                    elif kind == "rotate":
+                        if written:
+                            self.sync_file()
+                            written = False
+                        self.close_file()
+                        self.file_sequence = value
+                    elif kind == "delete":
+                        self.delete_files(value)
+                except OSError as e:
+                    info_msg("Write-ahead log error (%s)" % e)
+            if written:
+                try:
+                    self.sync_file()
+                except OSError as e:
+                    info_msg("Could not sync the write-ahead log (%s)" % e)
+        self.close_file()
+        info_msg("Write-ahead log stopped")
+
+    def open_file(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "%s-%08d.wal" % (self.name, self.file_sequence))
+        self.fp = open(path, 'ab')
+        debug_msg("Logging to %s" % path)
+
+    def sync_file(self):
+        # The group commit: one fsync for everything written since the last one:
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fsyncs += 1
+
+    def close_file(self):
+        if self.fp is not None:
+            try:
+                self.fp.close()
+            except OSError as e:
+                info_msg("Could not close the write-ahead log (%s)" % e)
+            self.fp = None
+
+    def delete_files(self, before):
+        # Delete the files of this log older than the file with sequence before:
+        for file_name, sequence, path in list_files(self.name):
+            if self.first_sequence <= sequence < before:
+                os.remove(path)
+                debug_msg("Deleted %s" % path)
@@ -0,0 +1,352 @@
+import os
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing
+from array import array
+import tornado.gen
+import tornado.ioloop
+import tornado.websocket
+import clusterServer
+""" Load generator and benchmark for the WebSocket server
+
+FILENAME
+    wsBench.py
+
+DESCRIPTION
+    Opens many simulated IoTD connections to the server, and measures how the server copes. Each simulated IoTD sends
+    "<IoT ID>,<send counter>,<temperature>" messages, exactly like the IoT_Ex firmware, at --rate messages per second.
+    With --churn, IoTDs drop their connection and reconnect, on average every 1/churn seconds.
+
+    By default the benchmark starts its own headless server in a child process (on --port, saving to a temporary
+    directory), with hooks that measure, on the server side:
+        ingest latency      from the moment a simulated IoTD sends a sample until the server has stored it
+        flush latency       the time the disk writer takes for each round of writes
+        RSS                 the memory used by the server process at the start and at the end
+    Commands are sent to random connected IoTDs every --cmd-interval seconds with TornadoThread.send_cmd, and the
+    round-trip time is measured until the simulated IoTD receives them.
+    With --url, an already running server is used instead. Only the client-side numbers are available then, plus the
+    RSS if --server-pid is given, and the command round trips if the server runs with --workers and --cluster-socket
+    is given.
+
+    Example:
+        python3 wsBench.py --devices 2000 --rate 1 --duration 60 --churn 0.01
+    Use --json to get the results in a form that can be compared between builds.
+
+AUTHOR
+    Damien Frost
+
+LICENSE
+    Copyright (c) 2016 Damien Frost
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+
+"""
+
+DEBUG = 0
+INFOMSG = 1
+
+BENCHPORT = 4450
+# Only every LATENCYEVERY-th sample of each IoTD is timed, to keep the bookkeeping small:
+LATENCYEVERY = 10
+# The command sent to measure round trips, the value is the sequence number:
+BENCHCOMMAND = "1,%d"
+
+
+def debug_msg(msg):
+    if DEBUG:
+        print('[wsBench : DEBUG] %s' % msg)
+
+
+def info_msg(msg):
+    if INFOMSG:
+        print('[wsBench : INFO] %s' % msg)
+
+
+def rss_bytes(pid=None):
+    # Resident memory of a process (Linux), or None if it cannot be read:
+    try:
+        with open("/proc/%s/statm" % (pid or "self")) as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def percentiles(values, scale=1000.0):
+    # Return the p50/p90/p99/max of values (in seconds) in milliseconds:
+    if not values:
+        return None
+    values = sorted(values)
+    result = {}
+    for name, p in (("p50", 0.50), ("p90", 0.90), ("p99", 0.99)):
+        result[name] = values[min(len(values) - 1, int(p * len(values)))] * scale
+    result["max"] = values[-1] * scale
+    result["count"] = len(values)
+    return result
+
+
+def serve(port, data_directory, conn):
+    # Run a headless server in this (child) process, with measurement hooks. conn is a multiprocessing Pipe end.
+    import PyWsServer
+    import mbedWSClient
+    mbedWSClient.INFOMSG = 0
+    PyWsServer.INFOMSG = 0
+    mbedWSClient.DATADIRECTORY = data_directory
+    PyWsServer.PORT = port
+    thread = PyWsServer.TornadoThread()
+    stats = {"ingested": 0, "flushes": [], "rss_start": rss_bytes()}
+    ingest_ids = array('l')
+    ingest_counters = array('l')
+    ingest_times = array('d')
+
+    def on_sample(IoTID, timestamp, sample):
+        stats["ingested"] += 1
+        if int(sample.send_counter) % LATENCYEVERY == 0:
+            ingest_ids.append(IoTID)
+            ingest_counters.append(int(sample.send_counter))
+            ingest_times.append(time.time())
+
+    def on_flush(seconds, batches):
+        stats["flushes"].append(seconds)
+
+    PyWsServer.Registry.listeners.append(on_sample)
+    thread.disk_writer.flush_listeners.append(on_flush)
+
+    def control():
+        # Commands from the benchmark:
+        while True:
+            msg = conn.recv()
+            if msg[0] == "cmd":
+                thread.send_cmd(msg[1], msg[2])
+            elif msg[0] == "stop":
+                thread.ioloop.add_callback(thread.ioloop.stop)
+                return
+
+    def ready():
+        # The IOLoop is running and listening, the benchmark can connect:
+        threading.Thread(target=control, daemon=True).start()
+        conn.send(("ready",))
+
+    # run() serves the sockets on the IOLoop of this (main) thread, the callback runs once it has started:
+    tornado.ioloop.IOLoop.current().add_callback(ready)
+    thread.run()
+    stats["rss_end"] = rss_bytes()
+    stats["connections_end"] = len(PyWsServer.Registry)
+    thread.stop()
+    stats["ingest"] = (ingest_ids.tolist(), ingest_counters.tolist(), ingest_times.tolist())
+    conn.send(("stats", stats))
+
+
+class Bench(object):
+    def __init__(self, args):
+        self.args = args
+        self.running = True
+        self.sent = 0
+        self.connects = 0
+        self.connect_errors = 0
+        self.send_errors = 0
+        # Send time of the timed samples, keyed by (IoT ID, send counter):
+        self.send_times = {}
+        # The IoT IDs that are connected right now:
+        self.connected = set()
+        # Command round trips:
+        self.cmd_sent = {}
+        self.cmd_rtts = []
+        self.cmd_seq = 0
+
+    async def device(self, IoTID, start_delay):
+        args = self.args
+        await tornado.gen.sleep(start_delay)
+        counter = 0
+        interval = 1.0 / args.rate
+        while self.running:
+            try:
+                conn = await tornado.websocket.websocket_connect(args.url)
+            except Exception as e:
+                self.connect_errors += 1
+                debug_msg("IoTD %d could not connect: %s" % (IoTID, e))
+                await tornado.gen.sleep(1.0)
+                continue
+            self.connects += 1
+            self.connected.add(IoTID)
+            tornado.ioloop.IOLoop.current().spawn_callback(self.read_commands, conn)
+            reconnect_at = time.time() + random.expovariate(args.churn) if args.churn > 0 else float("inf")
+            # Spread the first messages over one interval, so the IoTDs do not all send at once:
+            await tornado.gen.sleep(random.random() * interval)
+            while self.running and time.time() < reconnect_at:
+                counter += 1
+                if counter % LATENCYEVERY == 0:
+                    self.send_times[(IoTID, counter)] = time.time()
+                try:
+                    conn.write_message("%d,%d,%.3f" % (IoTID, counter, 20.0 + 5.0 * random.random()))
+                except tornado.websocket.WebSocketClosedError:
+                    self.send_errors += 1
+                    break
+                self.sent += 1
+                await tornado.gen.sleep(interval)
+            self.connected.discard(IoTID)
+            conn.close()
+
+    async def read_commands(self, conn):
+        while True:
+            msg = await conn.read_message()
+            if msg is None:
+                return
+            try:
+                seq = int(msg.split(",")[1])
+            except (IndexError, ValueError):
+                continue
+            if seq in self.cmd_sent:
+                self.cmd_rtts.append(time.time() - self.cmd_sent.pop(seq))
+
+    def send_command(self, send):
+        # Send a command to a random connected IoTD through send(adr, cmd):
+        if self.connected:
+            IoTID = random.choice(tuple(self.connected))
+            self.cmd_seq += 1
+            self.cmd_sent[self.cmd_seq] = time.time()
+            send(IoTID, BENCHCOMMAND % self.cmd_seq)
+
+    async def run(self, send=None):
+        args = self.args
+        ioloop = tornado.ioloop.IOLoop.current()
+        for ii in range(args.devices):
+            ioloop.spawn_callback(self.device, args.first_id + ii, ii / args.ramp)
+        start = time.time()
+        next_cmd = start + args.cmd_interval
+        while time.time() - start < args.duration:
+            await tornado.gen.sleep(0.1)
+            if send is not None and args.cmd_interval > 0 and time.time() >= next_cmd:
+                self.send_command(send)
+                next_cmd += args.cmd_interval
+        self.running = False
+        self.elapsed = time.time() - start
+        # Let the last messages and command replies arrive:
+        await tornado.gen.sleep(1.0)
+
+
+def report(args, bench, stats):
+    results = {
+        "devices": args.devices,
+        "rate": args.rate,
+        "churn": args.churn,
+        "duration": bench.elapsed,
+        "sent": bench.sent,
+        "sent_per_second": bench.sent / bench.elapsed,
+        "connects": bench.connects,
+        "connect_errors": bench.connect_errors,
+        "send_errors": bench.send_errors,
+        "command_rtt_ms": percentiles(bench.cmd_rtts),
+        "commands_lost": len(bench.cmd_sent),
+    }
+    if stats is not None:
+        latencies = []
+        for IoTID, counter, t in zip(*stats["ingest"]):
+            sent = bench.send_times.get((IoTID, counter))
+            if sent is not None:
+                latencies.append(t - sent)
+        results["ingested"] = stats["ingested"]
+        results["ingested_per_second"] = stats["ingested"] / bench.elapsed
+        results["ingest_latency_ms"] = percentiles(latencies)
+        results["flush_latency_ms"] = percentiles(stats["flushes"])
+        results["rss_start_mb"] = stats["rss_start"] / 1e6 if stats["rss_start"] else None
+        results["rss_end_mb"] = stats["rss_end"] / 1e6 if stats["rss_end"] else None
+    elif args.server_pid:
+        results["rss_start_mb"] = bench.rss_start / 1e6 if bench.rss_start else None
+        results["rss_end_mb"] = bench.rss_end / 1e6 if bench.rss_end else None
+    if results.get("rss_start_mb") is not None and results.get("rss_end_mb") is not None:
+        results["rss_growth_mb"] = results["rss_end_mb"] - results["rss_start_mb"]
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print("Devices: %d at %.3g msg/s each, churn %.3g/s, %.1f s" % (args.devices, args.rate, args.churn,
+                                                                     bench.elapsed))
+    print("Sent: %d messages (%.1f msg/s), %d connects, %d connect errors, %d send errors" % (
+        bench.sent, results["sent_per_second"], bench.connects, bench.connect_errors, bench.send_errors))
+    if "ingested" in results:
+        print("Ingested: %d messages (%.1f msg/s)" % (results["ingested"], results["ingested_per_second"]))
+    for name, key in (("Ingest latency", "ingest_latency_ms"), ("Command RTT", "command_rtt_ms"),
+                      ("Flush latency", "flush_latency_ms")):
+        if results.get(key):
+            p = results[key]
+            print("%s (ms, %d samples): p50 %.2f  p90 %.2f  p99 %.2f  max %.2f" % (
+                name, p["count"], p["p50"], p["p90"], p["p99"], p["max"]))
+    if results.get("rss_growth_mb") is not None:
+        print("Server RSS: %.1f MB -> %.1f MB (%+.1f MB)" % (results["rss_start_mb"], results["rss_end_mb"],
+                                                             results["rss_growth_mb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark for the IoT WebSocket server")
+    parser.add_argument("--devices", type=int, default=1000, help="number of simulated IoTDs (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=1.0 / 3,
+                        help="messages per second sent by each IoTD (default: %(default).3f)")
+    parser.add_argument("--duration", type=float, default=30.0, help="length of the run in seconds")
+    parser.add_argument("--churn", type=float, default=0.0,
+                        help="reconnections per second of each IoTD (default: no reconnections)")
+    parser.add_argument("--ramp", type=float, default=500.0, help="new connections per second at the start")
+    parser.add_argument("--first-id", type=int, default=1, help="IoT ID of the first simulated IoTD")
+    parser.add_argument("--cmd-interval", type=float, default=0.5,
+                        help="seconds between round-trip commands, 0 for none (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=BENCHPORT, help="port of the benchmark's own server")
+    parser.add_argument("--data", default=None, help="data directory of the benchmark's own server")
+    parser.add_argument("--url", default=None, help="benchmark a running server instead, e.g. ws://host:4444/ws")
+    parser.add_argument("--server-pid", type=int, default=None, help="pid of the running server, for its RSS")
+    parser.add_argument("--cluster-socket", default=None,
+                        help="coordinator socket of a running --workers server, for command round trips")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+    # Thousands of connections need thousands of file descriptors:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    bench = Bench(args)
+    child = None
+    stats = None
+    send = None
+    if args.url is None:
+        data_directory = args.data or tempfile.mkdtemp(prefix="wsbench_") + os.sep
+        args.url = "ws://127.0.0.1:%d/ws" % args.port
+        conn, child_conn = multiprocessing.Pipe()
+        child = multiprocessing.Process(target=serve, args=(args.port, data_directory, child_conn))
+        child.start()
+        conn.recv()
+        info_msg("Benchmark server started, saving to %s" % data_directory)
+
+        def send(adr, cmd):
+            conn.send(("cmd", adr, cmd))
+    elif args.cluster_socket:
+        def send(adr, cmd):
+            clusterServer.send_command(adr, cmd, args.cluster_socket)
+    bench.rss_start = rss_bytes(args.server_pid) if args.server_pid else None
+    tornado.ioloop.IOLoop.current().run_sync(lambda: bench.run(send))
+    bench.rss_end = rss_bytes(args.server_pid) if args.server_pid else None
+    if child is not None:
+        conn.send(("stop",))
+        msg = conn.recv()
+        stats = msg[1]
+        child.join()
+    report(args, bench, stats)
+
+
+if __name__ == "__main__":
+    main()